@@ -1,51 +1,426 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import numpy as np
-from skimage.registration import phase_cross_correlation
-from skimage.transform import AffineTransform, warp
-from skimage.filters import gaussian
-from scipy.interpolate import UnivariateSpline
+from driftmodel import fitmodel
+from instrument import count, logger, stage
+from jobs import checkpoint
+from references import ReferenceStrategy
+from registration import PyramidReference, ReferenceSpectrum, TiledReference, _taper, blur
+from tiffstack import tiffstack
 
-def PCC(tf, update=10, smoothing=0.9):
+_worker = threading.local()
+
+
+def PCC(tf, update=10, smoothing=None, workers=1, backend='thread', batch=None, pyramid=0, crop=512, tiles=0,
+        tilesize=256, aggregate='consensus', strategy='rolling', weight=0.3, precision='float32', model='spline',
+        taper=True, verbose=False, progress=None, cancel=None):
 
     """
-    Phase cross correlation to estimate the drift between images in a stack
+    Cross correlation to estimate the drift between images in a stack, of Hann tapered full frames by default or
+    phase correlation of whole frames with taper=False
     :param tf: stack of tiff images encapsulated in the tiffstack class
     :param update: how often the reference frame should be updated
-    :param smoothing: How much smoothing to apply to the fitted spline
+    :param smoothing: How much smoothing to apply to the fitted drift model, None chooses it by cross-validation
+    :param workers: number of workers to register frames with, 1 runs everything in this process
+    :param backend: 'thread' or 'process' pool used when workers > 1
+    :param batch: number of frames per batched FFT registration against a cached reference spectrum,
+    None registers frames one at a time with skimage
+    :param pyramid: number of 2x downsampling levels for coarse-to-fine registration, 0 registers at full resolution
+    :param crop: size of the full resolution window used to refine pyramid registrations
+    :param tiles: register this many automatically chosen tiles, or a list of (row, col) tile origins, and
+    combine their shifts instead of correlating the full frame, 0 uses the full frame
+    :param tilesize: edge length of the tiles
+    :param aggregate: how tile shifts are combined, 'median' or 'consensus'
+    :param strategy: how the reference frame is managed, 'fixed', 'rolling' or 'average', see
+    references.ReferenceStrategy
+    :param weight: weight of the newest keyframe in the 'average' template
+    :param precision: float dtype frames are blurred and registered in, 'float32' halves the memory traffic of
+    'float64' for the same subpixel precision
+    :param model: drift model fitted to the shifts, 'spline', 'polynomial' or 'robust', see driftmodel
+    :param taper: full frames are tapered with a Hann window and cross correlated, so the edges of the frames
+    don't pull the shifts towards zero. False phase correlates the whole frames as skimage does
+    :param verbose: print the offset detected in every frame, it is always logged at debug level on the
+    driftcorrection logger
+    :param progress: called as progress(index, shift) as soon as each frame has been registered,
+    frames arrive out of order when workers > 1
+    :param cancel: threading.Event, raises jobs.Cancelled once it is set
     :return: drift_total - list of x,y shifts for translation based drift
-    uxs - the fitted spline for x
-    usy - the fitted spline for y
+    usx - the fitted drift for the first (y) component of the shifts
+    usy - the fitted drift for the second (x) component
     """
 
-    counter = 0
-    drift_total = []
-    refimage = tf.getimage(0)
-    refimage = gaussian(refimage,sigma=2)
+    # The reference chain is inherently serial: each new reference depends on the shift of the boundary frame
+    # before it. Walk the chain first, then every other frame only depends on its segment reference and can
+    # be registered independently.
+    def notify(index, shift):
+        if progress is not None:
+            progress(index, shift)
+        checkpoint(cancel)
+
+    engine = dict(batch=batch, pyramid=pyramid, crop=crop, tiles=tiles, tilesize=tilesize, aggregate=aggregate,
+                  taper=taper, precision=precision)
+    references, shifts = referencechain(tf, update, engine, notify,
+                                        ReferenceStrategy(strategy, weight, precision=precision))
+    segments = []
+    start = 1
+    for k, (reference, offset) in enumerate(references):
+        stop = segmentboundary(k, update) if k < len(references) - 1 else tf.nfiles
+        indices = [index for index in range(start, min(stop + 1, tf.nfiles)) if index not in shifts]
+        if indices:
+            segments.append((reference, offset, indices))
+        start = stop + 1
+
+    if workers > 1:
+        shifts.update(_register_parallel(tf, segments, workers, backend, engine, notify))
+    else:
+        for reference, offset, indices in segments:
+            found = register_frames(tf, reference, indices, engine,
+                                    notify=lambda index, shift: notify(index, offset + shift))
+            shifts.update((index, offset + shift) for index, shift in found.items())
 
-    # refimage = io.imread(filelist[0])
-    # for file in (filelist[1:]):
+    drift_total = []
+    # Formatting a line per frame costs real time on long stacks, only do it when someone will see it
+    debug = logger.isEnabledFor(logging.DEBUG)
     for index in range(1, tf.nfiles):
-        #movingimage = io.imread(file)
-        movingimage = tf.getimage(index)
-        movingimage = gaussian(movingimage,sigma=2)
-        # subpixel precision
-        shift, error, diffphase = phase_cross_correlation(refimage, movingimage,
-                                                          upsample_factor=100)
-        euc = np.sqrt((shift[0]) ** 2 + (shift[1]) ** 2)
-        print(f'Detected subpixel offset (y, x) in tif {index+1}: {shift} with euclidean distance {euc}')
-
-        # As the image changes over time, update the refimage with transformed movingimage
-        if counter > update:
-            transform = AffineTransform(translation=[shift[1] * -1, shift[0] * -1])
-            refimage = warp(movingimage, transform, preserve_range=True)
-            counter = 0
-        counter += 1
+        shift = shifts[index]
+        if verbose or debug:
+            euc = np.sqrt((shift[0]) ** 2 + (shift[1]) ** 2)
+            line = f'Detected subpixel offset (y, x) in tif {index+1}: {shift} with euclidean distance {euc}'
+            logger.debug(line)
+            if verbose:
+                print(line)
         drift_total.append(shift)
-    x = [x[0] for x in drift_total]
-    y = [y[1] for y in drift_total]
-    t = [t for t in range(len(x))]
-    #Spline smoothing to reduce in correct drift spikes
-    usx = UnivariateSpline(t, x)
-    usy = UnivariateSpline(t, y)
-    usx.set_smoothing_factor(smoothing)
-    usy.set_smoothing_factor(smoothing)
-    return drift_total, usx, usy
\ No newline at end of file
+    count('frames registered', len(drift_total))
+    usx, usy = fitdrift(drift_total, smoothing, model)
+    return drift_total, usx, usy
+
+
+def fitdrift(drift_total, smoothing=None, model='spline'):
+    """
+    Fits the drift model to the per frame shifts, cheap compared to finding the shifts so changing
+    only the smoothing or the model doesn't need the stack registering again
+    :param drift_total: list of (y, x) shifts as found by PCC
+    :param smoothing: How much smoothing to apply, None chooses it by cross-validation
+    :param model: 'spline', 'polynomial' or 'robust', see driftmodel.fitmodel
+    :return: usx, usy - the two components of one driftmodel.DriftModel as returned by PCC
+    """
+    with stage('spline'):
+        fitted = fitmodel(np.arange(len(drift_total)), np.asarray(drift_total).reshape(-1, 2), model, smoothing)
+    return fitted.axis(0), fitted.axis(1)
+
+
+class OnlinePCC:
+
+    """
+    Streaming counterpart of PCC for acquisitions that are still being recorded. Frames are fed one at a time,
+    the reference is kept between calls and the smoothed drift comes from a drift model over only the most recent
+    frames, so the cost per frame stays the same however long the acquisition runs.
+    The raw shifts are identical to those PCC finds for the same frames.
+    :param update: how often the reference frame should be updated
+    :param smoothing: How much smoothing to apply to the fitted drift model, None chooses it by cross-validation
+    :param window: number of recent frames the drift model is fitted to
+    :param strategy: how the reference frame is managed, see PCC
+    :param weight: weight of the newest keyframe in the 'average' template
+    :param model: drift model, see PCC
+    :param engine: registration options, see reference_engine, and precision, see PCC
+    """
+
+    def __init__(self, update=10, smoothing=None, window=50, strategy='rolling', weight=0.3, model='spline',
+                 **engine):
+        self.update = update
+        self.smoothing = smoothing
+        self.model = model
+        self.window = window
+        self.engine, dtype = _precision(engine)
+        self.strategy = ReferenceStrategy(strategy, weight, precision=dtype)
+        self.refimage = None
+        self.reference = None
+        self.offset = np.zeros(2)
+        self.counter = 0
+        self.drift_total = []
+
+    def add(self, image):
+        """
+        Registers the next frame of the acquisition, the first frame becomes the reference
+        :param image: the frame
+        :return: shift - (y, x) shift of this frame, zero for the first
+        smoothed - (y, x) smoothed drift estimate at this frame
+        """
+        if self.refimage is None:
+            self._setreference(*self.strategy.start(image))
+            return np.zeros(2), np.zeros(2)
+        movingimage = self.strategy.blur(image)
+        with stage('register'):
+            shift = self.offset + (self.reference.register(movingimage) if self.reference is not None else
+                                   register(self.refimage, movingimage, self.engine))
+        # Same schedule as PCC: the reference is replaced after update + 1 frames
+        if self.counter > self.update and self.strategy.updates:
+            self._setreference(*self.strategy.advance(image, movingimage, shift))
+            self.counter = 0
+        self.counter += 1
+        self.drift_total.append(shift)
+        return shift, self.smoothed()
+
+    def _setreference(self, refimage, offset):
+        self.refimage = refimage
+        self.offset = offset
+        # Spectrum based engines cache the reference transform for every frame until the next update
+        self.reference = reference_engine(refimage, **self.engine)
+
+    def run(self, frames):
+        """
+        Generator over add for every frame coming out of frames, e.g. tiffstack.followstack
+        """
+        for image in frames:
+            yield self.add(image)
+
+    def smoothed(self):
+        """
+        Smoothed drift at the latest frame from the drift model fitted to the last window shifts
+        :return: (y, x)
+        """
+        recent = np.asarray(self.drift_total[-self.window:])
+        if len(recent) <= 3:
+            return recent[-1]
+        t = np.arange(len(recent))
+        return fitmodel(t, recent, self.model, self.smoothing)(t[-1])
+
+    def splines(self):
+        """
+        Fits the whole history like PCC does, for when the acquisition has finished
+        :return: drift_total, usx, usy as returned by PCC
+        """
+        usx, usy = fitdrift(self.drift_total, self.smoothing, self.model)
+        return self.drift_total, usx, usy
+
+
+def driftfield(tf, tiles=9, tilesize=256, reference=0, precision='float32', cancel=None):
+    """
+    Local drift across the field of view, the shift of every tile of every frame against a single
+    reference frame, e.g. to check whether the drift is a pure translation
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param tiles: number of automatically chosen tiles, or a list of (row, col) tile origins
+    :param tilesize: edge length of the tiles
+    :param reference: index of the reference frame
+    :param precision: float dtype frames are blurred into
+    :param cancel: threading.Event, raises jobs.Cancelled once it is set
+    :return: tiles - list of (row, col) tile origins
+    field - (nfiles, ntiles, 2) array of (y, x) tile shifts
+    """
+    engine = TiledReference(blur(tf.getimage(reference), dtype=precision), tiles, tilesize)
+    field = np.empty((tf.nfiles, len(engine.tiles), 2))
+    movingimage = np.empty((tf.width, tf.height), dtype=precision)
+    for index in range(tf.nfiles):
+        with stage('decode'):
+            image = tf.getimage(index)
+        with stage('blur'):
+            blur(image, out=movingimage)
+        with stage('register'):
+            field[index] = engine.field(movingimage)
+        checkpoint(cancel)
+    return engine.tiles, field
+
+
+def correctiontranslations(usx, usy, nfiles):
+    """
+    Translations that undo the fitted drift, in the (x, y) form used by translate and the writer.
+    The drift is fitted to the shifts of frames 1 onwards, frame 0 is the reference and stays in place.
+    :param usx: fitted drift for the first (y) component of the shifts returned by PCC
+    :param usy: fitted drift for the second (x) component
+    :param nfiles: number of frames in the stack
+    :return: (nfiles, 2) array
+    """
+    t = np.arange(nfiles - 1)
+    if getattr(usx, 'model', None) is not None and usx.model is getattr(usy, 'model', None):
+        # Both components of one drift model, evaluated together in a single pass
+        return np.vstack([[0, 0], usx.model(t)[:, ::-1] * -1])
+    return np.vstack([[0, 0], np.column_stack([usy(t) * -1, usx(t) * -1])])
+
+
+def segmentboundary(k, update):
+    """
+    Index of the frame after which the k-th reference update happens
+    :param k: which reference update
+    :param update: how often the reference frame should be updated
+    :return: frame index
+    """
+    return update + 2 + k * (update + 1)
+
+
+def referencechain(tf, update, engine=None, notify=None, strategy=None):
+    """
+    Builds every reference frame used while registering the stack
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param update: how often the reference frame should be updated
+    :param engine: registration options, see reference_engine
+    :param notify: called as notify(index, shift) after each registration
+    :param strategy: ReferenceStrategy, defaults to a rolling reference
+    :return: references - list of (blurred reference frame, offset) pairs, one per segment, where offset is
+    added to the shifts found against the reference
+    shifts - dict of frame index to shift for the boundary frames already registered
+    """
+    strategy = strategy or ReferenceStrategy()
+    refimage, offset = strategy.start(tf.getimage(0))
+    references = [(refimage, offset)]
+    shifts = {}
+    k = 0
+    while strategy.updates and segmentboundary(k, update) < tf.nfiles:
+        index = segmentboundary(k, update)
+        with stage('decode'):
+            image = tf.getimage(index)
+        movingimage = strategy.blur(image)
+        with stage('register'):
+            shift = offset + register(refimage, movingimage, engine)
+        shifts[index] = shift
+        if notify is not None:
+            notify(index, shift)
+        # As the image changes over time, move on to a reference built from this frame
+        refimage, offset = strategy.advance(image, movingimage, shift)
+        references.append((refimage, offset))
+        k += 1
+    return references, shifts
+
+
+def reference_engine(refimage, batch=None, pyramid=0, crop=512, tiles=0, tilesize=256, aggregate='consensus',
+                     taper=True, fftworkers=-1):
+    """
+    Picks the registration engine for a reference frame
+    :param refimage: blurred reference frame
+    :param batch: frames per batched FFT call, see PCC
+    :param pyramid: number of 2x downsampling levels, see PCC
+    :param crop: full resolution refinement window for the pyramid
+    :param tiles: number or list of tiles, see PCC
+    :param tilesize: edge length of the tiles
+    :param aggregate: how tile shifts are combined, see TiledReference
+    :param taper: taper full frames and cross correlate them, see PCC. Tiles and pyramid windows always are
+    :param fftworkers: FFT worker threads
+    :return: engine with a register(frames) method, or None to register one frame at a time with skimage
+    """
+    if tiles:
+        return TiledReference(refimage, tiles, tilesize, aggregate, workers=fftworkers)
+    if pyramid:
+        return PyramidReference(refimage, pyramid, crop, workers=fftworkers)
+    if batch:
+        return ReferenceSpectrum(refimage, workers=fftworkers, normalization=None if taper else 'phase', taper=taper)
+    return None
+
+
+def register(refimage, movingimage, engine=None):
+    """
+    Subpixel registration of movingimage against refimage
+    :param engine: registration options, see reference_engine
+    :return: (y, x) shift
+    """
+    reference = reference_engine(refimage, **_precision(engine)[0])
+    if reference is not None:
+        return reference.register(movingimage)
+    from skimage.registration import phase_cross_correlation
+    if engine is None or engine.get('taper', True):
+        shift, error, diffphase = phase_cross_correlation(_taper(refimage), _taper(movingimage), upsample_factor=100,
+                                                          normalization=None)
+    else:
+        shift, error, diffphase = phase_cross_correlation(refimage, movingimage, upsample_factor=100)
+    return shift
+
+
+def register_frames(tf, refimage, indices, engine=None, fftworkers=-1, notify=None):
+    """
+    Registers a range of frames against a single blurred reference
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param refimage: blurred reference frame
+    :param indices: frame indices to register
+    :param engine: registration options, see reference_engine
+    :param fftworkers: FFT worker threads for the batched engines
+    :param notify: called as notify(index, shift) after each registration
+    :return: dict of frame index to shift
+    """
+    shifts = {}
+    notify = notify or (lambda index, shift: None)
+    engine, dtype = _precision(engine)
+    # The reference spectrum is computed once here and reused for every frame in the range
+    reference = reference_engine(refimage, fftworkers=fftworkers, **engine)
+    if reference is not None:
+        batch = engine.get('batch') or 1
+        # Every chunk is blurred into the same buffer, the engines don't hold on to the frames
+        buffer = np.empty((min(batch, len(indices)),) + refimage.shape, dtype=dtype)
+        for start in range(0, len(indices), batch):
+            chunk = indices[start:start + batch]
+            with stage('decode'):
+                if chunk[-1] - chunk[0] == len(chunk) - 1:
+                    images = tf.getimages(chunk[0], chunk[-1] + 1)
+                else:
+                    images = [tf.getimage(index) for index in chunk]
+            with stage('blur'):
+                frames = buffer[:len(chunk)]
+                for image, frame in zip(images, frames):
+                    blur(image, out=frame)
+            with stage('register'):
+                found = reference.register(frames)
+            for index, shift in zip(chunk, found):
+                shifts[index] = shift
+                notify(index, shift)
+        return shifts
+    movingimage = np.empty(refimage.shape, dtype=dtype)
+    for index in indices:
+        with stage('decode'):
+            image = tf.getimage(index)
+        with stage('blur'):
+            blur(image, out=movingimage)
+        with stage('register'):
+            shifts[index] = register(refimage, movingimage, engine)
+        notify(index, shifts[index])
+    return shifts
+
+
+def _precision(engine):
+    """
+    Splits the precision off the registration options
+    :return: options for reference_engine, float dtype to blur frames into
+    """
+    engine = dict(engine or {})
+    return engine, np.dtype(engine.pop('precision', 'float32'))
+
+
+def _initworker(pathname, position=0, channel=0, plane=0):
+    # Every frame is read once, caching them would only cost memory in each worker
+    _worker.tf = tiffstack(pathname, cachesize=0, prefetch=0, position=position, channel=channel, plane=plane)
+
+
+def _register_task(refimage, indices, engine):
+    # Pool workers each keep their own file handle, a TiffFile can't be shared across threads or pickled.
+    # The pool already uses every core so the FFTs inside a task stay single threaded.
+    return register_frames(_worker.tf, refimage, indices, engine, fftworkers=1)
+
+
+def _register_parallel(tf, segments, workers, backend, engine=None, notify=None):
+    """
+    Registers (reference, offset, indices) segments on a pool
+    :return: dict of frame index to shift, offsets included
+    """
+    # Workers open the same frames as tf, the same position, channel and plane of the file
+    source = (tf.pathname, tf.position, tf.channel, tf.plane)
+    if backend == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_initworker, initargs=source)
+    elif backend == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers, initializer=_initworker, initargs=source)
+    else:
+        raise ValueError(f"backend must be 'thread' or 'process', not {backend!r}")
+    # Split long segments so that a stack with a large update interval still spreads over every worker
+    chunksize = max(1, int(np.ceil(sum(len(indices) for _, _, indices in segments) / (workers * 4))))
+    shifts = {}
+    with pool:
+        futures = {pool.submit(_register_task, reference, indices[i:i + chunksize], engine): offset
+                   for reference, offset, indices in segments for i in range(0, len(indices), chunksize)}
+        try:
+            for future in as_completed(futures):
+                for index, shift in future.result().items():
+                    shift = futures[future] + shift
+                    shifts[index] = shift
+                    if notify is not None:
+                        notify(index, shift)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return shifts
@@ -0,0 +1,324 @@
+import argparse
+import time
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.filters import gaussian
+from skimage.transform import AffineTransform, warp
+from registration import PyramidReference, TiledReference
+from translate import translate
+
+
+def synthetic_stack(nframes=20, size=512, noise=20, step=0.5, seed=0, dtype=np.uint16, evolve=0.0):
+    """
+    Builds a stack with known subpixel drift from a random texture
+    :param nframes: number of frames
+    :param size: frames are size x size
+    :param noise: standard deviation of the gaussian noise added to each frame
+    :param step: standard deviation of the per frame random walk step in pixels
+    :param seed: random seed
+    :param dtype: dtype of the frames
+    :param evolve: fraction of the texture replaced by a second one by the last frame, for samples that change
+    over the acquisition
+    :return: frames - (nframes, size, size) array
+    drift - (nframes, 2) array of the (y, x) displacement of each frame, the first frame is not displaced
+    """
+    frames, drift = synthetic_frames(nframes, size, noise, step, seed, dtype, evolve)
+    stack = np.empty((nframes, size, size), dtype=dtype)
+    for i, frame in enumerate(frames):
+        stack[i] = frame
+    return stack, drift
+
+
+def synthetic_frames(nframes=20, size=512, noise=20, step=0.5, seed=0, dtype=np.uint16, evolve=0.0):
+    """
+    Same frames as synthetic_stack, generated one at a time for stacks too big to hold in memory
+    :return: frames - generator of (size, size) frames
+    drift - (nframes, 2) array of the (y, x) displacement of each frame
+    """
+    rng = np.random.default_rng(seed)
+    drift = np.cumsum(rng.normal(0, step, (nframes, 2)), axis=0)
+    drift -= drift[0]
+    # Frames are cropped out of a larger canvas so their edges aren't periodic, as in real acquisitions
+    margin = int(np.ceil(np.abs(drift).max())) + 16
+    canvas = size + 2 * margin
+    spectrum = np.fft.fft2(sample_texture(rng, canvas))
+    change = None
+    if evolve:
+        change = np.fft.fft2(sample_texture(rng, canvas)) - spectrum
+
+    def generate():
+        for i, d in enumerate(drift):
+            current = spectrum + change * evolve * i / max(1, nframes - 1) if evolve else spectrum
+            frame = np.fft.ifft2(ndi.fourier_shift(current, d)).real[margin:margin + size, margin:margin + size]
+            frame += rng.normal(0, noise, (size, size))
+            if np.dtype(dtype).kind in 'ui':
+                frame = np.clip(frame, np.iinfo(dtype).min, np.iinfo(dtype).max)
+            yield frame.astype(dtype)
+
+    return generate(), drift
+
+
+def _normalise(image):
+    return (image - image.min()) / (image.max() - image.min())
+
+
+def sample_texture(rng, size, density=0.005):
+    """
+    Texture resembling a fluorescence image: a slowly varying background, fine structure a pixel or two
+    across and scattered diffraction limited spots, so there is content at every scale registration uses
+    rather than only the smooth blobs a single blurred noise field gives
+    :param rng: numpy Generator
+    :param size: texture is size x size
+    :param density: spots per pixel
+    :return: (size, size) float array between 200 and 3200
+    """
+    background = ndi.gaussian_filter(rng.random((size, size)), 8)
+    structure = ndi.gaussian_filter(rng.random((size, size)), 1)
+    count = int(size * size * density)
+    spots = np.zeros((size, size))
+    spots[rng.integers(0, size, count), rng.integers(0, size, count)] = rng.uniform(0.5, 1, count)
+    spots = ndi.gaussian_filter(spots, 1.2)
+    texture = 0.5 * _normalise(background) + 0.5 * _normalise(structure) + _normalise(spots)
+    return _normalise(texture) * 3000 + 200
+
+
+def _difference(image, expected):
+    return float(np.sqrt(np.mean((image - expected) ** 2)))
+
+
+def _rms(estimate, truth):
+    return float(np.sqrt(np.mean(np.sum((estimate - truth) ** 2, axis=1))))
+
+
+def bench_pyramid(size=2048, nframes=10, depth=2, crop=512):
+    """
+    Compares single scale registration, as PCC does it without a pyramid, with coarse-to-fine pyramid registration
+    :return: dict of mode to (seconds per frame, RMS error in pixels)
+    """
+    from PhaseCrossCorrelation import register
+    frames, drift = synthetic_stack(nframes, size, step=3)
+    refimage = gaussian(frames[0], sigma=2)
+    moving = [gaussian(frame, sigma=2) for frame in frames[1:]]
+    # Registering a frame against the first frame recovers minus its displacement
+    truth = -drift[1:]
+    results = {}
+
+    start = time.perf_counter()
+    shifts = np.array([register(refimage, image) for image in moving])
+    results['single scale'] = ((time.perf_counter() - start) / len(moving), _rms(shifts, truth))
+
+    start = time.perf_counter()
+    reference = PyramidReference(refimage, depth, crop)
+    shifts = np.array([reference.register(image) for image in moving])
+    results[f'pyramid depth {depth} crop {crop}'] = ((time.perf_counter() - start) / len(moving), _rms(shifts, truth))
+    return results
+
+
+def add_movers(frames, nmovers=4, size=96, speed=2.0, seed=1):
+    """
+    Pastes bright textured objects that wander independently of the drift, like cells in DIC data
+    :param frames: stack from synthetic_stack, modified in place
+    :param nmovers: number of moving objects
+    :param size: edge length of each object
+    :param speed: pixels each object moves per frame
+    :return: frames
+    """
+    rng = np.random.default_rng(seed)
+    texture = ndi.gaussian_filter(rng.random((nmovers, size, size)), (0, 2, 2))
+    texture = (texture - texture.min()) / (texture.max() - texture.min()) * 6000 + 2000
+    start = rng.uniform(size, frames.shape[1] - 2 * size, (nmovers, 2))
+    direction = rng.normal(size=(nmovers, 2))
+    direction /= np.linalg.norm(direction, axis=1)[:, np.newaxis]
+    for i, frame in enumerate(frames):
+        for mover, position in zip(texture, start + direction * speed * i):
+            row, col = np.clip(position.astype(int), 0, np.array(frame.shape) - size)
+            frame[row:row + size, col:col + size] = mover
+    return frames
+
+
+def bench_tiles(size=1024, nframes=10, tiles=9, tilesize=256, movers=4):
+    """
+    Compares full frame registration, as PCC does it without tiles, with tiled registration on a stack with
+    objects moving independently of the drift
+    :return: dict of mode to (seconds per frame, RMS error in pixels)
+    """
+    from PhaseCrossCorrelation import register
+    frames, drift = synthetic_stack(nframes, size, step=1)
+    add_movers(frames, movers)
+    refimage = gaussian(frames[0], sigma=2)
+    moving = [gaussian(frame, sigma=2) for frame in frames[1:]]
+    truth = -drift[1:]
+    results = {}
+
+    start = time.perf_counter()
+    shifts = np.array([register(refimage, image) for image in moving])
+    results['full frame'] = ((time.perf_counter() - start) / len(moving), _rms(shifts, truth))
+
+    for aggregate in ('median', 'consensus'):
+        start = time.perf_counter()
+        reference = TiledReference(refimage, tiles, tilesize, aggregate)
+        shifts = np.array([reference.register(image) for image in moving])
+        results[f'{tiles} tiles of {tilesize} {aggregate}'] = ((time.perf_counter() - start) / len(moving),
+                                                                _rms(shifts, truth))
+    return results
+
+
+def bench_references(size=256, nframes=500, update=10, evolve=0.9, pyramid=1):
+    """
+    Compares the reference strategies of PCC on a stack whose content slowly changes into something else
+    :return: dict of strategy to (seconds per frame, RMS error in pixels)
+    """
+    # Imported here so the other benchmarks don't need the tiff stack machinery
+    import os
+    import tempfile
+    import tifffile
+    from PhaseCrossCorrelation import PCC
+    from references import STRATEGIES
+    from tiffstack import tiffstack
+
+    frames, drift = synthetic_stack(nframes, size, step=0.3, evolve=evolve)
+    truth = -drift[1:]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'synthetic.tif')
+        tifffile.imwrite(pathname, frames)
+        tf = tiffstack(pathname, cachesize=0, prefetch=0)
+        for strategy in STRATEGIES:
+            start = time.perf_counter()
+            drift_total, usx, usy = PCC(tf, update, strategy=strategy, pyramid=pyramid, crop=size // 2,
+                                        verbose=False)
+            results[strategy] = ((time.perf_counter() - start) / nframes, _rms(np.array(drift_total), truth))
+        tf.close()
+    return results
+
+
+def bench_precision(size=2048, nframes=32, batch=8):
+    """
+    Registers and exports the same stack in float64 and float32
+    :return: dict of stage and precision to (seconds per frame, peak traced memory in MB)
+    """
+    import os
+    import tempfile
+    import tracemalloc
+    import tifffile
+    from PhaseCrossCorrelation import PCC, correctiontranslations
+    from tiffstack import tiffstack
+    from writer import savedriftcorrected
+
+    frames, drift = synthetic_stack(nframes, size, step=1)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        pathname = os.path.join(directory, 'synthetic.tif')
+        tifffile.imwrite(pathname, frames)
+        del frames
+        tf = tiffstack(pathname, cachesize=0, prefetch=0)
+        translations = correctiontranslations(lambda t: -drift[1:, 0], lambda t: -drift[1:, 1], nframes)
+        for precision in ('float64', 'float32'):
+            stages = {
+                'register': lambda: PCC(tf, batch=batch, precision=precision),
+                'export': lambda: savedriftcorrected(tf, os.path.join(directory, 'DC.tif'), translations,
+                                                     batch=batch, precision=precision),
+            }
+            for name, run in stages.items():
+                start = time.perf_counter()
+                run()
+                seconds = (time.perf_counter() - start) / nframes
+                # Memory from a second run, tracing allocations slows everything down
+                tracemalloc.start()
+                run()
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+                results[f'{name} {precision}'] = (seconds, peak)
+        tf.close()
+    return results
+
+
+def bench_shift(size=2048, nframes=16):
+    """
+    Compares skimage's general affine warp with the translation kernels for moving frames by a subpixel shift
+    :return: dict of mode to (seconds per frame, RMS difference to warp)
+    """
+    frames, drift = synthetic_stack(nframes, size, step=3)
+    translations = drift[:, ::-1]
+    results = {}
+
+    start = time.perf_counter()
+    expected = np.stack([warp(frame, AffineTransform(translation=translation), preserve_range=True)
+                         for frame, translation in zip(frames, translations)])
+    results['warp'] = ((time.perf_counter() - start) / nframes, 0.0)
+
+    start = time.perf_counter()
+    shifted = np.stack([translate(frame, translation) for frame, translation in zip(frames, translations)])
+    results['translate per frame'] = ((time.perf_counter() - start) / nframes, _difference(shifted, expected))
+
+    buffer = np.empty(frames.shape, dtype=np.float32)
+    start = time.perf_counter()
+    translate(frames, translations, out=buffer)
+    results['translate block into buffer'] = ((time.perf_counter() - start) / nframes,
+                                              _difference(buffer, expected))
+
+    start = time.perf_counter()
+    shifted = translate(frames, translations, method='fourier')
+    # Fourier shifts wrap around, only compare away from the edges
+    margin = int(np.ceil(np.abs(translations).max())) + 2
+    inner = (slice(None), slice(margin, -margin), slice(margin, -margin))
+    results['translate block fourier'] = ((time.perf_counter() - start) / nframes,
+                                          _difference(shifted[inner], expected[inner]))
+    return results
+
+
+def report(title, results, unit='RMS error', scale='px'):
+    print(title)
+    for mode, (seconds, error) in results.items():
+        print(f'  {mode:<32} {seconds * 1000:10.1f} ms/frame   {unit} {error:.3f} {scale}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed and accuracy benchmarks on synthetic drifting stacks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    pyramid = subparsers.add_parser('pyramid', help='pyramid vs single scale registration')
+    pyramid.add_argument('--size', type=int, default=2048)
+    pyramid.add_argument('--frames', type=int, default=10)
+    pyramid.add_argument('--depth', type=int, default=2)
+    pyramid.add_argument('--crop', type=int, default=512)
+    tiles = subparsers.add_parser('tiles', help='tiled vs full frame registration with moving objects')
+    tiles.add_argument('--size', type=int, default=1024)
+    tiles.add_argument('--frames', type=int, default=10)
+    tiles.add_argument('--tiles', type=int, default=9)
+    tiles.add_argument('--tile-size', dest='tilesize', type=int, default=256)
+    tiles.add_argument('--movers', type=int, default=4)
+    references = subparsers.add_parser('references', help='fixed, rolling and averaged reference frames')
+    references.add_argument('--size', type=int, default=256)
+    references.add_argument('--frames', type=int, default=500)
+    references.add_argument('--update', type=int, default=10)
+    references.add_argument('--evolve', type=float, default=0.9)
+    references.add_argument('--pyramid', type=int, default=1)
+    precision = subparsers.add_parser('precision', help='float32 vs float64 registration and export')
+    precision.add_argument('--size', type=int, default=2048)
+    precision.add_argument('--frames', type=int, default=32)
+    precision.add_argument('--batch', type=int, default=8)
+    shift = subparsers.add_parser('shift', help='translation kernels vs affine warp')
+    shift.add_argument('--size', type=int, default=2048)
+    shift.add_argument('--frames', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.benchmark == 'pyramid':
+        report(f'Registration of {args.size}x{args.size} frames',
+               bench_pyramid(args.size, args.frames, args.depth, args.crop))
+    elif args.benchmark == 'tiles':
+        report(f'Registration of {args.size}x{args.size} frames with {args.movers} moving objects',
+               bench_tiles(args.size, args.frames, args.tiles, args.tilesize, args.movers))
+    elif args.benchmark == 'references':
+        report(f'Reference strategies over {args.frames} {args.size}x{args.size} frames, {args.evolve:.0%} of '
+               f'the content changing', bench_references(args.size, args.frames, args.update, args.evolve,
+                                                        args.pyramid))
+    elif args.benchmark == 'precision':
+        report(f'Batched registration and export of {args.frames} {args.size}x{args.size} frames',
+               bench_precision(args.size, args.frames, args.batch), unit='peak traced', scale='MB')
+    elif args.benchmark == 'shift':
+        report(f'Shifting {args.size}x{args.size} frames', bench_shift(args.size, args.frames),
+               unit='RMS difference to warp', scale='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Benchmark suite for the whole pipeline on synthetic stacks with known drift
+
+    python benchsuite.py --preset quick --output results.jsonl
+    python benchsuite.py --preset quick --compare results.jsonl
+    python benchsuite.py --imports
+
+Every case runs in a fresh process so its peak memory is its own. Results are written as one JSON record per
+case, tagged with the git commit, so runs on different commits can be compared with --compare, which exits
+non-zero when a stage got slower than the tolerance allows. --imports times a cold import of each library entry
+point instead and exits non-zero when one is over its budget.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# (size, frames) cases, the full preset spans 256x256 to 4096x4096 and 100 to 10000 frames
+PRESETS = {
+    'quick': [(256, 100), (512, 100)],
+    'standard': [(256, 1000), (1024, 200), (2048, 100)],
+    'full': [(256, 10000), (1024, 1000), (4096, 100)],
+}
+
+STAGES = ('decode', 'blur', 'register', 'spline', 'warp', 'write')
+
+# Seconds a cold import of each library entry point may take. scipy and skimage are only imported once a
+# feature needs them, so importing a module stays cheap even on slow network mounted environments.
+IMPORT_BUDGET = {
+    'tiffstack': 0.4,
+    'PhaseCrossCorrelation': 0.4,
+    'driftcache': 0.4,
+    'driftmodel': 0.3,
+    'writer': 0.3,
+    'chunkstore': 0.3,
+    'main': 0.4,
+}
+
+
+def commit():
+    """ Current git commit of the tree being benchmarked, None outside a checkout """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peakrss():
+    """ Peak resident memory of this process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def importtime(module, repeats=5):
+    """
+    Time to import a module in a fresh interpreter, the fastest of several runs so a busy machine or a cold
+    file cache doesn't count against it
+    :param module: module name
+    :param repeats: number of fresh interpreters
+    :return: seconds
+    """
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    times = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(float(result.stdout.split()[-1]))
+    return min(times)
+
+
+def checkimports(budget=None, repeats=5):
+    """
+    Times a cold import of every entry point against its budget
+    :param budget: dict of module to seconds, IMPORT_BUDGET by default
+    :return: list of descriptions of modules over budget, empty when there are none
+    """
+    budget = budget or IMPORT_BUDGET
+    over = []
+    for module, limit in budget.items():
+        seconds = importtime(module, repeats)
+        print(f'import {module:<22} {seconds:6.3f} s  (budget {limit:.2f} s)')
+        if seconds > limit:
+            over.append(f'import {module} took {seconds:.3f} s, budget {limit:.2f} s')
+    return over
+
+
+def _chunks(nfiles, chunk):
+    return [(start, min(start + chunk, nfiles)) for start in range(0, nfiles, chunk)]
+
+
+def runcase(size, nframes, update=10, chunk=16, directory=None, options=None):
+    """
+    Times every stage of the pipeline on one synthetic stack. Decode, blur and warp are timed on their own
+    over the whole stack, blur as PCC does it, into a reused buffer of the configured precision. Register is the
+    time PCC spends registering frames, as recorded by its own stage timers, write is the complete export.
+    :param size: frames are size x size
+    :param nframes: number of frames
+    :param update: how often the reference frame is updated
+    :param chunk: frames per read in the decode, blur and warp passes
+    :param directory: where the stack is written, a temporary directory by default
+    :param options: passed on to PCC, e.g. batch, pyramid or precision
+    :return: dict record of the case
+    """
+    # Heavy imports inside the case so each spawned process pays for them itself, including the ones the
+    # pipeline defers to first use so they aren't timed as part of a stage
+    import scipy.fft
+    import scipy.interpolate
+    import tifffile
+    import instrument
+    from benchmark import synthetic_frames
+    from PhaseCrossCorrelation import PCC, correctiontranslations, fitdrift
+    from registration import blur
+    from tiffstack import tiffstack
+    from translate import translate
+    from writer import savedriftcorrected
+
+    options = options or {}
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        pathname = os.path.join(workdir, 'synthetic.tif')
+        frames, drift = synthetic_frames(nframes, size, step=0.3)
+        tifffile.imwrite(pathname, frames, shape=(nframes, size, size), dtype=np.uint16)
+        tf = tiffstack(pathname, cachesize=0, prefetch=0)
+        seconds = {}
+
+        start = time.perf_counter()
+        for first, last in _chunks(nframes, chunk):
+            np.array(tf.getimages(first, last))
+        seconds['decode'] = time.perf_counter() - start
+
+        seconds['blur'] = 0.0
+        seconds['warp'] = 0.0
+        translations = np.column_stack([-drift[:, 1], -drift[:, 0]])
+        buffer = np.empty((size, size), dtype=options.get('precision', 'float32'))
+        # The first blur imports scipy.ndimage, which isn't part of the stage
+        blur(tf.getimage(0), out=buffer)
+        for first, last in _chunks(nframes, chunk):
+            images = np.array(tf.getimages(first, last))
+            start = time.perf_counter()
+            for image in images:
+                blur(image, out=buffer)
+            seconds['blur'] += time.perf_counter() - start
+            start = time.perf_counter()
+            translate(images, translations[first:last])
+            seconds['warp'] += time.perf_counter() - start
+
+        # PCC's own stage timers give its registration time, the whole breakdown is kept alongside, summed over
+        # threads when it runs in parallel
+        instrument.reset()
+        instrument.enable()
+        drift_total, usx, usy = PCC(tf, update, verbose=False, **options)
+        instrument.disable()
+        pccstages = {name: timer['seconds'] for name, timer in instrument.summary()['stages'].items()}
+        seconds['register'] = pccstages.get('register', 0.0)
+
+        start = time.perf_counter()
+        usx, usy = fitdrift(drift_total)
+        seconds['spline'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        savedriftcorrected(tf, os.path.join(workdir, 'corrected.tif'), correctiontranslations(usx, usy, nframes))
+        seconds['write'] = time.perf_counter() - start
+        tf.close()
+
+    error = np.sqrt(np.mean(np.sum((np.array(drift_total) + drift[1:]) ** 2, axis=1)))
+    return dict(commit=commit(), time=time.strftime('%Y-%m-%dT%H:%M:%S'), size=size, frames=nframes,
+                update=update, options=options, seconds=seconds, pcc_stages=pccstages,
+                fps={stage: nframes / seconds[stage] if seconds[stage] else None for stage in STAGES},
+                total_fps=nframes / sum(seconds.values()), peak_rss_mb=peakrss(), rms_error_px=float(error),
+                machine=platform.machine(), python=platform.python_version(), numpy=np.__version__,
+                cpus=os.cpu_count())
+
+
+def runsuite(cases, update=10, directory=None, options=None):
+    """
+    Runs every (size, frames) case in its own freshly spawned process
+    :return: list of records
+    """
+    records = []
+    for size, nframes in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            records.append(pool.submit(runcase, size, nframes, update, directory=directory,
+                                       options=options).result())
+        report(records[-1])
+    return records
+
+
+def report(record):
+    stages = '  '.join(f"{stage} {record['fps'][stage]:.0f}" if record['fps'][stage] else f'{stage} -'
+                       for stage in STAGES)
+    print(f"{record['size']}x{record['size']} x {record['frames']}: {record['total_fps']:.1f} frames/s overall, "
+          f"{record['peak_rss_mb']:.0f} MB peak, RMS error {record['rms_error_px']:.3f} px\n"
+          f"  frames/s per stage: {stages}", flush=True)
+
+
+def compare(records, baseline, tolerance=0.2, floor=0.05, accuracy=0.01):
+    """
+    Checks records against a baseline run of the same cases
+    :param records: records of this run
+    :param baseline: records of an earlier run, e.g. on the parent commit
+    :param tolerance: fraction a stage may slow down by before it counts as a regression
+    :param floor: seconds below which a stage is too short to time reliably and isn't judged
+    :param accuracy: pixels the RMS error may grow by before it counts as a regression
+    :return: list of regression descriptions, empty when there are none
+    """
+    earlier = {(record['size'], record['frames']): record for record in baseline}
+    regressions = []
+    for record in records:
+        before = earlier.get((record['size'], record['frames']))
+        if before is None:
+            continue
+        for stage in STAGES:
+            new, old = record['seconds'][stage], before['seconds'][stage]
+            ratio = new / old if old else 1.0
+            print(f"{record['size']}x{record['size']} x {record['frames']} {stage:<9} {ratio:6.2f}x time "
+                  f"({before['commit']} -> {record['commit']})")
+            if ratio > 1 + tolerance and max(new, old) >= floor:
+                regressions.append(f"{record['size']}x{record['size']} x {record['frames']} {stage} "
+                                   f"{ratio:.2f}x slower")
+        if record['rms_error_px'] > before['rms_error_px'] + accuracy:
+            regressions.append(f"{record['size']}x{record['size']} x {record['frames']} RMS error "
+                               f"{before['rms_error_px']:.3f} -> {record['rms_error_px']:.3f} px")
+    return regressions
+
+
+def readrecords(filename):
+    with open(filename) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per stage speed, memory and accuracy of the drift correction '
+                                                 'pipeline on synthetic stacks')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--case', nargs=2, type=int, action='append', metavar=('SIZE', 'FRAMES'),
+                        help='run this case instead of the preset, can be repeated')
+    parser.add_argument('--update', type=int, default=10, help='how often the reference frame is updated')
+    parser.add_argument('--batch', type=int, help='frames per batched FFT registration')
+    parser.add_argument('--pyramid', type=int, default=0, help='levels of coarse-to-fine registration')
+    parser.add_argument('--precision', choices=['float32', 'float64'],
+                        help='float type frames are blurred and registered in, float32 by default')
+    parser.add_argument('--tmpdir', help='where the synthetic stacks are written')
+    parser.add_argument('--output', help='append the records to this JSON lines file')
+    parser.add_argument('--compare', help='JSON lines file of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown allowed before a regression')
+    parser.add_argument('--imports', action='store_true',
+                        help='check the import time of the library entry points against their budget instead')
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        over = checkimports()
+        for description in over:
+            print(f'REGRESSION {description}')
+        return 1 if over else 0
+
+    options = {name: value for name, value in dict(batch=args.batch, pyramid=args.pyramid,
+                                                     precision=args.precision).items() if value}
+    records = runsuite(args.case or PRESETS[args.preset], args.update, args.tmpdir, options)
+    if args.output:
+        with open(args.output, 'a') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+    if args.compare:
+        regressions = compare(records, readrecords(args.compare), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
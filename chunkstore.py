@@ -0,0 +1,272 @@
+"""
+Chunked, compressed, multi-resolution copy of a stack in a local directory
+
+    python chunkstore.py stack.tif stack.zarr
+
+The layout follows OME-Zarr (NGFF 0.4): a group holding one zarr v2 array per resolution level, "0" at full
+resolution and each further level downsampled 2x in y and x. Chunks are zlib compressed raw arrays, written and
+read with numpy and zlib only, so the store opens in tiffstack without extra dependencies and in any zarr reader.
+"""
+import argparse
+import json
+import os
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from jobs import checkpoint
+
+_pool = None
+
+
+def _threads():
+    # zlib releases the GIL, chunks of a frame are (de)compressed in parallel
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    return _pool
+
+
+def isstore(pathname):
+    """ Whether pathname is a directory written by this module """
+    return isinstance(pathname, str) and os.path.isfile(os.path.join(pathname, '.zattrs'))
+
+
+class ChunkedArray:
+
+    """
+    A single zarr v2 array of shape (t, y, x) on disk
+    :param path: directory holding .zarray and the chunk files
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, '.zarray')) as file:
+            meta = json.load(file)
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.fill = meta['fill_value'] or 0
+        self.separator = meta.get('dimension_separator', '.')
+        self.compressed = meta['compressor'] is not None
+
+    @classmethod
+    def create(cls, path, shape, chunks, dtype, level=1):
+        os.makedirs(path, exist_ok=True)
+        meta = dict(zarr_format=2, shape=list(shape), chunks=list(chunks), dtype=np.dtype(dtype).str,
+                    compressor=dict(id='zlib', level=level) if level else None, fill_value=0, order='C',
+                    filters=None, dimension_separator='/')
+        with open(os.path.join(path, '.zarray'), 'w') as file:
+            json.dump(meta, file, indent=1)
+        array = cls(path)
+        array.level = level
+        return array
+
+    def _filename(self, key):
+        return os.path.join(self.path, self.separator.join(str(k) for k in key))
+
+    def _grid(self, axis, start, stop):
+        return range(start // self.chunks[axis], -(-stop // self.chunks[axis]))
+
+    def readchunk(self, key):
+        try:
+            with open(self._filename(key), 'rb') as file:
+                raw = file.read()
+        except FileNotFoundError:
+            return np.full(self.chunks, self.fill, dtype=self.dtype)
+        if self.compressed:
+            raw = zlib.decompress(raw)
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.chunks)
+
+    def writechunk(self, key, data):
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        raw = np.ascontiguousarray(data, dtype=self.dtype).tobytes()
+        with open(filename, 'wb') as file:
+            file.write(zlib.compress(raw, getattr(self, 'level', 1)) if self.compressed else raw)
+
+    def read(self, start, stop):
+        """
+        Frames start to stop at full extent
+        :return: (n, y, x) array
+        """
+        stop = min(stop, self.shape[0])
+        out = np.empty((max(0, stop - start),) + self.shape[1:], dtype=self.dtype)
+        keys = [(t, y, x) for t in self._grid(0, start, stop) for y in self._grid(1, 0, self.shape[1])
+                for x in self._grid(2, 0, self.shape[2])]
+
+        def copy(key):
+            chunk = self.readchunk(key)
+            origin = [k * c for k, c in zip(key, self.chunks)]
+            t0, t1 = max(start, origin[0]), min(stop, origin[0] + self.chunks[0])
+            y1, x1 = min(self.shape[1], origin[1] + self.chunks[1]), min(self.shape[2], origin[2] + self.chunks[2])
+            out[t0 - start:t1 - start, origin[1]:y1, origin[2]:x1] = \
+                chunk[t0 - origin[0]:t1 - origin[0], :y1 - origin[1], :x1 - origin[2]]
+
+        list(_threads().map(copy, keys))
+        return out
+
+    def write(self, start, block):
+        """
+        Writes frames starting at start, which must be the first frame of a chunk. Edge chunks are padded to
+        the full chunk size as zarr expects.
+        :param block: (n, y, x) array
+        """
+        if start % self.chunks[0]:
+            raise ValueError(f'writes must start on a chunk boundary, {start} is not a multiple of {self.chunks[0]}')
+        keys = [(t, y, x) for t in self._grid(0, start, start + len(block)) for y in self._grid(1, 0, self.shape[1])
+                for x in self._grid(2, 0, self.shape[2])]
+
+        def store(key):
+            origin = [k * c for k, c in zip(key, self.chunks)]
+            part = block[origin[0] - start:origin[0] - start + self.chunks[0],
+                         origin[1]:origin[1] + self.chunks[1], origin[2]:origin[2] + self.chunks[2]]
+            if part.shape != self.chunks:
+                padded = np.full(self.chunks, self.fill, dtype=self.dtype)
+                padded[:part.shape[0], :part.shape[1], :part.shape[2]] = part
+                part = padded
+            self.writechunk(key, part)
+
+        list(_threads().map(store, keys))
+
+
+class MultiscaleStore:
+
+    """
+    OME-Zarr style group of resolution levels, levels[0] is full resolution and levels[k] is downsampled 2 ** k
+    :param path: directory of the store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, '.zattrs')) as file:
+            multiscales = json.load(file)['multiscales'][0]
+        self.levels = [ChunkedArray(os.path.join(path, dataset['path'])) for dataset in multiscales['datasets']]
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    @property
+    def dtype(self):
+        return self.levels[0].dtype
+
+    def level(self, index, level=0):
+        """ Frame index at a resolution level, clamped to the coarsest available """
+        return self.levels[min(level, len(self.levels) - 1)].read(index, index + 1)[0]
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunks=(1, 512, 512), levels=None, compression=1, name=None):
+        """
+        Creates an empty store
+        :param shape: (t, y, x) of the full resolution stack
+        :param chunks: (t, y, x) chunk shape, the same at every level
+        :param levels: number of resolution levels, None adds levels until the frame fits in one chunk
+        :param compression: zlib level, 0 stores chunks uncompressed
+        """
+        if levels is None:
+            levels = 1
+            while max(shape[1], shape[2]) // 2 ** (levels - 1) > max(chunks[1:]):
+                levels += 1
+        os.makedirs(path, exist_ok=True)
+        datasets = []
+        for k in range(levels):
+            factor = 2 ** k
+            levelshape = (shape[0], shape[1] // factor, shape[2] // factor)
+            ChunkedArray.create(os.path.join(path, str(k)), levelshape,
+                                (chunks[0], min(chunks[1], levelshape[1]), min(chunks[2], levelshape[2])), dtype,
+                                compression)
+            datasets.append(dict(path=str(k), coordinateTransformations=[
+                dict(type='scale', scale=[1.0, float(factor), float(factor)])]))
+        axes = [dict(name='t', type='time'), dict(name='y', type='space'), dict(name='x', type='space')]
+        with open(os.path.join(path, '.zgroup'), 'w') as file:
+            json.dump(dict(zarr_format=2), file)
+        with open(os.path.join(path, '.zattrs'), 'w') as file:
+            json.dump(dict(multiscales=[dict(version='0.4', name=name or os.path.basename(path), axes=axes,
+                                             datasets=datasets)]), file, indent=1)
+        store = cls(path)
+        for array in store.levels:
+            array.level = compression
+        return store
+
+    def writeblock(self, start, block):
+        """ Writes a block of full resolution frames and every level downsampled from it """
+        from registration import downsample
+        for k, array in enumerate(self.levels):
+            if k:
+                # Each level from the one before, trailing odd rows and columns are dropped
+                block = downsample(block, 2)
+                if array.dtype.kind in 'ui':
+                    block = np.rint(block)
+                block = block.astype(array.dtype)[:, :array.shape[1], :array.shape[2]]
+            array.write(start, block)
+
+
+def convert(tf, path, chunks=(1, 512, 512), levels=None, compression=1, translations=None, method='linear',
+            workers=None, progress=None, cancel=None):
+    """
+    Writes a stack into a multi-resolution store. Blocks of frames are independent, so they are read,
+    optionally drift corrected, downsampled and compressed in parallel. A store holds a single channel and plane,
+    multi-channel and z-stacks are refused rather than written with all but one missing.
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param path: directory of the store
+    :param chunks: (t, y, x) chunk shape
+    :param levels: number of resolution levels, None picks enough to fit a frame in one chunk
+    :param compression: zlib level
+    :param translations: (nfiles, 2) array of (x, y) translations to write a drift corrected store
+    :param method: interpolation used with translations, see translate.translate
+    :param workers: number of blocks processed at the same time
+    :param progress: called as progress(frames written so far)
+    :param cancel: threading.Event, raises jobs.Cancelled once it is set and removes the partial store
+    :return: MultiscaleStore
+    """
+    from translate import translate
+    from writer import tosource
+    nchannels, nplanes = getattr(tf, 'nchannels', 1), getattr(tf, 'nplanes', 1)
+    if nchannels * nplanes > 1:
+        raise ValueError(f'a store holds a single channel and plane, this stack has {nchannels} channels and '
+                         f'{nplanes} planes')
+    store = MultiscaleStore.create(path, (tf.nfiles, tf.width, tf.height), tf.dtype, chunks, levels, compression)
+    block = chunks[0] * max(1, 16 // chunks[0])
+
+    def work(start):
+        checkpoint(cancel)
+        frames = tf.getimages(start, start + block)
+        if translations is not None:
+            frames = tosource(translate(frames, translations[start:start + len(frames)], method), tf.dtype)
+        store.writeblock(start, np.asarray(frames))
+        return len(frames)
+
+    written = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1)) as pool:
+            for n in pool.map(work, range(0, tf.nfiles, block)):
+                written += n
+                if progress is not None:
+                    progress(written)
+    except BaseException:
+        # Half written stores would still open, with zeros for the missing frames
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    return store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a tiff stack into a chunked multi-resolution store')
+    parser.add_argument('input', help='tiff stack, image sequence directory or glob pattern')
+    parser.add_argument('output', nargs='?', help='store directory, defaults to the input name ending in .zarr')
+    parser.add_argument('--chunk', type=int, default=512, help='chunk edge length in pixels')
+    parser.add_argument('--levels', type=int, help='number of resolution levels')
+    parser.add_argument('--compression', type=int, default=1, help='zlib level, 0 for none')
+    args = parser.parse_args(argv)
+
+    from tiffstack import tiffstack
+    tf = tiffstack(args.input, cachesize=0, prefetch=0)
+    output = args.output or os.path.splitext(args.input.rstrip(os.sep))[0] + '.zarr'
+    store = convert(tf, output, (1, args.chunk, args.chunk), args.levels, args.compression)
+    print(f'{output}: {tf.nfiles} frames, {len(store.levels)} levels')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
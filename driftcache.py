@@ -0,0 +1,131 @@
+import hashlib
+import os
+import numpy as np
+from PhaseCrossCorrelation import PCC, fitdrift
+
+# PCC options that change the shifts found, the rest only change how the work is spread
+ENGINE = ('batch', 'pyramid', 'crop', 'tiles', 'tilesize', 'aggregate', 'strategy', 'weight', 'precision', 'taper')
+
+# Part of every key, raised when stored shifts can't be trusted any more. 2: parallel runs on a position or
+# channel other than the first registered the first one's frames
+VERSION = 2
+
+
+def defaultdirectory():
+    """ Per user cache directory, $XDG_CACHE_HOME/driftCorrection or ~/.cache/driftCorrection """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'driftCorrection')
+
+
+def fingerprint(tf, samples=8):
+    """
+    Identifies a stack by its content rather than its name, so renamed or copied files still hit the cache.
+    Hashes the shape, dtype and a handful of evenly spaced frames including the first and last.
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param samples: number of frames hashed
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((tf.nfiles, tf.width, tf.height, str(tf.dtype))).encode())
+    for index in np.unique(np.linspace(0, tf.nfiles - 1, min(samples, tf.nfiles)).astype(int)):
+        digest.update(np.ascontiguousarray(tf.getimage(index)).tobytes())
+    return digest.hexdigest()
+
+
+class DriftCache:
+
+    """
+    On-disk store of PCC results keyed by stack content and the registration parameters that change the
+    shifts. Only the raw shifts are stored, the drift model is refitted on load so a cached result can be reused
+    with any smoothing or model. The least recently used entries are dropped once the store grows beyond its size limit.
+    :param directory: where entries are kept, defaults to the per user cache directory
+    :param size: size limit in MB
+    """
+
+    def __init__(self, directory=None, size=256):
+        self.directory = directory or defaultdirectory()
+        self.size = size * 2 ** 20
+
+    def key(self, tf, update=10, batch=None, pyramid=0, crop=512, tiles=0, tilesize=256, aggregate='consensus',
+            strategy='rolling', weight=0.3, precision='float32', taper=True):
+        tiles = [tuple(tile) for tile in tiles] if isinstance(tiles, (list, tuple)) else tiles
+        params = repr((VERSION, update, batch, pyramid, crop if pyramid else None,
+                       (tiles, tilesize, aggregate) if tiles else None,
+                       strategy, weight if strategy == 'average' else None, str(precision),
+                       taper if not (tiles or pyramid) else None))
+        return hashlib.blake2b((fingerprint(tf) + params).encode(), digest_size=16).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """
+        :return: drift_total as a list of (y, x) shifts, or None on a miss
+        """
+        filename = self.filename(key)
+        try:
+            with np.load(filename) as data:
+                drift_total = list(data['drift_total'])
+        except (OSError, KeyError, ValueError):
+            return None
+        # Access time is what eviction goes by, and can't be relied on from the filesystem
+        os.utime(filename)
+        return drift_total
+
+    def save(self, key, drift_total):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.filename(key)
+        # Written under a temporary name so a concurrent reader never sees half an entry
+        temporary = filename + '.tmp.npz'
+        np.savez(temporary, drift_total=np.asarray(drift_total, dtype=float).reshape(-1, 2))
+        os.replace(temporary, filename)
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the store fits its size limit """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                info = os.stat(os.path.join(self.directory, name))
+                entries.append((info.st_mtime, info.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+def cachedPCC(tf, update=10, smoothing=None, cache=None, model='spline', **options):
+    """
+    PCC that reuses the shifts of an earlier run on the same stack with the same registration parameters.
+    Changing only the smoothing or the drift model refits it without registering anything.
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param cache: DriftCache, None uses the default store
+    :param model: drift model fitted to the shifts, see PCC
+    :param options: passed on to PCC, e.g. pyramid, workers, progress, cancel
+    :return: drift_total, usx, usy as returned by PCC
+    """
+    cache = cache or DriftCache()
+    engine = {name: options[name] for name in ENGINE if name in options}
+    key = cache.key(tf, update, **engine)
+    drift_total = cache.load(key)
+    if drift_total is None:
+        drift_total, usx, usy = PCC(tf, update, smoothing, model=model, **options)
+        try:
+            cache.save(key, drift_total)
+        except OSError:
+            # Read only cache location, the result is still returned
+            pass
+        return drift_total, usx, usy
+    usx, usy = fitdrift(drift_total, smoothing, model)
+    return drift_total, usx, usy
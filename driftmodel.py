@@ -0,0 +1,195 @@
+"""
+Smooth models of the drift over time, fitted to the x and y shifts together
+
+    model = fitmodel(np.arange(len(shifts)), shifts)
+    smoothed = model(np.arange(nfiles))
+
+'spline' - cubic penalised B-spline, the penalty on the second differences of its coefficients sets how smooth
+'polynomial' - Chebyshev polynomial, the degree sets how smooth
+'robust' - the spline refitted with frames whose (x, y) residual is far from the rest weighted down to nothing,
+so a handful of failed registrations don't drag the whole curve
+
+Unless a smoothing is given it is chosen by cross-validation: generalised cross-validation over a grid of
+penalties for the splines and leave-one-out over degrees for the polynomial, both computed in closed form
+for every candidate at once rather than by refitting.
+"""
+import numpy as np
+
+MODELS = ('spline', 'polynomial', 'robust')
+
+# Candidate spline penalties, the penalty acts on coefficient differences so its scale doesn't depend on the
+# number of frames
+PENALTIES = np.logspace(-4, 8, 61)
+
+
+class DriftModel:
+
+    """
+    Fitted drift, evaluated for any frames at once as an (n, 2) array
+    :param model: one of MODELS
+    :param smoothing: penalty of the spline or degree of the polynomial that was used
+    :param basis: function turning frames into the (n, k) design matrix
+    :param coef: (k, 2) coefficients
+    :param weights: per point weights of the last fit, zero for points the robust model rejected
+    """
+
+    def __init__(self, model, smoothing, basis, coef, weights):
+        self.model = model
+        self.smoothing = smoothing
+        self.basis = basis
+        self.coef = coef
+        self.weights = weights
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        return (self.basis(t.ravel()) @ self.coef).reshape(t.shape + (2,))
+
+    @property
+    def outliers(self):
+        """ Boolean mask of the points that were left out of the fit """
+        return self.weights == 0
+
+    def axis(self, axis):
+        """ One component as a callable of frames, for code that evaluates the components separately """
+        return Component(self, axis)
+
+    def __repr__(self):
+        description = f'{self.model} drift model, smoothing {self.smoothing:.3g}'
+        if self.outliers.any():
+            description += f', {self.outliers.sum()} outliers rejected'
+        return description
+
+
+class Component:
+
+    """ A single axis of a DriftModel, evaluating it gives the same values as the model's column """
+
+    def __init__(self, model, axis):
+        self.model = model
+        self.index = axis
+
+    def __call__(self, t):
+        return self.model(t)[..., self.index]
+
+
+def _splinebasis(start, stop, npoints):
+    """ Cubic B-spline design matrix with evenly spaced knots, at most one segment per point or 500 """
+    segments = int(max(1, min(npoints - 1, 500)))
+    spacing = max(stop - start, 1e-9) / segments
+    knots = start + spacing * np.arange(-3, segments + 4)
+    return lambda t: _design(knots, t)
+
+
+def _design(knots, t):
+    from scipy.interpolate import BSpline
+    inside = (t >= knots[3]) & (t <= knots[-4])
+    matrix = np.zeros((len(t), len(knots) - 4))
+    if inside.any():
+        matrix[inside] = BSpline.design_matrix(t[inside], knots, 3).toarray()
+    if not inside.all():
+        # Linear extrapolation from the ends keeps frames past the last point from running off like a cubic
+        for edge, side in ((knots[3], t < knots[3]), (knots[-4], t > knots[-4])):
+            if side.any():
+                value = BSpline.design_matrix(np.array([edge]), knots, 3).toarray()
+                slope = BSpline(knots, np.eye(len(knots) - 4), 3).derivative()(edge)
+                matrix[side] = value + (t[side] - edge)[:, None] * slope
+    return matrix
+
+
+def _gcv(B, y, w, penalties):
+    """
+    Weighted penalised least squares with the penalty that has the lowest generalised cross-validation score
+    over both axes together. Every candidate is scored at once through a Demmler-Reinsch basis: with
+    B'WB = LL' and L^-1 P L^-T = U diag(s) U', the columns of A = L^-T U are orthonormal under B'WB, so the fit
+    for penalty lam has coefficients A (z / (1 + lam s)) with z = A'B'Wy, sum(1 / (1 + lam s)) degrees of
+    freedom and a residual sum of squares that only needs z.
+    :return: penalty, (k, 2) coefficients
+    """
+    k = B.shape[1]
+    D = np.diff(np.eye(k), 2, axis=0)
+    G = B.T @ (w[:, None] * B) + 1e-10 * np.eye(k) * max(1.0, w.sum())
+    L = np.linalg.cholesky(G)
+    Linv = np.linalg.inv(L)
+    s, U = np.linalg.eigh(Linv @ (D.T @ D) @ Linv.T)
+    s = np.clip(s, 0, None)
+    A = Linv.T @ U
+    z = A.T @ (B.T @ (w[:, None] * y))
+    shrink = 1 / (1 + penalties[:, None] * s[None, :])
+    energy = np.sum(z ** 2, axis=1)
+    rss = np.sum(w[:, None] * y ** 2) - (2 * shrink - shrink ** 2) @ energy
+    n = np.count_nonzero(w)
+    score = n * np.maximum(rss, 0) / np.maximum(n - shrink.sum(axis=1), 1e-9) ** 2
+    best = int(np.argmin(score))
+    return penalties[best], A @ (shrink[best][:, None] * z)
+
+
+def _chebyshev(start, stop):
+    middle, half = (start + stop) / 2, max(stop - start, 1e-9) / 2
+
+    def vander(t, degree):
+        return np.polynomial.chebyshev.chebvander((t - middle) / half, degree)
+    return vander
+
+
+def _polynomial(t, y, degree=None, maxdegree=12):
+    """
+    Least squares polynomial, the degree with the lowest leave-one-out error unless given. The leave-one-out
+    residuals come straight from the hat matrix, r / (1 - h), so no degree is refitted n times.
+    """
+    vander = _chebyshev(t.min(), t.max())
+    if degree is None:
+        scores = []
+        for d in range(min(maxdegree, len(t) - 2) + 1):
+            Q, _ = np.linalg.qr(vander(t, d))
+            h = np.sum(Q ** 2, axis=1)
+            loo = (y - Q @ (Q.T @ y)) / np.maximum(1 - h, 1e-9)[:, None]
+            scores.append(np.mean(loo ** 2))
+        degree = int(np.argmin(scores))
+    degree = int(min(degree, len(t) - 1))
+    coef = np.linalg.lstsq(vander(t, degree), y, rcond=None)[0]
+    return DriftModel('polynomial', degree, lambda frames: vander(frames, degree), coef, np.ones(len(t)))
+
+
+def fitmodel(t, drift, model='spline', smoothing=None, iterations=10, cutoff=4.685):
+    """
+    Fits a smooth drift model to both components of the shifts together
+    :param t: frame of every shift
+    :param drift: (n, 2) shifts
+    :param model: one of MODELS
+    :param smoothing: spline penalty or polynomial degree, None chooses it by cross-validation
+    :param iterations: reweighting rounds of the robust model
+    :param cutoff: residuals beyond this many robust standard deviations get no weight in the robust model
+    :return: DriftModel
+    """
+    if model not in MODELS:
+        raise ValueError(f"model must be one of {MODELS}, not {model!r}")
+    t = np.asarray(t, dtype=float)
+    drift = np.asarray(drift, dtype=float).reshape(-1, 2)
+    if len(t) < 4:
+        # Too few points to choose anything by cross-validation, a straight line (or constant) through them
+        return _polynomial(t, drift, min(len(t) - 1, 1)) if len(t) else \
+            DriftModel(model, 0, lambda frames: np.ones((len(frames), 1)), np.zeros((1, 2)), np.ones(0))
+    if model == 'polynomial':
+        return _polynomial(t, drift, smoothing)
+
+    basis = _splinebasis(t.min(), t.max(), len(np.unique(t)))
+    B = basis(t)
+    penalties = PENALTIES if smoothing is None else np.array([float(smoothing)])
+    weights = np.ones(len(t))
+    penalty, coef = _gcv(B, drift, weights, penalties)
+    if model == 'robust':
+        for _ in range(iterations):
+            residual = np.linalg.norm(B @ coef - drift, axis=1)
+            scale = 1.4826 * np.median(residual[weights > 0])
+            if scale <= 0:
+                break
+            # Tukey's biweight on the length of the (x, y) residual, a bad frame is usually bad in both
+            updated = np.clip(1 - (residual / (cutoff * scale)) ** 2, 0, None) ** 2
+            if np.count_nonzero(updated) < 4:
+                break
+            converged = np.allclose(updated, weights, atol=1e-3)
+            weights = updated
+            penalty, coef = _gcv(B, drift, weights, penalties)
+            if converged:
+                break
+    return DriftModel(model, penalty, basis, coef, weights)
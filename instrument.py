@@ -0,0 +1,167 @@
+"""
+Lightweight per stage timers and counters for the drift correction pipeline
+
+    import instrument
+    instrument.enable()
+    PCC(tf)
+    instrument.report()
+
+Stages are timed wherever the pipeline does its work (decoding, blurring, registering, shifting, writing and
+the GUI handlers) and accumulated per name across threads. While disabled, which is the default, stage()
+hands back a shared do-nothing context so the cost is a function call and a flag check.
+Setting DRIFTCORRECTION_PROFILE=1 in the environment enables timing at import.
+"""
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger('driftcorrection')
+
+_enabled = False
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_profiler = None
+_null = contextlib.nullcontext()
+
+
+class _Stage:
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            timer = _timers.setdefault(self.name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += elapsed
+            timer[2] = max(timer[2], elapsed)
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def enable(profile=False, memory=False):
+    """
+    Starts collecting stage timings
+    :param profile: also run cProfile, only sees the thread that called enable
+    :param memory: also trace allocations with tracemalloc, slows everything down noticeably
+    """
+    global _enabled, _profiler
+    _enabled = True
+    if profile and _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """ Stops collecting, what was collected is kept until reset """
+    global _enabled
+    _enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+    if tracemalloc.is_tracing():
+        _counters['peak traced MB'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+
+def reset():
+    global _profiler
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+    _profiler = None
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the pipeline
+    :param name: stage name, timings with the same name add up
+    """
+    if not _enabled:
+        return _null
+    return _Stage(name)
+
+
+def timed(name):
+    """ Decorator timing every call of a function as a stage """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """ Adds n to a counter """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def summary():
+    """
+    :return: dict with 'stages' - name to dict of calls, total and mean seconds and the longest call,
+    and 'counters' - name to value
+    """
+    with _lock:
+        stages = {name: dict(calls=calls, seconds=seconds, mean=seconds / calls, longest=longest)
+                  for name, (calls, seconds, longest) in _timers.items()}
+        counters = dict(_counters)
+    if tracemalloc.is_tracing():
+        counters['peak traced MB'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    return dict(stages=stages, counters=counters)
+
+
+def report(file=None, profile=20):
+    """
+    Prints the stage timings, slowest first, the counters and the top of the cProfile output
+    :param file: stream to print to, stdout by default
+    :param profile: number of cProfile entries to show
+    """
+    results = summary()
+    print(f"{'stage':<24}{'calls':>8}{'total s':>12}{'mean ms':>12}{'max ms':>12}", file=file)
+    for name, timer in sorted(results['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<24}{timer['calls']:>8}{timer['seconds']:>12.3f}{timer['mean'] * 1000:>12.2f}"
+              f"{timer['longest'] * 1000:>12.2f}", file=file)
+    for name, value in results['counters'].items():
+        print(f'{name:<24}{value:>8.6g}', file=file)
+    if _profiler is not None and profile:
+        pstats.Stats(_profiler, stream=file).sort_stats('cumulative').print_stats(profile)
+
+
+def log(level=logging.INFO):
+    """ Emits the summary as one structured record on the driftcorrection logger """
+    logger.log(level, 'stage summary %s', json.dumps(summary()))
+
+
+def dump(filename):
+    """ Writes the summary as JSON, and the cProfile statistics next to it when profiling """
+    with open(filename, 'w') as file:
+        json.dump(summary(), file, indent=1)
+    if _profiler is not None:
+        _profiler.dump_stats(os.path.splitext(filename)[0] + '.prof')
+
+
+if os.environ.get('DRIFTCORRECTION_PROFILE', '') not in ('', '0'):
+    enable()
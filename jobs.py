@@ -0,0 +1,13 @@
+class Cancelled(Exception):
+    """
+    Raised by a long running job (registration, export) when its cancel event has been set
+    """
+
+
+def checkpoint(cancel):
+    """
+    Stops a job between two units of work if it has been cancelled
+    :param cancel: threading.Event or None
+    """
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
@@ -1,93 +1,213 @@
+"""
+Headless drift correction for one or more stacks, e.g. on compute nodes without a display
+
+    python main.py data/*.tif --outdir corrected --workers 4
+
+Writes a drift corrected tiff and a csv of the detected and smoothed shifts for every stack, and for every
+position of multi-position files, which are processed concurrently like separate stacks.
+"""
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from tifffile import TiffWriter
-import tifffile
-from skimage.registration import phase_cross_correlation
-from skimage.transform import AffineTransform, warp
-from skimage.filters import gaussian
-from matplotlib import pyplot as plt
-from scipy.interpolate import UnivariateSpline
+import chunkstore
+import instrument
+from driftcache import DriftCache, cachedPCC
+from PhaseCrossCorrelation import PCC, correctiontranslations
+from tiffstack import positions, tiffstack
+from writer import savedriftcorrected
 
-class TiffStack:
 
+def expand(patterns):
     """
-    Tiffstack holds information about the images to process and accesses them in a memory-efficient manner
-    :param pathname
+    Turns the command line inputs into a list of stacks, each input can be a file, a glob pattern or a
+    directory holding an image sequence
     """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(match for match in matches if match not in paths)
+    return paths
 
-    def __init__(self, pathname):
-        self.ims = tifffile.TiffFile(pathname)
-        self.nfiles = len(self.ims.pages)
-        page = self.ims.pages[0]
-        self.width = page.shape[0]
-        self.height = page.shape[1]
-
-    def getimage(self, index):
-        return self.ims.pages[index].asarray()
-
-
-def PCC(tf, update=10, smoothing=0.9):
-    counter = 0
-    drift_total = []
-    refimage = tf.getimage(0)
-    refimage = gaussian(refimage,sigma=2)
-
-    # refimage = io.imread(filelist[0])
-    # for file in (filelist[1:]):
-    for index in range(1, tf.nfiles):
-        #movingimage = io.imread(file)
-        movingimage = tf.getimage(index)
-        movingimage = gaussian(movingimage,sigma=2)
-        # subpixel precision
-        shift, error, diffphase = phase_cross_correlation(refimage, movingimage,
-                                                          upsample_factor=100)
-        euc = np.sqrt((shift[0]) ** 2 + (shift[1]) ** 2)
-        print(f'Detected subpixel offset (y, x) in tif {index+1}: {shift} with euclidean distance {euc}')
-
-        # As the image changes over time, update the refimage with transformed movingimage
-        if counter > update:
-            transform = AffineTransform(translation=[shift[1] * -1, shift[0] * -1])
-            refimage = warp(movingimage, transform, preserve_range=True)
-            counter = 0
-        counter += 1
-        drift_total.append(shift)
-    x = [x[0] for x in drift_total]
-    y = [y[1] for y in drift_total]
-    t = [t for t in range(len(x))]
-    usx = UnivariateSpline(t, x)
-    usy = UnivariateSpline(t, y)
-    usx.set_smoothing_factor(smoothing)
-    usy.set_smoothing_factor(smoothing)
-    return drift_total, usx, usy
-
-path = '/Users/sbarnett/Documents/PIVData/circle/20211108_MCF10ARab5A_H2BGFP_Invasion-02_-Scene-60-P50-B02-Image Export-60_t127_Phase_ORG.tif' # Enter Path Here
-outpath = '/Users/sbarnett/Documents/PIVData/circle/out.tif' # Enter output place here
-
-# filelist = [os.path.join(path,filename) for filename in os.listdir(path) if filename != '.DS_Store']
-# filelist.sort(key=lambd  a f: int(re.sub('\D', '', f)))
-
-tiffstack = TiffStack(path)
-
-drift_total, usx, usy = PCC(tiffstack, 10, smoothing=0.7)
-
-#refimage = io.imread(filelist[0])
-refimage = tiffstack.getimage(0)
-
-with TiffWriter(outpath) as tif:
-    tif.save(refimage.astype(np.int16))
-    # for index, file in enumerate(filelist[1:]):
-    for index in range(1, tiffstack.nfiles):
-        # movingimage = io.imread(file)
-        movingimage = tiffstack.getimage(index)
-        xshift = usx(index)
-        yshift = usy(index)
-        transform = AffineTransform(translation=[yshift * -1, xshift * -1])
-        shifted = warp(movingimage, transform, preserve_range=True)
-        tif.save(np.int16(shifted))
-
-subt = [t / 10 for t in range(len(drift_total) * 10)]
-plt.plot(drift_total)
-plt.plot(subt, usx(subt))
-plt.plot(subt, usy(subt))
-plt.show()
+
+def outputs(path, outdir=None, store=False, position=None):
+    """
+    Names of the corrected tiff, or chunked store, and the drift csv for an input stack, or one position of it
+    """
+    root, _ = os.path.splitext(path.rstrip(os.sep))
+    if outdir is not None:
+        root = os.path.join(outdir, os.path.basename(root))
+    if position is not None:
+        root += f'_pos{position}'
+    return root + ('DC.zarr' if store else 'DC.tif'), root + '_drift.csv'
 
 
+def savedrift(filename, drift_total, usx, usy):
+    """
+    Writes the per frame shifts and the fitted drift to csv, frame 0 is the reference
+    """
+    drift_total = np.asarray(drift_total).reshape(-1, 2)
+    t = np.arange(len(drift_total))
+    table = np.column_stack([t + 1, drift_total, usx(t), usy(t)])
+    np.savetxt(filename, table, delimiter=',', fmt=['%d', '%.4f', '%.4f', '%.4f', '%.4f'],
+               header='frame,shift_y,shift_x,smooth_y,smooth_x', comments='')
+
+
+def process(path, position=None, channel=0, plane=0, outdir=None, update=10, smoothing=None, threads=1, batch=None,
+            pyramid=0, crop=512, tiles=0, tilesize=256, aggregate='consensus', strategy='rolling', compression=None,
+            bigtiff=None, write=True, cache=True, cachedir=None, profile=False, precision='float32', store=False,
+            model='spline', taper=True):
+    """
+    Estimates and corrects the drift of a single stack, or one position of a multi-position file. Drift is
+    estimated on one channel and plane, the corrected tiff holds every channel and plane shifted by it.
+    :param position: which position, None for files with a single one
+    :param channel: channel the drift is estimated on
+    :param plane: z-plane the drift is estimated on
+    :param model: drift model fitted to the shifts, 'spline', 'polynomial' or 'robust'
+    :param taper: taper full frames before correlating them, see PCC
+    :param store: write the corrected stack as a chunked multi-resolution store rather than a tiff, stores hold a
+    single channel and plane so multi-channel or z-stack input is rejected
+    :param profile: time the stages of the pipeline and return them as 'stages'
+    :return: dict with the number of frames and seconds spent registering and writing
+    """
+    if profile:
+        # Pool workers are reused across stacks, every stack gets its own timings
+        instrument.reset()
+        instrument.enable()
+    outname, csvname = outputs(path, outdir, store, position)
+    tf = tiffstack(path, cachesize=0, prefetch=0, position=position or 0, channel=channel, plane=plane)
+    if store and write and tf.nchannels * tf.nplanes > 1:
+        # Refused before registering rather than writing a store with every other channel and plane missing
+        tf.close()
+        raise ValueError(f'--store writes a single channel and plane, this stack has {tf.nchannels} channels and '
+                         f'{tf.nplanes} planes, write a tiff instead')
+    # A sequence is indexed from its first file, any other file shaped differently would fail part way through
+    mismatched = tf.checkheaders()
+    if mismatched:
+        tf.close()
+        raise ValueError(f'{len(mismatched)} files differ in shape or dtype from the first frame, e.g. '
+                         f'{mismatched[0]}')
+    start = time.perf_counter()
+    options = dict(workers=threads, batch=batch, pyramid=pyramid, crop=crop, tiles=tiles, tilesize=tilesize,
+                   aggregate=aggregate, strategy=strategy, precision=precision, model=model, taper=taper,
+                   verbose=False)
+    if cache:
+        drift_total, usx, usy = cachedPCC(tf, update, smoothing, cache=DriftCache(cachedir), **options)
+    else:
+        drift_total, usx, usy = PCC(tf, update, smoothing, **options)
+    registered = time.perf_counter()
+    savedrift(csvname, drift_total, usx, usy)
+    result = dict(path=path if position is None else f'{path} position {position}', frames=tf.nfiles,
+                  register=registered - start, write=None)
+    if write:
+        translations = correctiontranslations(usx, usy, tf.nfiles)
+        if store:
+            chunkstore.convert(tf, outname, translations=translations, workers=threads)
+        else:
+            savedriftcorrected(tf, outname, translations, compression=compression, bigtiff=bigtiff,
+                               precision=precision)
+        result['write'] = time.perf_counter() - registered
+    if profile:
+        instrument.disable()
+        result['stages'] = instrument.summary()
+    return result
+
+
+def report(result):
+    line = f"{result['path']}: {result['frames']} frames, " \
+           f"registered at {result['frames'] / result['register']:.1f} frames/s"
+    if result['write'] is not None:
+        line += f", written at {result['frames'] / result['write']:.1f} frames/s"
+    stages = result.get('stages', {}).get('stages', {})
+    for name, timer in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        line += f"\n  {name:<12} {timer['seconds']:8.2f} s  {timer['calls']:6d} calls"
+    print(line, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Estimate and correct drift in tiff stacks with cross '
+                                                 'correlation')
+    parser.add_argument('inputs', nargs='+', help='tiff stacks, glob patterns, directories of single frames or '
+                                                  'chunked stores')
+    parser.add_argument('--outdir', help='where to write results, defaults to next to each input')
+    parser.add_argument('--workers', type=int, default=1, help='stacks processed at the same time')
+    parser.add_argument('--threads', type=int, default=1, help='registration threads per stack')
+    parser.add_argument('--update', type=int, default=10, help='how often the reference frame is updated')
+    parser.add_argument('--channel', type=int, default=0, help='channel the drift is estimated on, every channel '
+                                                              'is corrected')
+    parser.add_argument('--plane', type=int, default=0, help='z-plane the drift is estimated on')
+    parser.add_argument('--position', type=int, help='only process this position of multi-position files')
+    parser.add_argument('--smoothing', type=float, help='penalty of the drift spline or degree of the polynomial, '
+                                                        'chosen by cross-validation by default')
+    parser.add_argument('--model', choices=['spline', 'polynomial', 'robust'], default='spline',
+                        help='drift model, robust rejects frames whose shift is far off the rest')
+    parser.add_argument('--batch', type=int, help='frames per batched FFT registration')
+    parser.add_argument('--pyramid', type=int, default=0, help='levels of coarse-to-fine registration')
+    parser.add_argument('--crop', type=int, default=512, help='refinement window of the pyramid')
+    parser.add_argument('--tiles', type=int, default=0, help='register this many textured tiles instead of '
+                                                             'the full frame')
+    parser.add_argument('--tile-size', dest='tilesize', type=int, default=256, help='edge length of the tiles')
+    parser.add_argument('--aggregate', choices=['median', 'consensus'], default='consensus',
+                        help='how the tile shifts are combined')
+    parser.add_argument('--reference', dest='strategy', choices=['fixed', 'rolling', 'average'], default='rolling',
+                        help='register against the first frame, the latest keyframe or a running average')
+    parser.add_argument('--precision', choices=['float32', 'float64'], default='float32',
+                        help='float type frames are blurred, registered and shifted in')
+    parser.add_argument('--no-taper', dest='taper', action='store_false',
+                        help='phase correlate whole frames without a window, as skimage does')
+    parser.add_argument('--compression', help="compression of the corrected tiffs, e.g. 'zlib'")
+    parser.add_argument('--bigtiff', action='store_true', default=None, help='always write BigTIFF')
+    parser.add_argument('--store', action='store_true',
+                        help='write the corrected stacks as chunked multi-resolution stores (.zarr directories), '
+                             'single channel and plane stacks only')
+    parser.add_argument('--no-write', dest='write', action='store_false', help='only write the drift csv')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='always register, ignoring drift found by earlier runs')
+    parser.add_argument('--profile', action='store_true', help='report the time spent in every stage')
+    parser.add_argument('--cache-dir', dest='cachedir', help='where earlier drift results are kept')
+    args = parser.parse_args(argv)
+
+    paths = expand(args.inputs)
+    if not paths:
+        parser.error('no input stacks found')
+    if args.outdir is not None:
+        os.makedirs(args.outdir, exist_ok=True)
+    # Every position of a multi-position file is a job of its own, processed alongside the other stacks
+    jobs = []
+    for path in paths:
+        if args.position is not None:
+            jobs.append((path, args.position))
+            continue
+        try:
+            count = positions(path)
+        except Exception:
+            # Unreadable, process reports the error
+            count = 1
+        jobs.extend((path, position if count > 1 else None) for position in range(count))
+    options = dict(channel=args.channel, plane=args.plane, outdir=args.outdir, update=args.update,
+                   smoothing=args.smoothing, threads=args.threads, batch=args.batch, pyramid=args.pyramid,
+                   crop=args.crop, tiles=args.tiles, tilesize=args.tilesize, aggregate=args.aggregate,
+                   strategy=args.strategy, compression=args.compression, bigtiff=args.bigtiff, write=args.write,
+                   cache=args.cache, cachedir=args.cachedir, profile=args.profile, precision=args.precision,
+                   store=args.store, model=args.model, taper=args.taper)
+
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(process, path, position, **options): (path, position) for path, position in jobs}
+        for future in as_completed(futures):
+            try:
+                report(future.result())
+            except Exception as error:
+                failed += 1
+                path, position = futures[future]
+                label = path if position is None else f'{path} position {position}'
+                print(f'{label}: failed, {error}', flush=True)
+    print(f'{len(jobs) - failed} of {len(jobs)} stacks done in {time.perf_counter() - start:.1f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,15 +1,22 @@
 
 from PyQt6 import QtCore, QtWidgets
 import sys
+import threading
+import math
+import time
+import numpy as np
 from PyQt6.QtGui import  QFontDatabase, QAction, QIcon
 from PyQt6.QtCore import pyqtSlot
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 from superqt import QLabeledRangeSlider
 from matplotlib.figure import Figure
-from skimage.transform import AffineTransform, warp
-from scipy.interpolate import UnivariateSpline
-from PhaseCrossCorrelation import PCC
+import chunkstore
+from driftmodel import MODELS
 from functools import wraps
+import instrument
+from instrument import timed
+from jobs import Cancelled
+from roipoints import PointStore
 from tiffstack import tiffstack
 
 
@@ -23,6 +30,45 @@ def ifnotplothandles(func):
     return wrapper
 
 
+class WorkerSignals(QtCore.QObject):
+    progress = QtCore.pyqtSignal(object)
+    finished = QtCore.pyqtSignal(object)
+    error = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+
+
+class Worker(QtCore.QRunnable):
+
+    """
+    Runs a long job such as PCC or an export on the thread pool so the window stays responsive.
+    The job is called with progress and cancel keyword arguments, progress calls are forwarded to the GUI
+    thread through signals.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        super(Worker, self).__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.cancelevent = threading.Event()
+
+    def cancel(self):
+        self.cancelevent.set()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            result = self.func(*self.args, progress=lambda *args: self.signals.progress.emit(args),
+                               cancel=self.cancelevent, **self.kwargs)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as error:
+            self.signals.error.emit(str(error))
+        else:
+            self.signals.finished.emit(result)
+
+
 class MplCanvas(FigureCanvasQTAgg):
 
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -31,8 +77,53 @@ class MplCanvas(FigureCanvasQTAgg):
         super(MplCanvas, self).__init__(self.fig)
 
 
+class Blitter:
+
+    """
+    Fast redraw path for the image viewer. The image and ROI artists are animated, so a full draw of the
+    figure only happens when the view itself changes (resizing, zooming, panning). Stepping through frames
+    restores the saved background and redraws just those two artists into the canvas.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.artists = []
+        self.background = None
+        canvas.mpl_connect('draw_event', self.ondraw)
+
+    def add(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        return artist
+
+    def clear(self):
+        self.artists = []
+        self.background = None
+
+    def ondraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.drawartists()
+
+    def drawartists(self):
+        for artist in self.artists:
+            if artist.axes is not None:
+                artist.axes.draw_artist(artist)
+
+    def update(self):
+        if self.background is None:
+            # Nothing drawn yet, a full draw sets up the background
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.drawartists()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+
 class MainWindow(QtWidgets.QMainWindow):
 
+    # The stack's intensity statistics have been computed in the background
+    statisticsready = QtCore.pyqtSignal()
+
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         self._createMenuBar()
@@ -51,22 +142,59 @@ class MainWindow(QtWidgets.QMainWindow):
         self.PCCbutton = QtWidgets.QPushButton('PCC')
         self.PCCbutton.clicked.connect(self.pccbuttonfunction)
         self.PCCbutton.setToolTip('Applies subpixel phase cross correlation to estimate drift')
+        self.modelbox = QtWidgets.QComboBox(self)
+        self.modelbox.addItems(MODELS)
+        self.modelbox.setToolTip("Drift model fitted to the shifts, its smoothing is chosen by cross-validation. "
+                                 "'robust' ignores frames whose shift is far off the rest")
+        self.channelbox = QtWidgets.QSpinBox(self)
+        self.channelbox.setPrefix('Channel ')
+        self.channelbox.setToolTip("Channel shown and drift is estimated on, the correction is applied to every "
+                                   "channel and z-plane on export")
+        self.channelbox.setEnabled(False)
+        self.channelbox.valueChanged.connect(self.changechannel)
         self.driftcheckbox = QtWidgets.QCheckBox("Apply drift", self)
-        self.driftcheckbox.setToolTip("If a drift estimation has been made, this toggles the correction to the displayed"
-                                      " data")
+        self.driftcheckbox.setToolTip("If a drift estimation has been made, this toggles the correction to the "
+                                      "displayed data")
         self.driftcheckbox.setEnabled(False)
         self.driftcheckbox.clicked.connect(self.viewdrift)
         self.autocontrast = QtWidgets.QCheckBox("AutoContrast", self)
         self.autocontrast.setToolTip("Toggle autocontrast on/off")
         self.autocontrast.setChecked(True)
+        self.progressbar = QtWidgets.QProgressBar(self)
+        self.progressbar.setVisible(False)
+        self.cancelbutton = QtWidgets.QPushButton('Cancel')
+        self.cancelbutton.setToolTip('Stop the running drift estimation or export')
+        self.cancelbutton.clicked.connect(self.canceljob)
+        self.cancelbutton.setVisible(False)
+        self.threadpool = QtCore.QThreadPool.globalInstance()
+        self.worker = None
+        self.globalcontrast = QtWidgets.QCheckBox("Global contrast", self)
+        self.globalcontrast.setToolTip("Autocontrast with the intensity range of the whole stack rather than each "
+                                       "frame")
+        self.globalcontrast.clicked.connect(self.viewdrift)
+        self.playbutton = QtWidgets.QPushButton('Play')
+        self.playbutton.setToolTip('Play through the stack and report the frame rate achieved')
+        self.playbutton.setCheckable(True)
+        self.playbutton.clicked.connect(self.toggleplayback)
+        self.playbackfps = 30
+        self.playtimer = QtCore.QTimer(self)
+        self.playtimer.timeout.connect(self.playbackstep)
+        self.playstats = None
+        self.statisticsready.connect(self.viewdrift)
 
         self.buttonbox = QtWidgets.QVBoxLayout()
         self.buttonbox.addStretch(1)
         self.buttonbox.addWidget(self.toggleroi)
         self.buttonbox.addWidget(self.driftcorbutton)
         self.buttonbox.addWidget(self.PCCbutton)
+        self.buttonbox.addWidget(self.modelbox)
+        self.buttonbox.addWidget(self.channelbox)
         self.buttonbox.addWidget(self.driftcheckbox)
         self.buttonbox.addWidget(self.autocontrast)
+        self.buttonbox.addWidget(self.globalcontrast)
+        self.buttonbox.addWidget(self.playbutton)
+        self.buttonbox.addWidget(self.progressbar)
+        self.buttonbox.addWidget(self.cancelbutton)
         self.buttonbox.addStretch(1)
 
         # Central Image controls
@@ -79,7 +207,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.sc.axes.get_yaxis().set_visible(False)
         self.sc.axes.set_aspect('auto')
         self.sc.fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
-        self.s = self.sc.axes.scatter([], [], facecolors='none', edgecolors='r')
+        self.blitter = Blitter(self.sc)
+        self.s = self.blitter.add(self.sc.axes.scatter([], [], facecolors='none', edgecolors='r'))
         self.mpl_toolbar = NavigationToolbar2QT(self.sc, None)
 
         zoomact = QAction(QIcon("icons/zoom2.png"), "zoom", self)
@@ -96,9 +225,11 @@ class MainWindow(QtWidgets.QMainWindow):
         openact = QAction(QIcon("icons/open.png"),"open file",self)
         openact.setCheckable(True)
         openact.triggered.connect(self.get_file)
+        self.openact = openact
 
         saveact = QAction(QIcon("icons/save.png"),"Save drift corrected data",self)
         saveact.triggered.connect(self.savedrift)
+        self.saveact = saveact
 
         self.toolbar = self.addToolBar("zoom")
         self.toolbar.addAction(panact)
@@ -126,6 +257,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.right = QtWidgets.QVBoxLayout()
 
         data = []
+        # The points live in the store, the table only shows them
+        self.points = PointStore()
         self.table = TableView(data)
         self.table.setColumnCount(3)
         self.table.setRowCount(0)
@@ -136,10 +269,18 @@ class MainWindow(QtWidgets.QMainWindow):
         self.cleartablebutton.clicked.connect(self.cleartable)
         self.deleteonebutton = QtWidgets.QPushButton("Delete last")
         self.deleteonebutton.clicked.connect(self.deletelast)
+        self.loadpointsbutton = QtWidgets.QPushButton("Load")
+        self.loadpointsbutton.setToolTip('Load ROI points from a csv or npy file')
+        self.loadpointsbutton.clicked.connect(self.loadpoints)
+        self.savepointsbutton = QtWidgets.QPushButton("Save")
+        self.savepointsbutton.setToolTip('Save the ROI points to a csv or npy file')
+        self.savepointsbutton.clicked.connect(self.savepoints)
 
         self.right_buttons = QtWidgets.QHBoxLayout()
         self.right_buttons.addWidget(self.cleartablebutton)
         self.right_buttons.addWidget(self.deleteonebutton)
+        self.right_buttons.addWidget(self.loadpointsbutton)
+        self.right_buttons.addWidget(self.savepointsbutton)
         self.right.addLayout(self.right_buttons)
 
         self.driftgraph = MplCanvas()
@@ -149,6 +290,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.right.addWidget(self.driftgraph)
         self.line1, = self.driftgraph.axes.plot([], [])
         self.line2, = self.driftgraph.axes.plot([], [])
+        self.rawlines = []
 
         self.hbox.addLayout(self.right)
 
@@ -158,7 +300,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
         self.slider.setRange(0, self.imstack.nfiles - 1)
         self.slider.valueChanged.connect(self.move_through_stack)
+        # Scrubbing shows a coarser level of a chunked store, full resolution comes back on release
+        self.slider.sliderReleased.connect(self.viewdrift)
         self.currentimage = 0
+        self.shownlevel = 0
         sliderholder.addWidget(self.slider)
         self.label = QtWidgets.QLabel('0', self)
         self.label.setAlignment(QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter)
@@ -182,77 +327,212 @@ class MainWindow(QtWidgets.QMainWindow):
         exitAction.setStatusTip('Exit application')
         exitAction.triggered.connect(self.exit)
 
+        storeAction = QAction(' &Open chunked store', self)
+        storeAction.setStatusTip('Open a stack converted into a chunked multi-resolution store')
+        storeAction.triggered.connect(self.get_store)
+        self.storeact = storeAction
+
+        convertAction = QAction(' &Convert to chunked store', self)
+        convertAction.setStatusTip('Write the open stack into a chunked multi-resolution store for faster browsing')
+        convertAction.triggered.connect(self.convertstack)
+        self.convertact = convertAction
+
+        timingAction = QAction(' &Record timings', self)
+        timingAction.setCheckable(True)
+        timingAction.setStatusTip('Time every stage of the pipeline, the report is printed when switched off')
+        timingAction.triggered.connect(self.recordtimings)
+
         menuBar = self.menuBar()
         filemenu = QtWidgets.QMenu(" &File", self)
         menuBar.addMenu(filemenu)
+        filemenu.addAction(storeAction)
+        filemenu.addAction(convertAction)
+        filemenu.addAction(timingAction)
         filemenu.addAction(exitAction)
         self.setMenuBar(menuBar)
 
+    def recordtimings(self, checked):
+        if checked:
+            instrument.reset()
+            instrument.enable()
+        else:
+            instrument.disable()
+            instrument.report()
+
     def exit(self):
         self.close()
 
+    @timed('gui.update_contrast')
     def update_contrast(self, value):
         self.mincontrast = value[0]
         self.maxcontrast = value[1]
         if self.plothandle:
             self.plothandle.set_clim(self.mincontrast, self.maxcontrast)
-            self.sc.fig.canvas.draw()
+            self.blitter.update()
+
+    @ifnotplothandles
+    def changechannel(self, channel):
+        self.imstack.setchannel(channel)
+        minimum, maximum = self.imstack.contrastlimits(self.currentimage, self.contrastmode())
+        self.contrastslider.blockSignals(True)
+        self.contrastslider.setRange(0, maximum * 1.5)
+        self.contrastslider.setValue((minimum, maximum))
+        self.contrastslider.blockSignals(False)
+        self.mincontrast, self.maxcontrast = minimum, maximum
+        self.viewdrift()
+
+    def contrastmode(self):
+        return 'global' if self.globalcontrast.isChecked() else 'frame'
 
     def viewdrift(self):
         self.move_through_stack(self.currentimage)
 
+    @timed('gui.get_file')
     def get_file(self):
+        filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open File', '')[0]
+        if filename != "":
+            self.openstack(filename)
+
+    def get_store(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, 'Open chunked store', '')
+        if directory != "":
+            if not chunkstore.isstore(directory):
+                return QtWidgets.QMessageBox.about(self, "Error", f"{directory} is not a chunked store")
+            self.openstack(directory)
+
+    @timed('gui.openstack')
+    def openstack(self, filename):
         self.sc.axes.cla()
-        self.filename = None
-        self.filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open File', '')
-        if self.filename[0] != "":
-            self.filename = self.filename[0]
-            self.imstack = tiffstack(self.filename)
-            self.plothandle = self.sc.axes.imshow(self.imstack.getimage(0))
-            self.slider.setRange(0, self.imstack.nfiles - 1)
-            self.slider.setValue(0)
-            self.plothandle.set_cmap('gray')
-            self.sc.fig.canvas.draw()
-            self.table.clearTable()
-            self.contrastslider.setRange(0, self.imstack.maximum * 1.5)
-            self.contrastslider.setValue((self.imstack.minimum, self.imstack.maximum))
+        self.blitter.clear()
+        self.filename = filename
+        # Its prefetch thread, cached frames and file handle go with it
+        self.imstack.close()
+        self.imstack = tiffstack(self.filename)
+        if self.imstack.npositions > 1:
+            position, ok = QtWidgets.QInputDialog.getInt(self, 'Position', f'{self.imstack.npositions} positions, '
+                                                         'open position', 0, 0, self.imstack.npositions - 1)
+            if ok and position:
+                self.imstack.close()
+                self.imstack = tiffstack(self.filename, position=position)
+        mismatched = self.imstack.checkheaders()
+        if mismatched:
+            QtWidgets.QMessageBox.warning(self, "Warning", f"{len(mismatched)} files differ in shape or dtype from "
+                                                           f"the first frame and can't be shown, e.g. {mismatched[0]}")
+        self.channelbox.blockSignals(True)
+        self.channelbox.setRange(0, self.imstack.nchannels - 1)
+        self.channelbox.setValue(self.imstack.channel)
+        self.channelbox.blockSignals(False)
+        self.channelbox.setEnabled(self.imstack.nchannels > 1)
+        # Drift of the previous stack doesn't apply to this one
+        self.xdrift = None
+        self.ydrift = None
+        self.driftcheckbox.setChecked(False)
+        self.driftcheckbox.setEnabled(False)
+        # Fixed extent in full resolution pixels, so lower resolution levels of a store fill the same area
+        # and ROI coordinates stay in full resolution whatever level is shown
+        extent = (-0.5, self.imstack.height - 0.5, self.imstack.width - 0.5, -0.5)
+        self.plothandle = self.blitter.add(self.sc.axes.imshow(self.imstack.getimage(0), extent=extent))
+        self.shownlevel = 0
+        self.sc.axes.callbacks.connect('xlim_changed', self.zoomchanged)
+        self.s = self.blitter.add(self.sc.axes.scatter([], [], facecolors='none', edgecolors='r'))
+        self.slider.setRange(0, self.imstack.nfiles - 1)
+        self.slider.setValue(0)
+        self.plothandle.set_cmap('gray')
+        self.sc.fig.canvas.draw()
+        self.points.clear()
+        self.table.clearTable()
+        # Reading every frame for the statistics would hold up the first one, until they are ready the
+        # contrast follows each frame's own range
+        self.imstack.computestatistics(self.statisticsready.emit)
+        minimum, maximum = self.imstack.contrastlimits(0, self.contrastmode())
+        self.contrastslider.setRange(0, maximum * 1.5)
+        self.contrastslider.setValue((minimum, maximum))
 
     @pyqtSlot()
     @ifnotplothandles
     def savedrift(self):
-        if self.xdrift != None:
-            self.imstack.savedriftcorrected()
+        if self.xdrift is not None:
+            # A stack browsed from a chunked store is written back as one, in parallel blocks
+            outname = self.imstack.outname('DC.zarr') if self.imstack.store is not None else None
+            worker = Worker(self.imstack.savedriftcorrected, outname)
+            worker.signals.progress.connect(lambda args: self.progressbar.setValue(args[0]))
+            worker.signals.finished.connect(lambda result: self.statusBar().showMessage("Saved drift corrected data"))
+            self.startjob(worker, self.imstack.nfiles)
         else:
             QtWidgets.QMessageBox.about(self,"Error","There is no drift calculated")
 
+    @pyqtSlot()
+    @ifnotplothandles
+    def convertstack(self):
+        if self.imstack.store is not None:
+            return QtWidgets.QMessageBox.about(self, "Error", "The stack is already a chunked store")
+        if self.imstack.nchannels * self.imstack.nplanes > 1:
+            return QtWidgets.QMessageBox.about(self, "Error", "A chunked store holds a single channel and z-plane, "
+                                                              "this stack has more")
+        directory = QtWidgets.QFileDialog.getSaveFileName(self, 'Convert to chunked store',
+                                                          self.imstack.outname('.zarr'))[0]
+        if directory != "":
+            worker = Worker(chunkstore.convert, self.imstack, directory)
+            worker.signals.progress.connect(lambda args: self.progressbar.setValue(args[0]))
+            worker.signals.finished.connect(lambda store: self.openstack(store.path))
+            self.startjob(worker, self.imstack.nfiles)
+
+    def startjob(self, worker, total):
+        """
+        Runs worker on the thread pool with the progress bar and cancel button shown, one job at a time
+        """
+        if self.worker is not None:
+            QtWidgets.QMessageBox.about(self, "Error", "Wait for the running job to finish or cancel it")
+            return
+        self.worker = worker
+        worker.signals.finished.connect(self.jobdone)
+        worker.signals.error.connect(self.joberror)
+        worker.signals.cancelled.connect(self.jobdone)
+        self.progressbar.setRange(0, total)
+        self.progressbar.setValue(0)
+        self.progressbar.setVisible(True)
+        self.cancelbutton.setVisible(True)
+        # The job holds on to the open stack and channel, neither may change under it
+        for control in (self.PCCbutton, self.driftcorbutton, self.saveact, self.openact, self.storeact,
+                        self.convertact, self.channelbox):
+            control.setEnabled(False)
+        self.threadpool.start(worker)
+
+    def canceljob(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def jobdone(self, *args):
+        self.worker = None
+        self.progressbar.setVisible(False)
+        self.cancelbutton.setVisible(False)
+        for control in (self.PCCbutton, self.driftcorbutton, self.saveact, self.openact, self.storeact,
+                        self.convertact):
+            control.setEnabled(True)
+        self.channelbox.setEnabled(self.imstack.nchannels > 1)
+
+    def joberror(self, message):
+        self.jobdone()
+        QtWidgets.QMessageBox.about(self, "Error", message)
+
+    @timed('gui.onclick')
     def onclick(self, event):
         if self.roimode == 1:
-            self.table.addRow([self.slider.value(), round(event.xdata, 2), round(event.ydata, 2)])
-            self.table.setData()
-            x = []
-            y = []
-            for row in range(self.table.rowCount()):
-                if int(self.table.item(row, 0).text()) == self.slider.value():
-                    x.append(float(self.table.item(row, 1).text()))
-                    y.append(float(self.table.item(row, 2).text()))
-            if len(x) == 0:
-                self.s.remove()
-                self.s = self.sc.axes.scatter([], [], facecolors='none', edgecolors='r')
-            else:
-                self.s.remove()
-                self.s = self.sc.axes.scatter(x, y, facecolors='none', edgecolors='r')
-            self.sc.fig.canvas.draw()
+            point = [self.slider.value(), round(event.xdata, 2), round(event.ydata, 2)]
+            self.points.add(*point)
+            self.table.addRow(point)
+            self.drawpoints(self.slider.value())
+            self.blitter.update()
         else:
             pass
 
     def keyPressEvent(self, event):
         if event.key() == QtCore.Qt.Key_S:
             if 0 <= self.slider.value() < self.imstack.nfiles-1:
-                self.move_through_stack(self.slider.value()+1)
+                # The slider's valueChanged signal redraws the frame
                 self.slider.setValue(self.slider.value()+1)
         elif event.key() == QtCore.Qt.Key_A:
             if 0 < self.slider.value() < self.imstack.nfiles:
-                self.move_through_stack(self.slider.value()-1)
                 self.slider.setValue(self.slider.value()-1)
         event.accept()
 
@@ -266,77 +546,116 @@ class MainWindow(QtWidgets.QMainWindow):
 
     @pyqtSlot(int)
     @ifnotplothandles
+    @timed('gui.move_through_stack')
     def move_through_stack(self, value):
         """ Updates the current image in the viewport"""
-        if self.driftcheckbox.isChecked():
-            # If user wishes to view the drift corrected results
-            xshift = self.xdrift(value)
-            yshift = self.ydrift(value)
-            image = self.imstack.getimage(value)
-            transform = AffineTransform(translation=[xshift, yshift])
-            shifted = warp(image, transform, preserve_range=True)
-            self.plothandle.set_data(shifted)
-        else:
-            self.plothandle.set_data(self.imstack.getimage(value))
-
-        # Update the scatter plot for ROIs
-        x = []
-        y = []
-        for row in range(self.table.rowCount()):
-            if int(self.table.item(row, 0).text()) == value:
-                x.append(float(self.table.item(row, 1).text()))
-                y.append(float(self.table.item(row, 2).text()))
-        if len(x) == 0:
-            self.s.remove()
-            self.s = self.sc.axes.scatter([], [], facecolors='none', edgecolors='r')
-        else:
-            self.s.remove()
-            self.s = self.sc.axes.scatter(x, y, facecolors='none', edgecolors='r')
+        direction = 1 if value >= self.currentimage else -1
+        # If user wishes to view the drift corrected results, the lazily shifted view of the stack
+        corrected = self.driftcheckbox.isChecked() and self.imstack.corrected is not None
+        stack = self.imstack.corrected if corrected else self.imstack
+        self.shownlevel = self.displaylevel()
+        self.plothandle.set_data(stack.getpreview(value, self.shownlevel))
+        if self.shownlevel == 0:
+            stack.prefetch(value, direction)
+
+        self.drawpoints(value)
 
         # Check and update contrast
         if not self.autocontrast.isChecked():
             self.plothandle.set_clim([self.mincontrast, self.maxcontrast])
         else:
-            self.contrastslider.setRange(0, self.imstack.maximum*1.5)
-            self.contrastslider.setValue((self.imstack.minimum, self.imstack.maximum))
-
-        self.sc.fig.canvas.draw()
+            minimum, maximum = self.imstack.contrastlimits(value, self.contrastmode())
+            self.plothandle.set_clim(minimum, maximum)
+            self.mincontrast, self.maxcontrast = minimum, maximum
+            # Only move the slider, update_contrast would otherwise redraw the frame a second time
+            self.contrastslider.blockSignals(True)
+            self.contrastslider.setRange(0, maximum*1.5)
+            self.contrastslider.setValue((minimum, maximum))
+            self.contrastslider.blockSignals(False)
+
+        self.blitter.update()
         self.label.setText(str(value))
         self.currentimage = value
 
+    def displaylevel(self):
+        """
+        Resolution level to show, 0 unless the stack is a chunked store. Zoomed out far enough that several
+        pixels share a screen pixel the matching lower resolution level is used, and one level coarser still
+        while the slider is dragged or the stack is playing.
+        """
+        if self.imstack.levels == 1:
+            return 0
+        span = abs(np.diff(self.sc.axes.get_xlim())[0])
+        level = max(0, int(math.log2(max(1.0, span / max(1.0, self.sc.axes.bbox.width)))))
+        if self.slider.isSliderDown() or self.playtimer.isActive():
+            level += 1
+        return min(level, self.imstack.levels - 1)
+
+    def zoomchanged(self, axes):
+        if self.imstack.levels > 1 and self.displaylevel() != self.shownlevel:
+            # Not from inside the draw that changed the limits
+            QtCore.QTimer.singleShot(0, self.viewdrift)
+
+    def drawpoints(self, value):
+        """ Update the scatter plot for ROIs placed on frame value """
+        self.s.set_offsets(self.points.inframe(value))
+
+    @ifnotplothandles
+    def toggleplayback(self, checked=False):
+        """
+        Steps through the stack on a timer aiming for playbackfps, the frame rate actually achieved is shown
+        in the status bar
+        """
+        if self.playtimer.isActive():
+            self.stopplayback()
+            return
+        self.playbutton.setText('Stop')
+        self.playstats = [time.perf_counter(), 0]
+        self.playtimer.start(int(1000 / self.playbackfps))
+
+    def playbackstep(self):
+        value = self.slider.value() + 1
+        if value >= self.imstack.nfiles:
+            self.stopplayback()
+            return
+        self.slider.setValue(value)
+        # Let the blit reach the screen so the rate counts frames actually shown
+        self.sc.repaint()
+        self.playstats[1] += 1
+        elapsed = time.perf_counter() - self.playstats[0]
+        if self.playstats[1] % self.playbackfps == 0:
+            self.statusBar().showMessage(f'Playback at {self.playstats[1] / elapsed:.1f} frames/s')
+
+    def stopplayback(self):
+        self.playtimer.stop()
+        self.playbutton.setChecked(False)
+        self.playbutton.setText('Play')
+        if self.playstats is not None and self.playstats[1]:
+            elapsed = time.perf_counter() - self.playstats[0]
+            self.statusBar().showMessage(f'Played {self.playstats[1]} frames at '
+                                         f'{self.playstats[1] / elapsed:.1f} frames/s')
+        self.playstats = None
+        self.viewdrift()
+
     @pyqtSlot()
     @ifnotplothandles
+    @timed('gui.correctdrift')
     def correctdrift(self):
         """
         For point-based drift tracking, will smooth the translations with a spline and render drift to the output graph
         :return: None
         """
+        if len(self.points) == 0:
+            return QtWidgets.QMessageBox.about(self, "Error", "There are no ROI points placed")
         self.line1.remove()
         self.line2.remove()
 
-        x = []
-        y = []
-        t = []
-        for row in range(self.table.rowCount()):
-            t.append(int(self.table.item(row, 0).text()))
-            x.append(float(self.table.item(row, 1).text()))
-            y.append(float(self.table.item(row, 2).text()))
-        t = [tsub for tsub in t]
-        x = [xsub - x[0] for xsub in x]
-        y = [ysub - y[0] for ysub in y]
-        t, xs, ys = (list(t) for t in zip(*sorted(zip(t, x, y))))
-
-        usx = UnivariateSpline(t, xs)
-        usy = UnivariateSpline(t, ys)
-        usx.set_smoothing_factor(0.7)
-        usy.set_smoothing_factor(0.7)
-
+        t, x, y, usx, usy, smoothx, smoothy = self.points.drift(self.imstack.nfiles,
+                                                                model=self.modelbox.currentText())
         self.xdrift = usx
         self.ydrift = usy
 
-        subt = [t for t in range(self.imstack.nfiles)]
-        smoothx = usx(subt)
-        smoothy = usy(subt)
+        subt = np.arange(self.imstack.nfiles)
 
         self.line1, = self.driftgraph.axes.plot(subt, smoothx, label='x drift')
         self.line2, = self.driftgraph.axes.plot(subt, smoothy, label='y drift')
@@ -346,35 +665,94 @@ class MainWindow(QtWidgets.QMainWindow):
         self.driftgraph.fig.canvas.draw()
 
         self.driftcheckbox.setEnabled(True)
-        self.imstack.settransforms(smoothx, smoothy)
+        # The tracked drift of every frame, frame 0 included, is the translation that moves it back
+        self.imstack.setdrift(np.column_stack([smoothx, smoothy]))
+        self.statusBar().showMessage(repr(usx.model))
 
     @pyqtSlot()
     @ifnotplothandles
     def pccbuttonfunction(self):
-        self.line1.remove()
-        self.line2.remove()
-
-        drifttotal, usx, usy = PCC(self.imstack)
+        """
+        Estimates the drift with PCC in the background, the raw shifts are drawn as frames are registered
+        """
+        if self.worker is not None:
+            return
+        for line in [self.line1, self.line2] + self.rawlines:
+            line.remove()
+        self.line1, = self.driftgraph.axes.plot([], [])
+        self.line2, = self.driftgraph.axes.plot([], [])
+        self.pccraw = np.full((self.imstack.nfiles, 2), np.nan)
+        self.pccraw[0] = 0
+        subt = np.arange(self.imstack.nfiles)
+        self.rawlines = self.driftgraph.axes.plot(subt, self.pccraw, '.', markersize=2)
+        self.registered = 0
+
+        from driftcache import cachedPCC
+        worker = Worker(cachedPCC, self.imstack, model=self.modelbox.currentText(), verbose=False)
+        worker.signals.progress.connect(self.pccprogress)
+        worker.signals.finished.connect(self.pccfinished)
+        self.startjob(worker, self.imstack.nfiles - 1)
+
+    @timed('gui.pccprogress')
+    def pccprogress(self, args):
+        index, shift = args
+        # Drift of the content is the opposite of the shift that registers it back onto the reference
+        self.pccraw[index] = (-shift[1], -shift[0])
+        self.registered += 1
+        self.progressbar.setValue(self.registered)
+        self.rawlines[0].set_ydata(self.pccraw[:, 0])
+        self.rawlines[1].set_ydata(self.pccraw[:, 1])
+        self.driftgraph.axes.relim()
+        self.driftgraph.axes.autoscale_view()
+        self.driftgraph.fig.canvas.draw_idle()
+
+    @timed('gui.pccfinished')
+    def pccfinished(self, result):
+        drifttotal, usx, usy = result
+        # A cached result arrives without any progress, draw all of the raw shifts at once
+        self.pccraw[1:] = -np.asarray(drifttotal)[:, ::-1]
+        self.rawlines[0].set_ydata(self.pccraw[:, 0])
+        self.rawlines[1].set_ydata(self.pccraw[:, 1])
         self.xdrift = usx
         self.ydrift = usy
-        subt = [t for t in range(self.imstack.nfiles)]
-        smoothx = usx(subt)
-        smoothy = usy(subt)
-        self.line1, = self.driftgraph.axes.plot(subt, smoothx, label='x drift')
-        self.line2, = self.driftgraph.axes.plot(subt, smoothy, label='y drift')
+        from PhaseCrossCorrelation import correctiontranslations
+        translations = correctiontranslations(usx, usy, self.imstack.nfiles)
+        subt = np.arange(self.imstack.nfiles)
+        self.line1.remove()
+        self.line2.remove()
+        self.line1, = self.driftgraph.axes.plot(subt, translations[:, 0], label='x drift')
+        self.line2, = self.driftgraph.axes.plot(subt, translations[:, 1], label='y drift')
         self.driftgraph.axes.legend(handles=[self.line1, self.line2], loc='upper right')
         self.driftgraph.fig.canvas.draw()
         self.driftcheckbox.setEnabled(True)
-        self.imstack.settransforms(smoothx, smoothy)
+        self.imstack.setdrift(translations)
+        self.statusBar().showMessage(repr(usx.model))
 
     def cleartable(self):
+        self.points.clear()
         self.table.clearTable()
         self.move_through_stack(self.currentimage)
 
     def deletelast(self):
+        self.points.removelast()
         self.table.deleteRow()
         self.move_through_stack(self.currentimage)
 
+    @pyqtSlot()
+    @ifnotplothandles
+    def loadpoints(self):
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Load points', '', 'Points (*.csv *.npy)')
+        if filename:
+            self.points = PointStore.load(filename)
+            self.table.showpoints(self.points.points[:len(self.points)])
+            self.move_through_stack(self.currentimage)
+
+    @pyqtSlot()
+    def savepoints(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save points', '', 'Points (*.csv *.npy)')
+        if filename:
+            self.points.save(filename)
+
 
 class TableView(QtWidgets.QTableWidget):
     def __init__(self, data, *args):
@@ -404,6 +782,15 @@ class TableView(QtWidgets.QTableWidget):
             self.setItem(row, col, cell)
             col += 1
 
+    def showpoints(self, points):
+        """ Replaces the contents with an (n, 3) array of frame, x, y """
+        self.setUpdatesEnabled(False)
+        self.setRowCount(len(points))
+        for row, (frame, x, y) in enumerate(points):
+            for col, el in enumerate([int(frame), round(x, 2), round(y, 2)]):
+                self.setItem(row, col, QtWidgets.QTableWidgetItem(str(el)))
+        self.setUpdatesEnabled(True)
+
     def deleteRow(self):
         row = self.rowCount()
         self.removeRow(row-1)
@@ -416,6 +803,19 @@ class TableView(QtWidgets.QTableWidget):
         e.ignore()
 
 
+def preload():
+    """
+    Imports what registration, drift fitting and export need on first use, so the window can show before
+    scipy and skimage have loaded and the first job doesn't pay for them
+    """
+    import scipy.fft
+    import scipy.interpolate
+    import scipy.ndimage
+    from skimage.registration import phase_cross_correlation
+    import PhaseCrossCorrelation
+    import driftcache
+
+
 def main():
     #Initialise GUI
     if not QtWidgets.QApplication.instance():
@@ -427,6 +827,7 @@ def main():
     app.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
     main = MainWindow()
     main.show()
+    threading.Thread(target=preload, daemon=True).start()
     sys.exit(app.exec_())
 
 
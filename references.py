@@ -0,0 +1,70 @@
+import numpy as np
+from instrument import stage
+from registration import blur
+from translate import translate
+
+STRATEGIES = ('fixed', 'rolling', 'average')
+
+
+class ReferenceStrategy:
+
+    """
+    Decides what frames are registered against as the stack goes on. Every reference is in the same state as
+    the frames registered against it, blurred once with the same sigma, so no strategy correlates a frame
+    against a reference that has been through an extra interpolation.
+    'fixed' - the first frame for the whole stack, cheapest and exact as long as the sample doesn't change
+    'rolling' - the latest keyframe as it is, its absolute shift is carried as an offset that is added to every
+    shift found against it, so the chain accumulates shifts rather than resampling images
+    'average' - a running average of the keyframes shifted back into the first frame's position and blurred
+    again, less noisy than a single frame
+    :param strategy: one of STRATEGIES
+    :param weight: weight of the newest keyframe in the running average
+    :param sigma: blur applied to every frame before registration
+    :param precision: float dtype frames are blurred into, 'float32' or 'float64'
+    """
+
+    def __init__(self, strategy='rolling', weight=0.3, sigma=2, precision='float32'):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"strategy must be one of {STRATEGIES}, not {strategy!r}")
+        self.strategy = strategy
+        self.weight = weight
+        self.sigma = sigma
+        self.dtype = np.dtype(precision)
+        self.template = None
+
+    @property
+    def updates(self):
+        """ Whether keyframes change the reference """
+        return self.strategy != 'fixed'
+
+    def blur(self, image, out=None):
+        with stage('blur'):
+            return blur(image, self.sigma, out, self.dtype)
+
+    def start(self, image):
+        """
+        First reference of the stack
+        :param image: raw first frame
+        :return: refimage - blurred reference
+        offset - (y, x) shift added to shifts found against it
+        """
+        self.template = self.blur(image)
+        return self.template, np.zeros(2)
+
+    def advance(self, image, blurred, shift):
+        """
+        Next reference once a keyframe has been registered
+        :param image: raw keyframe
+        :param blurred: the keyframe as it was registered
+        :param shift: absolute (y, x) shift of the keyframe
+        :return: refimage, offset as for start
+        """
+        if self.strategy == 'rolling':
+            return blurred, np.asarray(shift, dtype=float)
+        if self.strategy == 'average':
+            aligned = self.blur(translate(image, [shift[1] * -1, shift[0] * -1]))
+            if image.dtype.kind in 'ui':
+                # translate has already turned the frame into floats, scale it like the integer frames
+                aligned *= 1 / np.iinfo(image.dtype).max
+            self.template = ((1 - self.weight) * self.template + self.weight * aligned).astype(self.dtype)
+        return self.template, np.zeros(2)
@@ -0,0 +1,325 @@
+import contextlib
+import numpy as np
+
+# scipy.fft, scipy.ndimage and pyFFTW are imported on first use, they make up most of the import time
+_fftw = False
+
+
+def _backend():
+    """ Use pyFFTW for scipy.fft calls when it is installed """
+    global _fftw
+    if _fftw is False:
+        try:
+            import pyfftw
+            import pyfftw.interfaces.scipy_fft as _fftw
+            pyfftw.interfaces.cache.enable()
+        except ImportError:
+            _fftw = None
+    if _fftw is not None:
+        import scipy.fft
+        return scipy.fft.set_backend(_fftw)
+    return contextlib.nullcontext()
+
+
+def blur(image, sigma=2, out=None, dtype=np.float32):
+    """
+    Gaussian blur matching skimage.filters.gaussian(image, sigma) (integer frames are scaled to [0, 1], edges
+    are extended) but computed straight into a float buffer of the chosen precision, so registering a 16 bit
+    stack never materialises a float64 copy of each frame
+    :param image: 2D frame
+    :param sigma: standard deviation of the gaussian in pixels
+    :param out: float buffer of the same shape to reuse, allocated when None
+    :param dtype: precision of the result when out is None
+    :return: blurred frame
+    """
+    from scipy import ndimage as ndi
+    image = np.asarray(image)
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    ndi.gaussian_filter(image, sigma, output=out, mode='nearest', truncate=4.0)
+    if image.dtype.kind in 'ui':
+        out *= 1 / np.iinfo(image.dtype).max
+    return out
+
+
+def spectrum(images, workers=-1):
+    """
+    Real FFT over the last two axes, so a single frame or a (n, h, w) block of frames go through one call
+    :param images: 2D frame or 3D block of frames
+    :param workers: FFT worker threads, -1 uses every core
+    :return: complex half spectrum
+    """
+    import scipy.fft
+    with _backend():
+        return scipy.fft.rfft2(images, axes=(-2, -1), workers=workers)
+
+
+def fullspectrum(half, shape):
+    """
+    Rebuilds the full 2D spectrum of a real image from its rfft2 half using Hermitian symmetry
+    :param half: output of rfft2 for a single frame
+    :param shape: (h, w) of the real frame
+    :return: complex spectrum matching fft2 of the frame
+    """
+    h, w = shape
+    rows = (-np.arange(h)) % h
+    cols = w - np.arange(half.shape[1], w)
+    return np.concatenate([half, np.conj(half[rows][:, cols])], axis=1)
+
+
+def upsampled_dft(data, region_size, upsample_factor, offsets):
+    """
+    Upsampled inverse DFT of a small region by matrix multiplication (Guizar-Sicairos et al. 2008),
+    avoids zero padding the whole spectrum by upsample_factor
+    :param data: full 2D spectrum
+    :param region_size: size of the square region to sample
+    :param upsample_factor: upsampling factor
+    :param offsets: (y, x) offset of the region
+    :return: region of the upsampled cross correlation
+    """
+    import scipy.fft
+    for n_items, offset in list(zip(data.shape, offsets))[::-1]:
+        kernel = (np.arange(region_size) - offset)[:, None] * scipy.fft.fftfreq(n_items, upsample_factor)
+        kernel = np.exp(-2j * np.pi * kernel).astype(data.dtype, copy=False)
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+class ReferenceSpectrum:
+
+    """
+    Caches the Fourier transform of a reference frame and registers moving frames against it in batches.
+    The coarse integer peak search runs on the whole batch at once, only the subpixel refinement is per frame.
+    Gives the same shifts as skimage's phase_cross_correlation of the same frames with the same normalization,
+    and of the _taper'ed frames when taper is set.
+    A (k, h, w) stack of reference tiles is registered pairwise against blocks of k moving tiles.
+    :param refimage: blurred reference frame, or stack of reference tiles
+    :param upsample_factor: subpixel precision is 1 / upsample_factor
+    :param workers: FFT worker threads, -1 uses every core
+    :param normalization: 'phase' for phase correlation, None for plain cross correlation
+    :param taper: taper the reference and every frame with _taper before correlating them
+    """
+
+    def __init__(self, refimage, upsample_factor=100, workers=-1, normalization='phase', taper=False):
+        self.shape = refimage.shape[-2:]
+        self.upsample_factor = upsample_factor
+        self.workers = workers
+        self.normalization = normalization
+        self.taper = taper
+        self.spectrum = spectrum(_taper(refimage) if taper else refimage, workers)
+
+    def register(self, frames):
+        """
+        Subpixel registration of one frame or a block of frames against the reference
+        :param frames: 2D frame or (n, h, w) block of frames
+        :return: (y, x) shift, or (n, 2) array of shifts for a block
+        """
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        if single:
+            frames = frames[np.newaxis]
+        if self.taper:
+            frames = _taper(frames)
+        product = self.spectrum * np.conj(spectrum(frames, self.workers))
+        if self.normalization == 'phase':
+            eps = np.finfo(product.real.dtype).eps
+            product /= np.maximum(np.abs(product), 100 * eps)
+        import scipy.fft
+        with _backend():
+            crosscorrelation = scipy.fft.irfft2(product, s=self.shape, axes=(-2, -1), workers=self.workers)
+
+        # Whole pixel shifts for the full batch
+        peaks = np.abs(crosscorrelation).reshape(len(frames), -1).argmax(axis=1)
+        shifts = np.stack(np.unravel_index(peaks, self.shape), axis=1).astype(product.real.dtype)
+        size = np.array(self.shape)
+        midpoint = np.trunc(size / 2)
+        shifts = np.where(shifts > midpoint, shifts - size, shifts)
+
+        for i in range(len(frames) if self.upsample_factor > 1 else 0):
+            shifts[i] = self._refine(product[i], shifts[i])
+        return shifts[0] if single else shifts
+
+    def _refine(self, product, shift):
+        upsample_factor = self.upsample_factor
+        shift = np.round(shift * upsample_factor) / upsample_factor
+        region_size = np.ceil(upsample_factor * 1.5)
+        dftshift = np.trunc(region_size / 2.0)
+        offsets = dftshift - shift * upsample_factor
+        crosscorrelation = upsampled_dft(np.conj(fullspectrum(product, self.shape)), int(region_size),
+                                         upsample_factor, offsets)
+        maxima = np.unravel_index(np.argmax(np.abs(crosscorrelation)), crosscorrelation.shape)
+        return shift + (np.stack(maxima) - dftshift) / upsample_factor
+
+
+def downsample(image, factor):
+    """
+    Block mean downsampling over the last two axes, trailing rows/columns that don't fill a block are dropped
+    :param image: 2D frame or (n, h, w) block of frames
+    :param factor: integer downsampling factor
+    :return: downsampled frame(s)
+    """
+    h, w = image.shape[-2] // factor, image.shape[-1] // factor
+    image = image[..., :h * factor, :w * factor]
+    return image.reshape(image.shape[:-2] + (h, factor, w, factor)).mean(axis=(-3, -1))
+
+
+class PyramidReference:
+
+    """
+    Coarse-to-fine registration for large frames. The integer shift is found on frames downsampled by
+    2 ** depth, then refined to subpixel precision on a crop x crop window around the predicted position at
+    full resolution, so the expensive upsampled correlation never touches the whole frame.
+    The windows are tapered with a Hann window and cross correlated without phase normalisation, otherwise
+    their hard edges pull the subpixel estimate back towards the integer prediction.
+    :param refimage: blurred reference frame
+    :param depth: number of 2x pyramid levels
+    :param crop: size of the full resolution window used for the subpixel refinement
+    :param upsample_factor: subpixel precision is 1 / upsample_factor
+    :param workers: FFT worker threads, -1 uses every core
+    """
+
+    def __init__(self, refimage, depth=2, crop=512, upsample_factor=100, workers=-1):
+        self.refimage = refimage
+        self.factor = 2 ** depth
+        self.crop = crop
+        self.upsample_factor = upsample_factor
+        self.workers = workers
+        self.coarse = ReferenceSpectrum(downsample(refimage, self.factor), upsample_factor=1, workers=workers)
+        self._fine = {}
+
+    def _window(self, predicted):
+        # The moving frame is offset by -predicted relative to the reference. Centre the window in the
+        # reference, slide it back inside both frames when the drift would push it over an edge and shrink
+        # it when the frames are too small for the full crop.
+        origin, size = [], []
+        for axis in range(2):
+            length = self.refimage.shape[axis]
+            crop = min(self.crop, length - abs(int(predicted[axis])))
+            low = max(0, int(predicted[axis]))
+            high = min(length, length + int(predicted[axis])) - crop
+            origin.append(int(np.clip((length - crop) // 2, low, high)))
+            size.append(crop)
+        return tuple(origin), tuple(size)
+
+    def _reference(self, origin, size):
+        if (origin, size) not in self._fine:
+            window = self.refimage[origin[0]:origin[0] + size[0], origin[1]:origin[1] + size[1]]
+            self._fine[(origin, size)] = ReferenceSpectrum(_taper(window), self.upsample_factor, self.workers,
+                                                           normalization=None)
+        return self._fine[(origin, size)]
+
+    def register(self, frames):
+        """
+        Subpixel registration of one frame or a block of frames against the reference
+        :param frames: 2D frame or (n, h, w) block of frames
+        :return: (y, x) shift, or (n, 2) array of shifts for a block
+        """
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        if single:
+            frames = frames[np.newaxis]
+        predicted = np.round(self.coarse.register(downsample(frames, self.factor)) * self.factor).astype(int)
+        shifts = np.empty((len(frames), 2))
+        for i, frame in enumerate(frames):
+            origin, size = self._window(predicted[i])
+            y, x = origin[0] - predicted[i][0], origin[1] - predicted[i][1]
+            window = frame[y:y + size[0], x:x + size[1]]
+            shifts[i] = predicted[i] + self._reference(origin, size).register(_taper(window))
+        return shifts[0] if single else shifts
+
+
+def _taper(window):
+    """
+    Mean removed and a Hann window applied over the last two axes. Frames cropped from a larger field of view
+    don't wrap around, and the step at their edges is the same in every frame: left in, it correlates at zero
+    shift more strongly than the blurred content does at the true one.
+    """
+    window = np.asarray(window)
+    hann = np.outer(np.hanning(window.shape[-2]), np.hanning(window.shape[-1]))
+    return (window - window.mean(axis=(-2, -1), keepdims=True)) * hann
+
+
+def choosetiles(refimage, ntiles=9, size=256):
+    """
+    Picks the most textured tiles of a frame from a grid of non overlapping candidates, so flat background
+    and featureless regions don't take part in the registration
+    :param refimage: blurred reference frame
+    :param ntiles: number of tiles to choose
+    :param size: tile edge length
+    :return: list of (row, col) tile origins
+    """
+    gy, gx = np.gradient(refimage.astype(np.float32))
+    energy = gy ** 2 + gx ** 2
+    rows, cols = refimage.shape[0] // size, refimage.shape[1] // size
+    energy = energy[:rows * size, :cols * size].reshape(rows, size, cols, size).sum(axis=(1, 3))
+    best = np.argsort(energy, axis=None)[::-1][:ntiles]
+    return [(int(row) * size, int(col) * size) for row, col in zip(*np.unravel_index(best, energy.shape))]
+
+
+class TiledReference:
+
+    """
+    Registers a set of tiles instead of the whole frame and combines their shifts robustly, so parts of the
+    field of view that move by themselves (cells in DIC data) don't drag the drift estimate along.
+    Every tile of a frame goes through one batched FFT. Like the pyramid windows, the tiles are tapered and
+    cross correlated without phase normalisation so their edges don't bias the subpixel estimate.
+    Drift larger than half a tile can't be recovered.
+    :param refimage: blurred reference frame
+    :param tiles: list of (row, col) tile origins, or the number of tiles to choose automatically
+    :param size: tile edge length
+    :param aggregate: 'median' for the per axis median of the tile shifts, 'consensus' for the mean of the
+    largest group of tiles that agree to within tolerance
+    :param tolerance: pixels two tile shifts may differ by and still agree
+    :param upsample_factor: subpixel precision is 1 / upsample_factor
+    :param workers: FFT worker threads, -1 uses every core
+    """
+
+    def __init__(self, refimage, tiles=9, size=256, aggregate='consensus', tolerance=0.5, upsample_factor=100,
+                 workers=-1):
+        if aggregate not in ('median', 'consensus'):
+            raise ValueError(f"aggregate must be 'median' or 'consensus', not {aggregate!r}")
+        self.size = min(size, *refimage.shape)
+        self.tiles = choosetiles(refimage, tiles, self.size) if isinstance(tiles, int) else \
+            [tuple(tile) for tile in tiles]
+        self.aggregate = aggregate
+        self.tolerance = tolerance
+        self.reference = ReferenceSpectrum(self.cut(refimage), upsample_factor, workers, normalization=None)
+
+    def cut(self, frame):
+        """ (k, size, size) stack of the tapered tiles of a frame """
+        return np.stack([_taper(frame[row:row + self.size, col:col + self.size]) for row, col in self.tiles])
+
+    def field(self, frames):
+        """
+        Shift of every tile
+        :param frames: 2D frame or (n, h, w) block of frames
+        :return: (k, 2) array of (y, x) tile shifts, or (n, k, 2) for a block
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            return self.reference.register(self.cut(frames))
+        return np.stack([self.reference.register(self.cut(frame)) for frame in frames])
+
+    def combine(self, field):
+        """
+        Robust drift from the tile shifts of one frame
+        :param field: (k, 2) tile shifts
+        :return: (y, x) shift
+        """
+        if self.aggregate == 'median':
+            return np.median(field, axis=0)
+        # Every tile is a candidate, the one most other tiles agree with wins
+        distance = np.linalg.norm(field[:, np.newaxis] - field[np.newaxis], axis=-1)
+        inliers = distance <= self.tolerance
+        return field[inliers[inliers.sum(axis=1).argmax()]].mean(axis=0)
+
+    def register(self, frames):
+        """
+        Subpixel registration of one frame or a block of frames against the reference
+        :param frames: 2D frame or (n, h, w) block of frames
+        :return: (y, x) shift, or (n, 2) array of shifts for a block
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            return self.combine(self.field(frames))
+        return np.stack([self.combine(field) for field in self.field(frames)])
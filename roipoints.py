@@ -0,0 +1,112 @@
+import os
+import numpy as np
+from driftmodel import fitmodel
+
+
+class PointStore:
+
+    """
+    Manually placed ROI points held in numpy arrays with an index from frame to rows, so drawing the points of a
+    frame is a dictionary lookup rather than a scan of every point, and the drift fit works on whole arrays.
+    Rows are kept in the order they were added.
+    """
+
+    def __init__(self):
+        self.points = np.empty((0, 3))
+        self.count = 0
+        self.byframe = {}
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def frames(self):
+        return self.points[:self.count, 0].astype(int)
+
+    @property
+    def xy(self):
+        return self.points[:self.count, 1:]
+
+    def add(self, frame, x, y):
+        if self.count == len(self.points):
+            # Grow geometrically so adding points stays cheap
+            grown = np.empty((max(16, 2 * len(self.points)), 3))
+            grown[:self.count] = self.points[:self.count]
+            self.points = grown
+        self.points[self.count] = (frame, x, y)
+        self.byframe.setdefault(int(frame), []).append(self.count)
+        self.count += 1
+
+    def extend(self, points):
+        """
+        Adds many points at once
+        :param points: (n, 3) array of frame, x, y
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.points = np.concatenate([self.points[:self.count], points])
+        self.count = len(self.points)
+        self._reindex()
+
+    def removelast(self):
+        if self.count == 0:
+            return
+        self.count -= 1
+        rows = self.byframe[int(self.points[self.count, 0])]
+        rows.pop()
+        if not rows:
+            del self.byframe[int(self.points[self.count, 0])]
+
+    def clear(self):
+        self.count = 0
+        self.byframe = {}
+
+    def _reindex(self):
+        self.byframe = {}
+        for row, frame in enumerate(self.frames):
+            self.byframe.setdefault(int(frame), []).append(row)
+
+    def inframe(self, frame):
+        """
+        :return: (n, 2) array of the x, y positions of the points placed on frame
+        """
+        return self.points[self.byframe.get(frame, []), 1:]
+
+    def drift(self, nfiles, smoothing=None, model='spline'):
+        """
+        Drift of the tracked object relative to the first point placed, x and y fitted together
+        :param nfiles: number of frames to evaluate the drift for
+        :param smoothing: How much smoothing to apply, None chooses it by cross-validation
+        :param model: 'spline', 'polynomial' or 'robust', see driftmodel.fitmodel
+        :return: t, x, y - the points sorted by frame, relative to the first
+        usx, usy - the two components of the fitted driftmodel.DriftModel
+        smoothx, smoothy - the drift evaluated for every frame
+        """
+        points = self.points[:self.count]
+        t = points[:, 0]
+        x = points[:, 1] - points[0, 1]
+        y = points[:, 2] - points[0, 2]
+        order = np.lexsort((y, x, t))
+        t, x, y = t[order], x[order], y[order]
+        fitted = fitmodel(t, np.column_stack([x, y]), model, smoothing)
+        smooth = fitted(np.arange(nfiles))
+        return t, x, y, fitted.axis(0), fitted.axis(1), smooth[:, 0], smooth[:, 1]
+
+    def save(self, filename):
+        """ Writes the points as a .npy array or, for any other extension, a csv of frame, x, y """
+        points = self.points[:self.count]
+        if os.path.splitext(filename)[1].lower() == '.npy':
+            np.save(filename, points)
+        else:
+            np.savetxt(filename, points, delimiter=',', fmt=['%d', '%.2f', '%.2f'], header='frame,x,y',
+                       comments='')
+
+    @classmethod
+    def load(cls, filename):
+        """ Reads points written by save """
+        if os.path.splitext(filename)[1].lower() == '.npy':
+            points = np.load(filename)
+        else:
+            points = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+        store = cls()
+        store.extend(points)
+        return store
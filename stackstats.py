@@ -0,0 +1,167 @@
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from jobs import checkpoint
+
+# Percentile levels recorded unless others are asked for
+LEVELS = (0.5, 99.5)
+
+
+class StackStatistics:
+
+    """
+    Per frame intensity statistics of a stack, computed once and stored in a sidecar file next to the tiff,
+    the image sequence or inside the chunked store
+    so autocontrast is a table lookup rather than a reduction over every displayed frame.
+    Histograms have bins evenly spaced between each frame's own minimum and maximum.
+    :param minimum: (nfiles,) per frame minimum
+    :param maximum: (nfiles,) per frame maximum
+    :param percentiles: (nfiles, len(levels)) per frame percentiles
+    :param levels: the percentile levels, e.g. (0.5, 99.5)
+    :param histograms: (nfiles, bins) per frame histogram counts
+    """
+
+    def __init__(self, minimum, maximum, percentiles, levels, histograms):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentiles = percentiles
+        self.levels = tuple(float(level) for level in levels)
+        self.histograms = histograms
+
+    @classmethod
+    def compute(cls, tf, levels=LEVELS, bins=256, chunk=8, workers=None, cancel=None):
+        """
+        Single pass over the stack, chunks of frames are reduced together and in parallel
+        :param tf: stack of tiff images encapsulated in the tiffstack class
+        :param levels: percentile levels to record
+        :param bins: number of histogram bins per frame
+        :param chunk: frames reduced together in one vectorized call
+        :param workers: threads to reduce chunks with, None uses every core
+        :param cancel: threading.Event, raises jobs.Cancelled once it is set
+        :return: StackStatistics
+        """
+        def reduce(start):
+            checkpoint(cancel)
+            frames = tf.getimages(start, start + chunk).reshape(-1, tf.width * tf.height)
+            minimum = frames.min(axis=1)
+            maximum = frames.max(axis=1)
+            percentiles = np.percentile(frames, levels, axis=1).T
+            # One bincount for the whole chunk, each frame's bins offset by its row. Offsets from the minimum
+            # are taken in float, in the frame dtype they wrap around for signed data
+            lower = minimum.astype(np.float64)
+            scale = bins / np.maximum(maximum - lower, 1e-12)
+            index = ((frames - lower[:, np.newaxis]) * scale[:, np.newaxis]).astype(np.int32)
+            np.clip(index, 0, bins - 1, out=index)
+            index += np.arange(len(frames))[:, np.newaxis] * bins
+            histograms = np.bincount(index.ravel(), minlength=len(frames) * bins).reshape(len(frames), bins)
+            return minimum, maximum, percentiles, histograms
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            results = list(pool.map(reduce, range(0, tf.nfiles, chunk)))
+        minimum, maximum, percentiles, histograms = (np.concatenate(arrays) for arrays in zip(*results))
+        return cls(minimum, maximum, percentiles, levels, histograms)
+
+    def limits(self, index=None, mode='frame', level=None):
+        """
+        Contrast limits for displaying a frame
+        :param index: frame being displayed
+        :param mode: 'frame' for the frame's own limits, 'global' for limits over the whole stack
+        :param level: index into levels to use percentile limits, None uses the minimum and maximum
+        :return: (lower, upper)
+        """
+        if level is None:
+            lower, upper = self.minimum, self.maximum
+        else:
+            lower, upper = self.percentiles[:, level], self.percentiles[:, -1 - level]
+        if mode == 'global':
+            return lower.min(), upper.max()
+        if mode == 'frame':
+            return lower[index], upper[index]
+        raise ValueError(f"mode must be 'frame' or 'global', not {mode!r}")
+
+    def save(self, filename, source):
+        """
+        Writes the statistics to an npz sidecar, tagged with the size and modification time of source
+        :param source: file, or list of files, the statistics were computed from, see stamp
+        """
+        np.savez(filename, minimum=self.minimum, maximum=self.maximum, percentiles=self.percentiles,
+                 levels=self.levels, histograms=self.histograms, source=stamp(source))
+
+    @classmethod
+    def load(cls, filename, source, levels, bins):
+        """
+        Reads a sidecar written by save
+        :return: StackStatistics, or None when the sidecar is missing, stale or recorded different settings
+        """
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as data:
+            if list(data['source']) != stamp(source) or \
+                    tuple(data['levels']) != tuple(float(level) for level in levels) or \
+                    data['histograms'].shape[1] != bins:
+                return None
+            return cls(data['minimum'], data['maximum'], data['percentiles'], data['levels'], data['histograms'])
+
+
+def stamp(source):
+    """
+    Number, total size and latest modification time of the files, which change whenever any of them is
+    rewritten
+    :param source: file or list of files
+    :return: list of ints
+    """
+    infos = [os.stat(filename) for filename in ([source] if isinstance(source, str) else source)]
+    return [len(infos), sum(info.st_size for info in infos), max(info.st_mtime_ns for info in infos)]
+
+
+def sidecar(pathname, label=''):
+    """ Name of the statistics file stored next to a stack, label tells apart positions and channels """
+    return pathname + label + '.stats.npz'
+
+
+def sidecarfor(tf):
+    """
+    Where the statistics of a stack are kept and the files they are checked against
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :return: sidecar filename, source for StackStatistics.save, or None, None when the stack has no sidecar
+    """
+    label = getattr(tf, 'label', '')
+    if label is None:
+        return None, None
+    if getattr(tf, 'store', None) is not None:
+        # Inside the store, which is rewritten as a whole with a new .zattrs
+        return os.path.join(tf.store.path, 'stats' + label + '.npz'), os.path.join(tf.store.path, '.zattrs')
+    if getattr(tf, 'files', None) is not None:
+        # Next to the sequence directory, or its first file for a pattern or list of files
+        if isinstance(tf.pathname, str) and os.path.isdir(tf.pathname):
+            return sidecar(tf.pathname.rstrip(os.sep), label), tf.files
+        return sidecar(os.path.splitext(tf.files[0])[0] + '.sequence', label), tf.files
+    if isinstance(tf.pathname, str) and os.path.isfile(tf.pathname):
+        return sidecar(tf.pathname, label), tf.pathname
+    return None, None
+
+
+def stackstatistics(tf, levels=LEVELS, bins=256, cache=True, **options):
+    """
+    Statistics of a stack, read from its sidecar when it is up to date and computed (and saved) otherwise
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param levels: percentile levels to record
+    :param bins: number of histogram bins per frame
+    :param cache: read and write the sidecar file
+    :param options: passed on to StackStatistics.compute
+    :return: StackStatistics
+    """
+    filename, source = sidecarfor(tf) if cache else (None, None)
+    if filename is not None:
+        statistics = StackStatistics.load(filename, source, levels, bins)
+        if statistics is not None:
+            return statistics
+    statistics = StackStatistics.compute(tf, levels, bins, **options)
+    if filename is not None:
+        try:
+            statistics.save(filename, source)
+        except OSError:
+            # Read only location, the statistics are still usable for this session
+            pass
+    return statistics
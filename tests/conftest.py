@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+import tifffile
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def stackfile(tmp_path):
+    """ Small uint16 stack with known drift written as one contiguous multipage tiff, and its drift """
+    from benchmark import synthetic_stack
+    frames, drift = synthetic_stack(24, 96, step=0.6)
+    pathname = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(pathname, frames)
+    return pathname, drift
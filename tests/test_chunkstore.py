@@ -0,0 +1,40 @@
+import os
+import threading
+import numpy as np
+import pytest
+import tifffile
+import chunkstore
+from jobs import Cancelled
+from tiffstack import tiffstack
+
+
+def test_round_trip(stackfile, tmp_path):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    store = chunkstore.convert(tf, str(tmp_path / 'stack.zarr'), chunks=(2, 32, 32))
+    np.testing.assert_array_equal(store.levels[0].read(0, tf.nfiles), tf.getimages(0, tf.nfiles))
+    assert chunkstore.isstore(store.path) and len(store.levels) == 3
+    tf.close()
+
+
+def test_cancelled_store_is_removed(stackfile, tmp_path):
+    pathname, _ = stackfile
+    cancel = threading.Event()
+    cancel.set()
+    path = str(tmp_path / 'stack.zarr')
+    with pytest.raises(Cancelled):
+        chunkstore.convert(tiffstack(pathname), path, cancel=cancel)
+    assert not os.path.exists(path)
+
+
+def test_refuses_channels(tmp_path):
+    pathname = str(tmp_path / 'channels.tif')
+    data = np.random.default_rng(0).integers(0, 4000, (4, 2, 32, 32), dtype=np.uint16)
+    tifffile.imwrite(pathname, data, imagej=True, metadata={'axes': 'TCYX'})
+    tf = tiffstack(pathname)
+    corrected = tf.setdrift(np.zeros((4, 2)))
+    path = str(tmp_path / 'channels.zarr')
+    with pytest.raises(ValueError, match='2 channels'):
+        corrected.savedriftcorrected(path)
+    assert not os.path.exists(path)
+    tf.close()
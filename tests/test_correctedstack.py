@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import tifffile
+from PhaseCrossCorrelation import PCC, correctiontranslations
+from tiffstack import tiffstack
+from writer import savedriftcorrected
+
+
+@pytest.fixture
+def corrected(stackfile):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    drift_total, usx, usy = PCC(tf, update=5)
+    yield tf, tf.setdrift(correctiontranslations(usx, usy, tf.nfiles))
+    tf.close()
+
+
+def test_matches_written_tiff(corrected, tmp_path):
+    tf, view = corrected
+    outname = str(tmp_path / 'corrected.tif')
+    savedriftcorrected(tf, outname, view.translations)
+    written = tifffile.imread(outname)
+    np.testing.assert_array_equal(view.getimages(0, tf.nfiles), written)
+    for index in (0, 7, tf.nfiles - 1):
+        np.testing.assert_array_equal(view.getimage(index), written[index])
+        np.testing.assert_array_equal(tf.getcorrected(index), written[index])
+    # Written through the view, the copy is the same file
+    view.savedriftcorrected(str(tmp_path / 'view.tif'))
+    np.testing.assert_array_equal(tifffile.imread(str(tmp_path / 'view.tif')), written)
+
+
+def test_indexing(corrected):
+    tf, view = corrected
+    assert len(view) == tf.nfiles and view.dtype == tf.dtype
+    np.testing.assert_array_equal(view[-1], view.getimage(tf.nfiles - 1))
+    np.testing.assert_array_equal(view[2:9:3], view.getimages(2, 9)[::3])
+    with pytest.raises(IndexError):
+        view[tf.nfiles]
+
+
+def test_translations_must_match(corrected):
+    tf, view = corrected
+    with pytest.raises(ValueError):
+        tf.setdrift(np.zeros((tf.nfiles - 1, 2)))
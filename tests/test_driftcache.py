@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import tifffile
+import PhaseCrossCorrelation
+from driftcache import DriftCache, cachedPCC
+from tiffstack import tiffstack
+
+
+def test_hit_and_refit(stackfile, tmp_path, monkeypatch):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    cache = DriftCache(str(tmp_path / 'cache'))
+    expected, _, _ = cachedPCC(tf, 5, cache=cache)
+    assert len(os.listdir(cache.directory)) == 1
+
+    def register(*args, **kwargs):
+        raise AssertionError('registered again')
+
+    # Same stack and registration settings: nothing is registered, other models and smoothings are refitted
+    monkeypatch.setattr('driftcache.PCC', register)
+    drift_total, usx, usy = cachedPCC(tf, 5, cache=cache)
+    np.testing.assert_array_equal(drift_total, expected)
+    drift_total, usx, usy = cachedPCC(tf, 5, smoothing=2, cache=cache, model='polynomial')
+    fitted = PhaseCrossCorrelation.fitdrift(expected, 2, 'polynomial')
+    t = np.arange(len(expected))
+    np.testing.assert_allclose(usx(t), fitted[0](t))
+    np.testing.assert_allclose(usy(t), fitted[1](t))
+    tf.close()
+
+
+def test_key(stackfile, tmp_path):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    cache = DriftCache(str(tmp_path / 'cache'))
+    key = cache.key(tf, 5)
+    # Content, not the name, identifies the stack
+    copy = str(tmp_path / 'copy.tif')
+    tifffile.imwrite(copy, tf.getimages(0, tf.nfiles))
+    assert cache.key(tiffstack(copy), 5) == key
+    # Settings that change the shifts change the key, the crop only matters with a pyramid
+    assert cache.key(tf, 5, batch=4) != key
+    assert cache.key(tf, 5, taper=False) != key
+    assert cache.key(tf, 5, crop=128) == key
+    assert cache.key(tf, 5, pyramid=1, crop=128) != cache.key(tf, 5, pyramid=1)
+    tf.close()
+
+
+def test_eviction(tmp_path):
+    cache = DriftCache(str(tmp_path / 'cache'))
+    drift = np.zeros((200, 2))
+    cache.save('a', drift)
+    # Room for four entries
+    cache.size = 4.5 * os.path.getsize(cache.filename('a'))
+    for i, key in enumerate('abcd'):
+        cache.save(key, drift)
+        os.utime(cache.filename(key), (i, i))
+    # Loading refreshes an entry, so the oldest untouched ones go first
+    assert cache.load('a') is not None
+    cache.save('e', drift)
+    kept = sorted(name[0] for name in os.listdir(cache.directory))
+    assert 'a' in kept and 'e' in kept and 'b' not in kept
+    assert sum(os.path.getsize(cache.filename(key)) for key in kept) <= cache.size
+    assert cache.load('b') is None
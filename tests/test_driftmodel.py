@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from driftmodel import MODELS, fitmodel
+
+
+@pytest.fixture(scope='module')
+def drift():
+    # A smooth drift measured with noise on every frame
+    t = np.arange(200)
+    truth = np.column_stack([5 * np.sin(t / 40), 0.03 * t + np.cos(t / 25)])
+    return t, truth, truth + np.random.default_rng(0).normal(0, 0.3, truth.shape)
+
+
+@pytest.mark.parametrize('model', MODELS)
+def test_follows_the_drift(drift, model):
+    t, truth, measured = drift
+    fitted = fitmodel(t, measured, model)
+    # Cross-validation smooths away most of the noise without flattening the drift
+    assert np.sqrt(np.mean((fitted(t) - truth) ** 2)) < 0.12
+    np.testing.assert_allclose(fitted.axis(1)(t), fitted(t)[:, 1])
+    assert fitted(np.arange(5, 8)).shape == (3, 2)
+
+
+def test_smoothing(drift):
+    t, truth, measured = drift
+    line = fitmodel(t, measured, 'polynomial', smoothing=1)
+    assert line.smoothing == 1
+    np.testing.assert_allclose(np.diff(line(t), 2, axis=0), 0, atol=1e-9)
+    # A heavier penalty gives a smoother spline
+    rough, smooth = fitmodel(t, measured, smoothing=1e-2), fitmodel(t, measured, smoothing=1e4)
+    assert np.abs(np.diff(smooth(t), 2, axis=0)).sum() < np.abs(np.diff(rough(t), 2, axis=0)).sum()
+
+
+def test_robust_rejects_failed_registrations(drift):
+    t, truth, measured = drift
+    failed = measured.copy()
+    bad = [20, 75, 76, 150]
+    failed[bad] = 0
+    robust = fitmodel(t, failed, 'robust')
+    assert set(bad) <= set(np.flatnonzero(robust.outliers))
+    assert np.sqrt(np.mean((robust(t) - truth) ** 2)) < 0.12
+    assert np.sqrt(np.mean((fitmodel(t, failed)(t) - truth) ** 2)) > 0.12
+
+
+def test_few_points():
+    assert fitmodel([0, 1], [[0, 0], [1, 2]])(2) == pytest.approx([2, 4])
+    with pytest.raises(ValueError):
+        fitmodel(np.arange(10), np.zeros((10, 2)), 'lowess')
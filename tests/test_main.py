@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import pytest
+import tifffile
+from chunkstore import MultiscaleStore
+from main import process
+
+
+def test_store(stackfile, tmp_path):
+    pathname, _ = stackfile
+    result = process(pathname, outdir=str(tmp_path), cache=False, store=True)
+    store = MultiscaleStore(str(tmp_path / 'stackDC.zarr'))
+    assert result['frames'] == 24
+    assert store.shape == (24, 96, 96)
+
+
+def test_store_rejects_channels(tmp_path):
+    from benchmark import synthetic_stack
+    frames, _ = synthetic_stack(12, 64, step=1)
+    pathname = str(tmp_path / 'channels.tif')
+    tifffile.imwrite(pathname, np.stack([frames, frames], axis=1), imagej=True, metadata={'axes': 'TCYX'})
+    with pytest.raises(ValueError, match='2 channels'):
+        process(pathname, outdir=str(tmp_path), cache=False, store=True)
+    assert not os.path.exists(tmp_path / 'channels_drift.csv')
+
+
+def test_mismatched_sequence(tmp_path):
+    from benchmark import synthetic_stack
+    frames, _ = synthetic_stack(6, 64, step=1)
+    directory = tmp_path / 'sequence'
+    directory.mkdir()
+    for i, frame in enumerate(frames):
+        tifffile.imwrite(str(directory / f'frame_{i}.tif'), frame if i != 3 else frame[:32])
+    with pytest.raises(ValueError, match='1 files differ'):
+        process(str(directory), outdir=str(tmp_path), cache=False)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from PhaseCrossCorrelation import PCC, OnlinePCC
+from tiffstack import followstack, tiffstack
+
+
+@pytest.mark.parametrize('strategy', ['fixed', 'rolling', 'average'])
+@pytest.mark.parametrize('batch', [None, 4])
+def test_matches_pcc(stackfile, strategy, batch):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    expected, _, _ = PCC(tf, update=5, strategy=strategy, batch=batch)
+    online = OnlinePCC(update=5, strategy=strategy, batch=batch)
+    shifts = [shift for shift, smoothed in online.run(tf.getimage(index) for index in range(tf.nfiles))]
+    # The first frame is the reference
+    np.testing.assert_array_equal(shifts[0], [0, 0])
+    np.testing.assert_allclose(np.array(shifts[1:]), np.array(expected), atol=1e-6)
+    tf.close()
+
+
+def test_window_and_final_fit(stackfile):
+    pathname, drift = stackfile
+    online = OnlinePCC(update=5, window=10)
+    results = list(online.run(followstack(pathname, poll=0.01, timeout=0)))
+    drift_total, usx, usy = online.splines()
+    assert len(results) == 24 and len(drift_total) == 23
+    # The smoothed estimate follows the drift, the final fit is the one PCC makes of the whole history
+    smoothed = np.array([smoothed for shift, smoothed in results[1:]])
+    assert np.sqrt(np.mean((smoothed + drift[1:]) ** 2)) < 0.5
+    tf = tiffstack(pathname)
+    _, pccx, pccy = PCC(tf, update=5)
+    t = np.arange(23)
+    np.testing.assert_allclose(usx(t), pccx(t), atol=1e-6)
+    np.testing.assert_allclose(usy(t), pccy(t), atol=1e-6)
+    tf.close()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import tifffile
+from PhaseCrossCorrelation import PCC
+from tiffstack import tiffstack
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+@pytest.mark.parametrize('batch', [None, 4])
+def test_parallel_matches_serial(stackfile, backend, batch):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    serial, _, _ = PCC(tf, update=5, batch=batch)
+    parallel, _, _ = PCC(tf, update=5, batch=batch, workers=2, backend=backend)
+    np.testing.assert_array_equal(np.array(parallel), np.array(serial))
+    tf.close()
+
+
+@pytest.mark.parametrize('batch', [None, 8])
+def test_recovers_drift(stackfile, batch):
+    # The edges of the frames don't move with the drift, untapered they pull the shifts towards zero
+    pathname, drift = stackfile
+    tf = tiffstack(pathname)
+    drift_total, _, _ = PCC(tf, update=5, batch=batch)
+    assert np.sqrt(np.mean((np.array(drift_total) + drift[1:]) ** 2)) < 0.2
+    tf.close()
+
+
+def test_pyramid_recovers_drift(stackfile):
+    pathname, drift = stackfile
+    tf = tiffstack(pathname)
+    drift_total, _, _ = PCC(tf, update=5, pyramid=1, crop=64)
+    assert np.sqrt(np.mean((np.array(drift_total) + drift[1:]) ** 2)) < 0.2
+    tf.close()
+
+
+def test_untapered_is_skimage_phase_correlation(stackfile):
+    from skimage.registration import phase_cross_correlation
+    from registration import blur
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    drift_total, _, _ = PCC(tf, strategy='fixed', taper=False)
+    refimage = blur(tf.getimage(0))
+    expected = [phase_cross_correlation(refimage, blur(tf.getimage(index)), upsample_factor=100)[0]
+                for index in range(1, tf.nfiles)]
+    np.testing.assert_allclose(np.array(drift_total), np.array(expected), atol=1e-6)
+    tf.close()
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_parallel_reads_selected_position_and_channel(tmp_path, backend):
+    from benchmark import synthetic_stack
+    pathname = str(tmp_path / 'positions.ome.tif')
+    with tifffile.TiffWriter(pathname, ome=True) as tif:
+        for seed in (0, 1):
+            channels = [synthetic_stack(12, 64, step=1, seed=seed + 10 * c)[0] for c in range(2)]
+            tif.write(np.stack(channels, axis=1), metadata={'axes': 'TCYX'})
+    tf = tiffstack(pathname, position=1, channel=1)
+    serial, _, _ = PCC(tf, update=5)
+    parallel, _, _ = PCC(tf, update=5, workers=2, backend=backend)
+    np.testing.assert_array_equal(np.array(parallel), np.array(serial))
+    tf.close()
+
+
+@pytest.mark.parametrize('batch', [None, 4])
+def test_float32_matches_float64(stackfile, batch):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    single, _, _ = PCC(tf, update=5, batch=batch, precision='float32')
+    double, _, _ = PCC(tf, update=5, batch=batch, precision='float64')
+    np.testing.assert_allclose(np.array(single), np.array(double), atol=0.02)
+    tf.close()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import tifffile
+from benchmark import synthetic_stack
+from PhaseCrossCorrelation import PCC
+from references import STRATEGIES, ReferenceStrategy
+from registration import blur
+from tiffstack import tiffstack
+
+
+@pytest.fixture(scope='module')
+def frames():
+    return synthetic_stack(3, 96, step=2)
+
+
+def test_fixed(frames):
+    (first, _, _), _ = frames
+    strategy = ReferenceStrategy('fixed')
+    refimage, offset = strategy.start(first)
+    assert not strategy.updates
+    np.testing.assert_array_equal(refimage, blur(first))
+    np.testing.assert_array_equal(offset, [0, 0])
+
+
+def test_rolling_carries_the_shift(frames):
+    (first, keyframe, _), drift = frames
+    strategy = ReferenceStrategy('rolling', precision='float64')
+    strategy.start(first)
+    blurred = strategy.blur(keyframe)
+    refimage, offset = strategy.advance(keyframe, blurred, -drift[1])
+    # The keyframe as it was registered, never resampled
+    assert refimage is blurred and refimage.dtype == np.float64
+    np.testing.assert_array_equal(offset, -drift[1])
+
+
+def test_average_aligns_keyframes(frames):
+    (first, keyframe, _), drift = frames
+    strategy = ReferenceStrategy('average', weight=0.5)
+    template, _ = strategy.start(first)
+    template = template.copy()
+    refimage, offset = strategy.advance(keyframe, strategy.blur(keyframe), -drift[1])
+    np.testing.assert_array_equal(offset, [0, 0])
+    assert refimage.dtype == np.float32
+    # Shifted back into the first frame's position the keyframe matches it away from the edges
+    inside = (slice(12, -12), slice(12, -12))
+    np.testing.assert_allclose(refimage[inside], template[inside], atol=0.02 * np.ptp(template))
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        ReferenceStrategy('median')
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_recovers_drift(tmp_path, strategy):
+    frames, drift = synthetic_stack(40, 96, step=0.4)
+    pathname = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(pathname, frames)
+    tf = tiffstack(pathname)
+    drift_total, _, _ = PCC(tf, update=5, strategy=strategy)
+    assert np.sqrt(np.mean((np.array(drift_total) + drift[1:]) ** 2)) < 0.25
+    tf.close()
+
+
+def test_updates_follow_a_changing_sample(tmp_path):
+    # Almost all of the texture is replaced by the end, the first frame stops being a usable reference
+    frames, drift = synthetic_stack(60, 96, step=0.4, evolve=0.95)
+    pathname = str(tmp_path / 'evolving.tif')
+    tifffile.imwrite(pathname, frames)
+    tf = tiffstack(pathname)
+    errors = {}
+    for strategy in STRATEGIES:
+        drift_total, _, _ = PCC(tf, update=5, strategy=strategy)
+        errors[strategy] = np.sqrt(np.mean((np.array(drift_total) + drift[1:]) ** 2))
+    assert errors['rolling'] < 0.5 and errors['average'] < 0.5 and errors['fixed'] > 1
+    tf.close()
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from skimage.filters import gaussian
+from skimage.registration import phase_cross_correlation
+from benchmark import add_movers, synthetic_stack
+from registration import PyramidReference, ReferenceSpectrum, TiledReference, _taper, blur
+
+
+@pytest.fixture(scope='module')
+def frames():
+    frames, _ = synthetic_stack(6, 128, step=1.5)
+    return frames
+
+
+def test_spectrum_matches_skimage(frames):
+    refimage = gaussian(frames[0], sigma=2)
+    moving = np.array([gaussian(frame, sigma=2) for frame in frames[1:]])
+    expected = np.array([phase_cross_correlation(refimage, image, upsample_factor=100)[0] for image in moving])
+    reference = ReferenceSpectrum(refimage)
+    np.testing.assert_allclose(reference.register(moving), expected, atol=1e-6)
+    np.testing.assert_allclose(reference.register(moving[0]), expected[0], atol=1e-6)
+
+
+def test_tapered_spectrum_matches_skimage(frames):
+    refimage = gaussian(frames[0], sigma=2)
+    moving = np.array([gaussian(frame, sigma=2) for frame in frames[1:]])
+    expected = np.array([phase_cross_correlation(_taper(refimage), _taper(image), upsample_factor=100,
+                                                 normalization=None)[0] for image in moving])
+    reference = ReferenceSpectrum(refimage, normalization=None, taper=True)
+    np.testing.assert_allclose(reference.register(moving), expected, atol=1e-6)
+    # One frame at a time without an engine is the same registration
+    from PhaseCrossCorrelation import register
+    np.testing.assert_allclose(register(refimage, moving[0]), expected[0], atol=1e-6)
+
+
+def test_spectrum_registers_tile_stacks_pairwise(frames):
+    tiles = np.stack([gaussian(frames[0][:64, :64], sigma=2), gaussian(frames[0][64:, 64:], sigma=2)])
+    moving = np.stack([gaussian(frames[2][:64, :64], sigma=2), gaussian(frames[3][64:, 64:], sigma=2)])
+    expected = [phase_cross_correlation(tile, image, upsample_factor=100)[0] for tile, image in zip(tiles, moving)]
+    np.testing.assert_allclose(ReferenceSpectrum(tiles).register(moving), expected, atol=1e-6)
+
+
+def test_batched_pcc_matches_unbatched(stackfile):
+    from PhaseCrossCorrelation import PCC
+    from tiffstack import tiffstack
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    single, _, _ = PCC(tf, update=5)
+    for batch in (1, 4, 64):
+        batched, _, _ = PCC(tf, update=5, batch=batch)
+        np.testing.assert_allclose(np.array(batched), np.array(single), atol=1e-6)
+    tf.close()
+
+
+def test_blur_matches_skimage(frames):
+    np.testing.assert_allclose(blur(frames[0], dtype=np.float64), gaussian(frames[0], sigma=2), atol=1e-12)
+    np.testing.assert_allclose(blur(frames[0]), gaussian(frames[0], sigma=2), atol=1e-6)
+
+
+def rms(shifts, drift):
+    # Registering a frame against the first recovers minus its displacement
+    return np.sqrt(np.mean((np.asarray(shifts) + drift[1:]) ** 2))
+
+
+@pytest.fixture(scope='module')
+def drifting():
+    frames, drift = synthetic_stack(6, 256, step=12)
+    return blur(frames[0]), np.array([blur(frame) for frame in frames[1:]]), drift
+
+
+@pytest.mark.parametrize('depth, crop', [(1, 128), (2, 128), (2, 512)])
+def test_pyramid_recovers_known_shifts(drifting, depth, crop):
+    refimage, moving, drift = drifting
+    reference = PyramidReference(refimage, depth, crop)
+    assert rms(reference.register(moving), drift) < 0.05
+    np.testing.assert_allclose(reference.register(moving[0]), reference.register(moving)[0])
+
+
+@pytest.fixture(scope='module')
+def movers():
+    # Objects wandering across the field of view independently of the drift, as cells do in DIC data
+    frames, drift = synthetic_stack(6, 256, step=1)
+    add_movers(frames, 3, size=64, speed=3)
+    return blur(frames[0]), np.array([blur(frame) for frame in frames[1:]]), drift
+
+
+@pytest.mark.parametrize('aggregate, ntiles', [('median', 16), ('consensus', 9), ('consensus', 16)])
+def test_tiles_ignore_moving_objects(movers, aggregate, ntiles):
+    refimage, moving, drift = movers
+    reference = TiledReference(refimage, ntiles, 64, aggregate)
+    assert len(reference.tiles) == ntiles
+    assert rms(reference.register(moving), drift) < 0.1
+
+
+def test_tile_field():
+    frames, drift = synthetic_stack(6, 256, step=1)
+    refimage, moving = blur(frames[0]), np.array([blur(frame) for frame in frames[1:]])
+    tiles = [(0, 0), (64, 128), (160, 96)]
+    reference = TiledReference(refimage, tiles, 96)
+    field = reference.field(moving)
+    assert reference.tiles == tiles and field.shape == (5, 3, 2)
+    # A pure translation moves every tile alike
+    for tile in range(3):
+        assert rms(field[:, tile], drift) < 0.1
+    with pytest.raises(ValueError):
+        TiledReference(refimage, tiles, 96, aggregate='mean')
+
+
+def test_blur_into_buffer(frames):
+    buffer = np.empty(frames[0].shape, dtype=np.float32)
+    assert blur(frames[0], out=buffer) is buffer
+    assert blur(frames[0], dtype=np.float64).dtype == np.float64
+    np.testing.assert_allclose(buffer, blur(frames[0], dtype=np.float64), atol=1e-6)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from roipoints import PointStore
+
+
+@pytest.fixture
+def track():
+    # An object followed through 30 frames drifting linearly, clicked with a little jitter
+    rng = np.random.default_rng(0)
+    t = np.arange(0, 30, 2)
+    store = PointStore()
+    for frame in t:
+        store.add(frame, 50 + 0.5 * frame + rng.normal(0, 0.05), 40 - 0.25 * frame + rng.normal(0, 0.05))
+    return store
+
+
+def test_add_index_and_remove(track):
+    assert len(track) == 15
+    np.testing.assert_allclose(track.inframe(4), track.xy[[2]])
+    track.add(4, 1.0, 2.0)
+    assert len(track.inframe(4)) == 2 and len(track.inframe(5)) == 0
+    track.removelast()
+    assert len(track) == 15 and len(track.inframe(4)) == 1
+    track.clear()
+    assert len(track) == 0 and len(track.inframe(0)) == 0
+
+
+def test_drift(track):
+    t, x, y, usx, usy, smoothx, smoothy = track.drift(30, model='polynomial', smoothing=1)
+    # Relative to the first point, evaluated for every frame
+    assert x[0] == 0 and y[0] == 0 and len(smoothx) == 30
+    frames = np.arange(30)
+    np.testing.assert_allclose(smoothx, 0.5 * frames, atol=0.1)
+    np.testing.assert_allclose(smoothy, -0.25 * frames, atol=0.1)
+    np.testing.assert_allclose(usx(frames), smoothx)
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.npy'])
+def test_save_and_load(track, tmp_path, extension):
+    filename = str(tmp_path / f'points{extension}')
+    track.save(filename)
+    loaded = PointStore.load(filename)
+    np.testing.assert_array_equal(loaded.frames, track.frames)
+    # The csv keeps two decimals
+    np.testing.assert_allclose(loaded.xy, track.xy, atol=0.005 if extension == '.csv' else 0)
+    np.testing.assert_allclose(loaded.inframe(6), loaded.xy[[3]])
@@ -0,0 +1,69 @@
+import os
+import threading
+import numpy as np
+import tifffile
+import chunkstore
+from stackstats import StackStatistics, sidecarfor
+from tiffstack import tiffstack
+
+
+def frames(n=6, size=32):
+    return np.random.default_rng(0).integers(0, 4000, (n, size, size), dtype=np.uint16)
+
+
+def expected(data):
+    return data.reshape(len(data), -1).min(axis=1), data.reshape(len(data), -1).max(axis=1)
+
+
+def test_signed_histograms(tmp_path):
+    data = np.random.default_rng(0).integers(-30000, 30000, (6, 32, 32)).astype(np.int16)
+    pathname = str(tmp_path / 'signed.tif')
+    tifffile.imwrite(pathname, data)
+    statistics = StackStatistics.compute(tiffstack(pathname), bins=4)
+    np.testing.assert_array_equal(statistics.minimum, expected(data)[0])
+    for frame, histogram in zip(data, statistics.histograms):
+        np.testing.assert_array_equal(histogram, np.histogram(frame, 4, (frame.min(), frame.max()))[0])
+
+
+def test_sequence_sidecar(tmp_path):
+    data = frames()
+    directory = tmp_path / 'sequence'
+    directory.mkdir()
+    for i, frame in enumerate(data):
+        tifffile.imwrite(str(directory / f'frame_{i}.tif'), frame)
+    tf = tiffstack(str(directory))
+    np.testing.assert_array_equal(tf.statistics.maximum, expected(data)[1])
+    filename, _ = sidecarfor(tf)
+    assert os.path.isfile(filename)
+    # The next open reads the sidecar, and a changed frame makes it stale
+    assert tiffstack(str(directory)).statistics.maximum.max() == data.max()
+    tifffile.imwrite(str(directory / 'frame_0.tif'), data[0] // 2)
+    assert tiffstack(str(directory)).statistics.maximum[0] == data[0].max() // 2
+
+
+def test_store_sidecar(tmp_path):
+    data = frames()
+    pathname = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(pathname, data)
+    store = chunkstore.convert(tiffstack(pathname), str(tmp_path / 'stack.zarr'), chunks=(1, 16, 16))
+    tf = tiffstack(store.path)
+    np.testing.assert_array_equal(tf.statistics.minimum, expected(data)[0])
+    filename, _ = sidecarfor(tf)
+    assert os.path.dirname(filename) == store.path and os.path.isfile(filename)
+    assert chunkstore.MultiscaleStore(store.path).shape == data.shape
+
+
+def test_background_statistics(tmp_path):
+    data = frames()
+    pathname = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(pathname, data, compression='zlib')
+    tf = tiffstack(pathname)
+    ready = threading.Event()
+    tf.computestatistics(ready.set)
+    # Each frame's own range until the statistics arrive, then the same limits from the table
+    assert tf.contrastlimits(2) == (data[2].min(), data[2].max())
+    assert ready.wait(10)
+    assert isinstance(tf.statistics, StackStatistics)
+    assert tf.contrastlimits(2) == (data[2].min(), data[2].max())
+    assert tf.contrastlimits(2, 'global') == (data.min(), data.max())
+    tf.close()
@@ -0,0 +1,128 @@
+import threading
+import numpy as np
+import pytest
+import tifffile
+from tiffstack import followstack, tiffstack
+
+
+def frames(n=5, size=32):
+    return np.random.default_rng(0).integers(0, 4000, (n, size, size), dtype=np.uint16)
+
+
+def test_appended_pages_are_frames(tmp_path):
+    pathname = str(tmp_path / 'appended.tif')
+    data = frames()
+    for frame in data:
+        tifffile.imwrite(pathname, frame, append=True)
+    tf = tiffstack(pathname)
+    assert (tf.nfiles, tf.npositions) == (5, 1)
+    np.testing.assert_array_equal(tf.getimages(0, 5), data)
+    tf.close()
+
+
+def test_ome_positions(tmp_path):
+    pathname = str(tmp_path / 'positions.ome.tif')
+    data = [frames(), frames()[:, ::-1]]
+    with tifffile.TiffWriter(pathname, ome=True) as tif:
+        for position in data:
+            tif.write(position, metadata={'axes': 'TYX'})
+    for index, position in enumerate(data):
+        tf = tiffstack(pathname, position=index)
+        assert (tf.nfiles, tf.npositions) == (5, 2)
+        np.testing.assert_array_equal(tf.getimages(0, 5), position)
+        tf.close()
+
+
+def test_ome_with_thumbnail(tmp_path):
+    pathname = str(tmp_path / 'thumbnail.ome.tif')
+    data = np.random.default_rng(0).integers(0, 4000, (5, 2, 32, 32), dtype=np.uint16)
+    with tifffile.TiffWriter(pathname, ome=True) as tif:
+        tif.write(data, metadata={'axes': 'TCYX'})
+        tif.write(data[0, 0, ::4, ::4].astype(np.uint8), metadata={'axes': 'YX'})
+    tf = tiffstack(pathname, channel=1)
+    assert (tf.nfiles, tf.nchannels, tf.npositions) == (5, 2, 1)
+    np.testing.assert_array_equal(tf.getimages(0, 5), data[:, 1])
+    tf.close()
+
+
+def test_imagej_hyperstack(tmp_path):
+    pathname = str(tmp_path / 'hyperstack.tif')
+    data = np.random.default_rng(0).integers(0, 4000, (4, 2, 3, 16, 16), dtype=np.uint16)
+    tifffile.imwrite(pathname, data, imagej=True, metadata={'axes': 'TZCYX'})
+    tf = tiffstack(pathname, channel=2, plane=1)
+    assert (tf.nfiles, tf.nchannels, tf.nplanes, tf.npositions) == (4, 3, 2, 1)
+    np.testing.assert_array_equal(tf.getimages(0, 4), data[:, 1, 2])
+    tf.close()
+
+
+def test_follow_appended_stack(tmp_path):
+    pathname = str(tmp_path / 'growing.tif')
+    data = frames(6)
+
+    def acquire():
+        for frame in data:
+            tifffile.imwrite(pathname, frame, append=True)
+            threading.Event().wait(0.05)
+
+    writer = threading.Thread(target=acquire)
+    writer.start()
+    followed = list(followstack(pathname, poll=0.2, timeout=0.6))
+    writer.join()
+    assert len(followed) == 6
+    np.testing.assert_array_equal(followed, data)
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_growing_tiff_reads_only_new_pages(tmp_path, bigtiff):
+    from tiffstack import _GrowingTiff
+    pathname = str(tmp_path / 'growing.tif')
+    data = frames(6)
+    stack = _GrowingTiff(pathname)
+    assert stack.update() == 0
+    for count, frame in enumerate(data, 1):
+        tifffile.imwrite(pathname, frame, append=True, bigtiff=bigtiff)
+        field = stack.field
+        assert stack.update() == count
+        # The chain is picked up where the last poll left it
+        assert stack.offsets[-1] > (field or 0)
+        np.testing.assert_array_equal(stack.read(count - 1), frame)
+    stack.close()
+
+
+def test_follow_sequence(tmp_path):
+    data = frames(4)
+
+    def acquire():
+        for i, frame in enumerate(data):
+            tifffile.imwrite(str(tmp_path / f'frame_{i}.tif'), frame)
+            threading.Event().wait(0.05)
+
+    writer = threading.Thread(target=acquire)
+    writer.start()
+    followed = list(followstack(str(tmp_path), poll=0.2, timeout=0.6))
+    writer.join()
+    np.testing.assert_array_equal(followed, data)
+
+
+def test_close_stops_prefetch(tmp_path):
+    pathname = str(tmp_path / 'compressed.tif')
+    tifffile.imwrite(pathname, frames(), compression='zlib')
+    tf = tiffstack(pathname, prefetch=2)
+    tf.prefetch(0)
+    prefetcher = tf._prefetcher
+    tf.close()
+    assert not prefetcher.is_alive()
+    assert tf.cache.nbytes == 0
+
+
+def test_dropped_stack_ends_prefetch(tmp_path):
+    import gc
+    pathname = str(tmp_path / 'compressed.tif')
+    tifffile.imwrite(pathname, frames(), compression='zlib')
+    tf = tiffstack(pathname, prefetch=2)
+    tf.prefetch(0)
+    prefetcher = tf._prefetcher
+    del tf
+    gc.collect()
+    prefetcher.join(3)
+    assert not prefetcher.is_alive()
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from skimage.transform import AffineTransform, warp
+from translate import translate
+
+
+@pytest.fixture(scope='module')
+def image():
+    return np.random.default_rng(0).random((40, 56)) * 1000
+
+
+@pytest.mark.parametrize('shift', [(3, -2), (-1.25, 0.5), (0.3, 7.8), (0, 0)])
+def test_matches_warp(image, shift):
+    expected = warp(image, AffineTransform(translation=shift), preserve_range=True, order=1)
+    np.testing.assert_allclose(translate(image, shift, out=np.empty(image.shape)), expected, atol=1e-9)
+
+
+def test_block_and_in_place(image):
+    images = np.stack([image, image[::-1]])
+    translations = np.array([[1.5, -0.5], [-2.25, 3]])
+    expected = np.stack([translate(frame, shift) for frame, shift in zip(images, translations)])
+    np.testing.assert_allclose(translate(images, translations), expected)
+    buffer = images.astype(np.float32)
+    translate(buffer, translations, out=buffer)
+    np.testing.assert_allclose(buffer, expected, rtol=1e-6)
+
+
+def test_fourier_integer_shift(image):
+    # A whole pixel phase ramp is a circular shift
+    np.testing.assert_allclose(translate(image, (2, 3), 'fourier', out=np.empty(image.shape)),
+                               np.roll(image, (-3, -2), axis=(0, 1)), atol=1e-9)
+
+
+def test_outside_the_frame_is_zero(image):
+    np.testing.assert_array_equal(translate(image, (100, 0)), 0)
+    shifted = translate(image, (-3.5, 0))
+    assert not shifted[:, :3].any() and shifted[:, 4:].all()
+
+
+def test_result_dtype():
+    assert translate(np.ones((8, 8), dtype=np.uint16), (0.5, 0)).dtype == np.float32
+    assert translate(np.ones((8, 8)), (0.5, 0)).dtype == np.float64
+    with pytest.raises(ValueError):
+        translate(np.ones((8, 8)), (0.5, 0), method='cubic')
+
+
+def test_fourier_subpixel_shift():
+    # Exact for a band limited periodic signal
+    def wave(y, x):
+        return np.cos(2 * np.pi * (3 * y / 32 + 5 * x / 48))
+
+    rows, cols = np.mgrid[:32, :48]
+    np.testing.assert_allclose(translate(wave(rows, cols), (0.3, -1.7), 'fourier'), wave(rows - 1.7, cols + 0.3),
+                               atol=1e-9)
@@ -0,0 +1,89 @@
+import os
+import threading
+import numpy as np
+import pytest
+import tifffile
+from tiffstack import tiffstack
+from translate import translate
+from writer import savedriftcorrected, tosource
+
+
+@pytest.mark.parametrize('options', [{}, dict(batch=5, compression='zlib'), dict(tile=(32, 32))])
+def test_round_trip(stackfile, tmp_path, options):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    outname = str(tmp_path / 'corrected.tif')
+    translations = np.random.default_rng(1).normal(0, 2, (tf.nfiles, 2))
+    savedriftcorrected(tf, outname, translations, **options)
+    expected = tosource(translate(tf.getimages(0, tf.nfiles), translations), tf.dtype)
+    written = tifffile.imread(outname)
+    assert written.dtype == tf.dtype
+    np.testing.assert_array_equal(written, expected)
+    tf.close()
+
+
+def test_zero_translation_is_lossless(stackfile, tmp_path):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    outname = str(tmp_path / 'corrected.tif')
+    savedriftcorrected(tf, outname, np.zeros((tf.nfiles, 2)))
+    np.testing.assert_array_equal(tifffile.imread(outname), tf.getimages(0, tf.nfiles))
+    tf.close()
+
+
+def test_tosource_saturates():
+    shifted = np.array([-3.0, 0.4, 0.6, 65535.4, 70000.0])
+    np.testing.assert_array_equal(tosource(shifted, np.uint16), [0, 0, 1, 65535, 65535])
+    np.testing.assert_array_equal(tosource(np.array([-200.0, 200.0]), np.int8), [-128, 127])
+    buffer = shifted.copy()
+    assert tosource(buffer, np.uint16, overwrite=True).dtype == np.uint16
+    assert tosource(shifted, np.float32).dtype == np.float32
+
+
+def test_progress_and_cancel(stackfile, tmp_path):
+    from jobs import Cancelled
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    outname = str(tmp_path / 'corrected.tif')
+    written = []
+    savedriftcorrected(tf, outname, np.zeros((tf.nfiles, 2)), batch=10, progress=written.append)
+    assert written == [10, 20, 24]
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(Cancelled):
+        savedriftcorrected(tf, outname, np.zeros((tf.nfiles, 2)), cancel=cancel)
+    # No partial file is left behind
+    assert not os.path.exists(outname)
+    tf.close()
+
+
+def test_hyperstack_shares_translations(tmp_path):
+    pathname = str(tmp_path / 'hyperstack.tif')
+    data = np.random.default_rng(0).integers(0, 4000, (5, 2, 3, 24, 24), dtype=np.uint16)
+    tifffile.imwrite(pathname, data, imagej=True, metadata={'axes': 'TZCYX'})
+    tf = tiffstack(pathname)
+    outname = str(tmp_path / 'corrected.tif')
+    translations = np.random.default_rng(1).normal(0, 2, (5, 2))
+    savedriftcorrected(tf, outname, translations)
+    written = tifffile.imread(outname)
+    # Every channel and plane of a time point is shifted by that time point's translation
+    assert written.shape == (5, 3, 2, 24, 24)
+    for c in range(3):
+        for z in range(2):
+            np.testing.assert_array_equal(written[:, c, z], tosource(translate(data[:, z, c], translations),
+                                                                       tf.dtype))
+    tf.close()
+
+
+def test_float32_matches_float64(stackfile, tmp_path):
+    pathname, _ = stackfile
+    tf = tiffstack(pathname)
+    translations = np.random.default_rng(1).normal(0, 2, (tf.nfiles, 2))
+    written = {}
+    for precision in ('float32', 'float64'):
+        outname = str(tmp_path / f'{precision}.tif')
+        savedriftcorrected(tf, outname, translations, precision=precision)
+        written[precision] = tifffile.imread(outname).astype(int)
+    # Rounding to the source dtype differs by at most one count
+    assert np.abs(written['float32'] - written['float64']).max() <= 1
+    tf.close()
@@ -1,64 +1,876 @@
+import glob
+import operator
+import os
+import re
+import struct
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import tifffile
 import numpy as np
-from skimage.transform import AffineTransform, warp
+import chunkstore
+from instrument import count
+from jobs import Cancelled
+from stackstats import LEVELS, stackstatistics
+from translate import translate
+import writer
+
+
+class FrameCache:
+
+    """
+    Least recently used cache of frames bounded by the memory they take up
+    :param size: memory budget in MB
+    """
+
+    def __init__(self, size=512):
+        self.size = size * 2 ** 20
+        self.nbytes = 0
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.frames:
+                return None
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.frames:
+                self.nbytes -= self.frames.pop(key).nbytes
+            if image.nbytes > self.size:
+                return
+            self.frames[key] = image
+            self.nbytes += image.nbytes
+            while self.nbytes > self.size:
+                self.nbytes -= self.frames.popitem(last=False)[1].nbytes
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.frames
+
+    def clear(self, kind=None):
+        """ Drop every frame, or only those whose key starts with kind """
+        with self.lock:
+            for key in [key for key in self.frames if kind is None or key[0] == kind]:
+                self.nbytes -= self.frames.pop(key).nbytes
+
+
+class _Prefetcher(threading.Thread):
+
+    """
+    Background thread that loads the frames ahead of the one being viewed into the stack's cache.
+    Only the latest request matters, a new one abandons whatever is left of the previous.
+    The stack is only referenced weakly between requests, so a stack that is dropped without being closed
+    doesn't stay in memory, and the thread ends with it.
+    """
+
+    def __init__(self, stack, ahead):
+        super().__init__(daemon=True)
+        self.stack = weakref.ref(stack)
+        self.ahead = ahead
+        self.request = None
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def prefetch(self, index, direction, corrected):
+        with self.condition:
+            self.request = (index, direction, corrected)
+            self.condition.notify()
+
+    def stop(self):
+        """ Ends the thread once the frame it is loading, if any, is done """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self is not threading.current_thread():
+            self.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Woken up now and then to notice a stack that has gone
+                while self.request is None and not self.stopped and self.stack() is not None:
+                    self.condition.wait(1.0)
+                if self.stopped or self.stack() is None:
+                    return
+                request, self.request = self.request, None
+            self._fetch(self.stack(), *request)
+
+    def _fetch(self, stack, index, direction, corrected):
+        if stack is None:
+            return
+        for step in range(1, self.ahead + 1):
+            neighbour = index + step * direction
+            if self.request is not None or self.stopped or not 0 <= neighbour < stack.nfiles:
+                break
+            if corrected:
+                stack.getcorrected(neighbour)
+            else:
+                stack._load(neighbour)
+
+
+def naturalkey(filename):
+    """ Sort key that orders frame_2.tif before frame_10.tif """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', filename)]
+
+
+def sequencefiles(pathname):
+    """
+    Lists the frames of an image sequence
+    :param pathname: a directory of tiffs, a glob pattern or a list of files
+    :return: naturally sorted list of files, or None if pathname is a single (multipage) tiff
+    """
+    files = _listsequence(pathname)
+    if files is None:
+        return None
+    if not files:
+        raise FileNotFoundError(f'No tiff files found in {pathname}')
+    return sorted(files, key=naturalkey)
+
+
+def _listsequence(pathname):
+    """ Unsorted files of an image sequence, None if pathname is a single (multipage) tiff """
+    if isinstance(pathname, (list, tuple)):
+        return list(pathname)
+    if os.path.isdir(pathname):
+        return [os.path.join(pathname, filename) for filename in os.listdir(pathname)
+                if filename.lower().endswith(('.tif', '.tiff')) and not filename.startswith('.')]
+    if glob.has_magic(pathname):
+        return glob.glob(pathname)
+    return None
+
+
+class _GrowingSequence:
+
+    """
+    Frames of an image sequence that files are still being added to. Files already known keep their place,
+    only the names not seen before are sorted and appended
+    """
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.files = []
+        self.known = set()
+
+    def update(self):
+        """ :return: number of frames found so far """
+        new = [file for file in _listsequence(self.pathname) if file not in self.known]
+        self.files.extend(sorted(new, key=naturalkey))
+        self.known.update(new)
+        return len(self.files)
+
+    def read(self, index):
+        return tifffile.imread(self.files[index])
+
+    def close(self):
+        pass
+
+
+class _GrowingTiff:
+
+    """
+    Pages of a multipage tiff that pages are still being appended to. The chain of IFDs is followed on from the
+    last page already found, so a poll only reads the header and the pages added since the one before.
+    The file is opened again for every poll, an open handle keeps serving what it buffered before the append.
+    """
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.offsets = []
+        # File position of the offset to the next IFD, in the header until the first page is found
+        self.field = None
+        self.tif = None
+
+    def update(self):
+        """ :return: number of pages found so far """
+        self.close()
+        try:
+            self.tif = tifffile.TiffFile(self.pathname)
+        except (FileNotFoundError, ValueError, tifffile.TiffFileError):
+            # Nothing written yet, or caught in the middle of writing the header
+            return len(self.offsets)
+        fh, tiff = self.tif.filehandle, self.tif.tiff
+        if self.field is None:
+            # The first IFD offset follows the 4 byte header of a classic tiff, the 8 byte one of a BigTIFF
+            self.field = tiff.offsetsize
+        try:
+            while True:
+                fh.seek(self.field)
+                offset = struct.unpack(tiff.offsetformat, fh.read(tiff.offsetsize))[0]
+                if not offset or offset >= fh.size:
+                    break
+                fh.seek(offset)
+                ntags = struct.unpack(tiff.tagnoformat, fh.read(tiff.tagnosize))[0]
+                self.offsets.append(offset)
+                self.field = offset + tiff.tagnosize + ntags * tiff.tagsize
+        except struct.error:
+            # An IFD still being written, picked up on the next poll
+            pass
+        return len(self.offsets)
+
+    def read(self, index):
+        self.tif.filehandle.seek(self.offsets[index])
+        return tifffile.TiffPage(self.tif, index=index).asarray()
+
+    def close(self):
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+
+
+def followstack(pathname, poll=1.0, timeout=60.0, start=0):
+    """
+    Yields the frames of a stack that is still being acquired, as a multipage tiff that pages are appended to,
+    every page a frame, or an image sequence that new files are added to. Each poll only reads what was added
+    since the last one. The newest frame is only handed out once the stack has stopped changing for a poll,
+    it may still be half written before that.
+    :param pathname: a multipage tiff, or an image sequence as tiffstack accepts it
+    :param poll: seconds between checks for new frames
+    :param timeout: stop after this many seconds without a new frame
+    :param start: first frame to yield
+    :return: generator of frames
+    """
+    stack = _GrowingTiff(pathname) if _listsequence(pathname) is None else _GrowingSequence(pathname)
+    index = start
+    seen = None
+    idle = 0.0
+    try:
+        while True:
+            nfiles = stack.update()
+            settled = nfiles == seen
+            ready = nfiles if settled else nfiles - 1
+            for i in range(index, ready):
+                yield stack.read(i)
+            stack.close()
+            if ready > index:
+                index = ready
+                idle = 0.0
+            elif idle >= timeout:
+                return
+            seen = nfiles
+            time.sleep(poll)
+            idle += poll
+    finally:
+        stack.close()
+
+
+def pagelayout(series):
+    """
+    What the pages of a tiff series are stacked along, from its axes metadata. T, C and Z are time, channel and
+    z-plane, any other axis of more than one page is taken as time when there is no T, e.g. the Q or I of
+    stacks without metadata.
+    :param series: tifffile series of 2D pages
+    :return: dims - number of pages along every page axis
+    roles - 't', 'c', 'z' or None for each of them
+    """
+    if series.axes[-2:] != 'YX' or series.keyframe.ndim != 2:
+        raise ValueError(f'{series.axes} series, only stacks of single plane (YX) pages are supported')
+    dims = tuple(series.shape[:-2])
+    roles = [{'T': 't', 'C': 'c', 'Z': 'z'}.get(axis) for axis in series.axes[:-2]]
+    for i, (axis, size) in enumerate(zip(series.axes[:-2], dims)):
+        if roles[i] is None and size > 1:
+            if 't' in roles:
+                raise ValueError(f'{series.axes} series, no way to index its {axis} axis')
+            roles[i] = 't'
+    return dims, roles
+
+
+def positions(pathname):
+    """ Number of positions (scenes) in a stack, the images of an OME tiff shaped like the first """
+    tf = tiffstack(pathname, cachesize=0, prefetch=0)
+    tf.close()
+    return tf.npositions
+
 
 class tiffstack():
 
     """
-    Container class for a stack of tiff images
-    to do: handle both multipage tiffs as well as image sequences
+    Container class for a stack of tiff images, either a multipage tiff or an image sequence with one frame
+    per file given as a directory, a glob pattern or a list of files.
+    Sequences are indexed lazily, only the first file is opened until frames are requested.
+    A chunked store written by chunkstore.convert is read the same way, with its downsampled levels
+    available through getpreview.
+    Multipage tiffs with channels, z-planes or several positions (OME or ImageJ hyperstacks) are read from their
+    axes metadata. Frames are the time points of one channel and plane of one position, the one drift is
+    estimated on, while gethyperstack reads every channel and plane.
+    :param position: which series of a multi-position file
+    :param channel: channel frames are taken from
+    :param plane: z-plane frames are taken from
     """
 
-    def __init__(self, pathname=None):
+    def __init__(self, pathname=None, cachesize=256, prefetch=8, position=0, channel=0, plane=0):
         self.ims = None
         self.nfiles = 0
-        self.minimum = 0
-        self.maximum = np.inf
         self.width = 0
         self.height = 0
         self.dtype = None
+        self.data = None
+        self.volume = None
+        self.files = None
+        self.store = None
+        self.nchannels = 1
+        self.nplanes = 1
+        self.npositions = 1
+        self.position = position
+        self.channel = channel
+        self.plane = plane
+        self._pages = None
+        self._layout = ((), [])
         self.pathname = pathname
+        self.cache = FrameCache(cachesize)
+        self.prefetchsize = prefetch
+        self._prefetcher = None
+        self._readlock = threading.Lock()
+        self._statistics = None
+        self._statisticsjob = None
+        self._statisticsdone = None
+        self._statisticslock = threading.Lock()
+        self.corrected = None
         if pathname is not None:
             self.load_info(pathname)
-        self.transforms = []
 
     def load_info(self, pathname):
+        if chunkstore.isstore(pathname):
+            self.store = chunkstore.MultiscaleStore(pathname)
+            self.nfiles, self.width, self.height = self.store.shape
+            self.dtype = self.store.dtype
+            return
+        self.files = sequencefiles(pathname)
+        if self.files is not None:
+            with tifffile.TiffFile(self.files[0]) as first:
+                self.width = first.pages[0].shape[0]
+                self.height = first.pages[0].shape[1]
+                self.dtype = first.pages[0].dtype
+            self.nfiles = len(self.files)
+            return
         self.ims = tifffile.TiffFile(pathname)
-        self.width = self.ims.pages[0].shape[0]
-        self.height = self.ims.pages[0].shape[1]
-        self.dtype = self.ims.pages[0].dtype
-        self.nfiles = len(self.ims.pages)
+        first = self.ims.series[0]
+        if self.ims.is_ome:
+            # OME stores every position (scene) as an image of its own, anything shaped differently
+            # (thumbnails, labels) isn't one
+            self.npositions = sum(1 for series in self.ims.series if series.axes == first.axes and
+                                  series.shape[1:] == first.shape[1:])
+        if not 0 <= self.position < self.npositions:
+            raise IndexError(f'position {self.position} out of range for {self.npositions} positions')
+        series = self.ims.series[self.position]
+        if not self.ims.is_ome and len(self.ims.series) > 1:
+            # Pages written one write at a time, e.g. appended to a stack as it is acquired, come out as a series
+            # each without saying what they are, they are the frames of one stack
+            self._pages = [page for page in self.ims.pages if page.shape == first.keyframe.shape]
+            self._layout = ((len(self._pages),), ['t'])
+        else:
+            self._pages = series.pages
+            self._layout = pagelayout(series)
+        dims, roles = self._layout
+        size = {role: dims[roles.index(role)] if role in roles else 1 for role in 'tcz'}
+        self.nfiles, self.nchannels, self.nplanes = size['t'], size['c'], size['z']
+        if not (0 <= self.channel < self.nchannels and 0 <= self.plane < self.nplanes):
+            raise IndexError(f'channel {self.channel}, plane {self.plane} out of range for {self.nchannels} '
+                             f'channels and {self.nplanes} planes')
+        self.width, self.height = series.shape[-2:]
+        self.dtype = series.dtype
+        self.volume = self._memmap(pathname)
+        if self.volume is not None:
+            self.data = self.volume[:, self.channel, self.plane]
+
+    def close(self):
+        """ Stops prefetching and releases the cached frames, file handle and memory map of a multipage tiff """
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+        if self._statisticsjob is not None:
+            self._statisticsjob.set()
+        self.cache.clear()
+        if self.corrected is not None:
+            self.corrected.cache.clear()
+        self.data = None
+        self.volume = None
+        if self.ims is not None:
+            self.ims.close()
+            self.ims = None
+
+    def _memmap(self, pathname):
+        """
+        Maps uncompressed, contiguous stacks straight into memory as a (nfiles, nchannels, nplanes, width,
+        height) array so that frames and frame ranges are views rather than freshly decoded copies
+        :return: read only numpy memmap, or None when the file has to go through the decoder
+        """
+        try:
+            data = tifffile.memmap(pathname, series=self.position, mode='r')
+        except ValueError:
+            return None
+        dims, roles = self._layout
+        if data.size != np.prod(dims, dtype=int) * self.width * self.height:
+            return None
+        data = data.reshape(dims + (self.width, self.height))
+        # Axes of a single page dropped, the missing ones of t, c and z added, then put in that order
+        data = data[tuple(slice(None) if role else 0 for role in roles)]
+        present = [role for role in roles if role]
+        for role in 'tcz':
+            if role not in present:
+                data = data[np.newaxis]
+                present.insert(0, role)
+        return np.moveaxis(data, [present.index(role) for role in 'tcz'], [0, 1, 2])
+
+    def _page(self, index, channel, plane):
+        """ Page of a multipage tiff holding time point index of channel and plane """
+        dims, roles = self._layout
+        if not dims:
+            return self._pages[0]
+        position = dict(t=index, c=channel, z=plane)
+        return self._pages[int(np.ravel_multi_index([position[role] if role else 0 for role in roles], dims))]
+
+    @property
+    def label(self):
+        """ Which position, channel and plane frames come from, empty for the first of each """
+        if (self.position, self.channel, self.plane) == (0, 0, 0):
+            return ''
+        return f'.p{self.position}c{self.channel}z{self.plane}'
+
+    def setchannel(self, channel=None, plane=None):
+        """
+        Switches the channel and z-plane frames are taken from, e.g. to estimate drift on another channel.
+        Cached frames, statistics and the drift corrected view are rebuilt for the new channel.
+        """
+        channel = self.channel if channel is None else channel
+        plane = self.plane if plane is None else plane
+        if not (0 <= channel < self.nchannels and 0 <= plane < self.nplanes):
+            raise IndexError(f'channel {channel}, plane {plane} out of range for {self.nchannels} channels and '
+                             f'{self.nplanes} planes')
+        self.channel, self.plane = channel, plane
+        if self.volume is not None:
+            self.data = self.volume[:, channel, plane]
+        self.cache.clear()
+        with self._statisticslock:
+            self._statistics = None
+            if self._statisticsjob is not None:
+                # Whatever the running computation finds is for the old channel
+                self._statisticsjob.set()
+        if self._statisticsjob is not None:
+            self.computestatistics(self._statisticsdone)
+        if self.corrected is not None:
+            self.setdrift(self.corrected.translations, self.corrected.method)
+
+    def getframe(self, index, channel=None, plane=None):
+        """
+        Image at time point index of any channel and plane, not cached
+        :return: numpy array of image
+        """
+        channel = self.channel if channel is None else channel
+        plane = self.plane if plane is None else plane
+        if (channel, plane) == (self.channel, self.plane):
+            return self._load(index)
+        if self.volume is not None:
+            return self.volume[index, channel, plane]
+        with self._readlock:
+            return self._page(index, channel, plane).asarray()
+
+    def gethyperstack(self, start, stop):
+        """
+        Every channel and plane of a range of time points
+        :param start: first time point in the range
+        :param stop: one past the last time point in the range
+        :return: numpy array of shape (n, nchannels, nplanes, width, height)
+        """
+        if self.volume is not None:
+            return self.volume[start:stop]
+        if self.nchannels == self.nplanes == 1:
+            return self.getimages(start, stop)[:, np.newaxis, np.newaxis]
+        stop = min(stop, self.nfiles)
+        images = np.empty((max(0, stop - start), self.nchannels, self.nplanes, self.width, self.height),
+                          dtype=self.dtype)
+        with self._readlock:
+            for i in range(len(images)):
+                for channel in range(self.nchannels):
+                    for plane in range(self.nplanes):
+                        images[i, channel, plane] = self._page(start + i, channel, plane).asarray()
+        return images
 
     def getimage(self, index):
         """
-        Load in the image at index and store the min and max values
+        Load in the image at index
+        :param index: which image in series to open
+        :return: numpy array of image
+        """
+        return self._load(index)
+
+    @property
+    def statistics(self):
+        """ Per frame intensity statistics, computed on first use or read from the sidecar file """
+        if self._statistics is None:
+            self._statistics = stackstatistics(self)
+        return self._statistics
+
+    def computestatistics(self, done=None):
+        """
+        Reads or computes the statistics on a background thread instead of on first use, until they are ready
+        contrastlimits gives each frame's own range so a viewer can show frames straight away
+        :param done: called without arguments from the background thread once the statistics are ready
+        """
+        if self._statistics is not None:
+            if done is not None:
+                done()
+            return
+        cancel = threading.Event()
+        self._statisticsjob = cancel
+        self._statisticsdone = done
+
+        def work():
+            try:
+                statistics = stackstatistics(self, cancel=cancel)
+            except (Cancelled, OSError, ValueError, AttributeError):
+                # Stack closed or channel switched while reading it
+                return
+            with self._statisticslock:
+                if cancel.is_set():
+                    return
+                self._statistics = statistics
+            if done is not None:
+                done()
+
+        threading.Thread(target=work, daemon=True).start()
+
+    @property
+    def minimum(self):
+        return self.statistics.minimum.min() if self.nfiles else 0
+
+    @property
+    def maximum(self):
+        return self.statistics.maximum.max() if self.nfiles else np.inf
+
+    def contrastlimits(self, index=None, mode='frame', level=None):
+        """
+        Display limits for a frame, see StackStatistics.limits
+        :param index: which image in series
+        :param mode: 'frame' or 'global'
+        :param level: which percentile level to use, None for the minimum and maximum
+        :return: (lower, upper)
+        """
+        if self._statistics is None and self._statisticsjob is not None:
+            # Still being computed in the background, the frame's own range in the meantime
+            image = self._load(index or 0)
+            if level is None:
+                return image.min(), image.max()
+            return tuple(np.percentile(image, [LEVELS[level], LEVELS[-1 - level]]))
+        return self.statistics.limits(index, mode, level)
+
+    def _load(self, index, store=True):
+        if self.data is not None:
+            return self.data[index]
+        image = self.cache.get(('raw', index))
+        if image is None:
+            count('cache misses')
+            if self.store is not None:
+                image = self.store.level(index)
+            elif self.files is not None:
+                # Separate files, no need to serialise reads
+                image = tifffile.imread(self.files[index], key=0)
+            else:
+                with self._readlock:
+                    image = self._page(index, self.channel, self.plane).asarray()
+            if store:
+                self.cache.put(('raw', index), image)
+        else:
+            count('cache hits')
+        return image
+
+    def getcorrected(self, index):
+        """
+        Drift corrected image at index, needs settransforms or setdrift to have been called
+        :param index: which image in series to open
+        :return: numpy array of the shifted image
+        """
+        return self.corrected.getimage(index)
+
+    @property
+    def levels(self):
+        """ Number of resolution levels, 1 unless the stack is read from a chunked store """
+        return len(self.store.levels) if self.store is not None else 1
+
+    def getpreview(self, index, level=0, corrected=False):
+        """
+        Image at index downsampled 2 ** level times, read from the store's lower resolution levels so
+        scrubbing through a large stack only decodes a fraction of the data. Full resolution for plain tiffs.
         :param index: which image in series to open
+        :param level: resolution level, clamped to the coarsest available
+        :param corrected: drift correct the preview, needs settransforms or setdrift to have been called
         :return: numpy array of image
         """
-        image = self.ims.pages[index].asarray()
-        self.minimum = image.min()
-        self.maximum = image.max()
+        if corrected:
+            return self.corrected.getpreview(index, level)
+        level = min(level, self.levels - 1)
+        if level == 0:
+            return self._load(index)
+        image = self.cache.get(('preview', index, level))
+        if image is None:
+            image = self.store.level(index, level)
+            self.cache.put(('preview', index, level), image)
         return image
 
+    def prefetch(self, index, direction=1, corrected=False):
+        """
+        Start loading the frames following index in the direction of travel in the background
+        :param index: frame currently being viewed
+        :param direction: 1 when moving forwards through the stack, -1 backwards
+        :param corrected: prefetch drift corrected frames rather than raw ones
+        """
+        if self.prefetchsize <= 0 or (self.data is not None and not corrected):
+            return
+        if self._prefetcher is None:
+            self._prefetcher = _Prefetcher(self, self.prefetchsize)
+            self._prefetcher.start()
+        self._prefetcher.prefetch(index, direction, corrected)
+
+    def getimages(self, start, stop):
+        """
+        Load a range of images, a view into the file when it is memory mapped
+        :param start: first image in the range
+        :param stop: one past the last image in the range
+        :return: numpy array of shape (n, width, height)
+        """
+        if self.data is not None:
+            return self.data[start:stop]
+        if self.store is not None:
+            return self.store.levels[0].read(start, stop)
+        images = np.empty((max(0, min(stop, self.nfiles) - start), self.width, self.height), dtype=self.dtype)
+
+        def read(i):
+            # Ranges are read for streaming passes over the stack, keep them from flushing the viewer's frames
+            images[i] = self._load(start + i, store=False)
+
+        if self.files is not None:
+            with ThreadPoolExecutor(max_workers=min(8, os.cpu_count())) as pool:
+                list(pool.map(read, range(len(images))))
+        else:
+            for i in range(len(images)):
+                read(i)
+        return images
+
+    def checkheaders(self, workers=None):
+        """
+        Reads the header of every file of an image sequence in parallel and checks each holds a single frame
+        of the same shape and dtype as the first
+        :param workers: threads to read headers with, None lets the pool decide
+        :return: list of files that don't match, empty for multipage tiffs
+        """
+        if self.files is None:
+            return []
+
+        def matches(filename):
+            with tifffile.TiffFile(filename) as tif:
+                page = tif.pages[0]
+                return page.shape[:2] == (self.width, self.height) and page.dtype == self.dtype
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return [filename for filename, ok in zip(self.files, pool.map(matches, self.files)) if not ok]
+
     def settransforms(self, xshift, yshift):
         """
-        Once drift has been estimated, generate an affine transform for each image
+        Once drift has been estimated, set the translation of every image after the first, which stays in place
         """
-        self.transforms.append(AffineTransform(translation=[0, 0]))
-        for i in range(self.nfiles-1):
-            self.transforms.append(AffineTransform(translation=[xshift[i], yshift[i]]))
+        shifts = np.column_stack([xshift, yshift])[:self.nfiles - 1]
+        self.setdrift(np.vstack([np.zeros((1, 2)), shifts]))
+
+    def setdrift(self, translations, method='linear'):
+        """
+        Replaces the drift correction, getcorrected and the corrected view then shift frames by translations
+        :param translations: (nfiles, 2) array of (x, y) translations, see PhaseCrossCorrelation.correctiontranslations
+        :param method: interpolation, see translate.translate
+        :return: the correctedstack view
+        """
+        self.corrected = correctedstack(self, translations, method, self.cache.size / 2 ** 20)
+        return self.corrected
 
     def printtransforms(self):
-        print(self.nfiles, len(self.transforms))
-        for i in range(len(self.transforms)):
-            print(self.transforms[i])
-
-    def savedriftcorrected(self):
-        outname = self.pathname[:-4] + 'DC.tif'
-        with tifffile.TiffWriter(outname) as tif:
-            for index in range(self.nfiles):
-                image = self.getimage(index)
-                transform = self.transforms[index]
-                shifted = warp(image, transform, preserve_range=True)
-                tif.save(np.int16(shifted))
-        print('saved data')
\ No newline at end of file
+        print(self.nfiles, None if self.corrected is None else self.corrected.translations)
+
+    def outname(self, suffix='DC.tif'):
+        """
+        Default name for derived files, next to the multipage tiff, the sequence directory or the first file.
+        Every position of a multi-position file gets its own.
+        """
+        if self.npositions > 1:
+            suffix = f'_pos{self.position}' + suffix
+        if self.files is None:
+            return os.path.splitext(self.pathname.rstrip(os.sep))[0] + suffix
+        if isinstance(self.pathname, str) and os.path.isdir(self.pathname):
+            return self.pathname.rstrip(os.sep) + suffix
+        return os.path.splitext(self.files[0])[0] + suffix
+
+    def savedriftcorrected(self, outname=None, **options):
+        """
+        Writes the drift corrected stack next to the original, needs settransforms or setdrift to have been
+        called, see correctedstack.savedriftcorrected
+        """
+        self.corrected.savedriftcorrected(outname, **options)
+
+
+class correctedstack():
+
+    """
+    Drift corrected view of a tiffstack with the same interface, indexable by frame or slice. Only the
+    (nfiles, 2) translations are kept and frames are shifted as they are read, so corrected data can be browsed
+    or analysed without writing a corrected copy of the stack first. Frames come back in the dtype of the
+    source, exactly as savedriftcorrected writes them.
+    :param source: the tiffstack to correct
+    :param translations: (nfiles, 2) array of (x, y) translations, see PhaseCrossCorrelation.correctiontranslations
+    :param method: interpolation, see translate.translate
+    :param cachesize: memory budget in MB for shifted frames
+    """
+
+    def __init__(self, source, translations, method='linear', cachesize=256):
+        translations = np.asarray(translations, dtype=float).reshape(-1, 2)
+        if len(translations) != source.nfiles:
+            raise ValueError(f'{len(translations)} translations for a stack of {source.nfiles} frames')
+        self.source = source
+        self.translations = translations
+        self.method = method
+        self.cache = FrameCache(cachesize)
+        self.nfiles = source.nfiles
+        self.width = source.width
+        self.height = source.height
+        self.dtype = source.dtype
+        self.nchannels = source.nchannels
+        self.nplanes = source.nplanes
+        self.npositions = source.npositions
+        self.position = source.position
+        self.channel = source.channel
+        self.plane = source.plane
+        self.pathname = source.pathname
+        self.files = source.files
+        self.store = source.store
+        self.data = None
+        # Not tied to the file alone, statistics of the shifted frames aren't kept next to it
+        self.label = None
+
+    def __len__(self):
+        return self.nfiles
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.nfiles)
+            if step == 1:
+                return self.getimages(start, stop)
+            indices = range(start, stop, step)
+            images = np.empty((len(indices), self.width, self.height), dtype=self.dtype)
+            for i, index in enumerate(indices):
+                images[i] = self.getimage(index)
+            return images
+        index = operator.index(key)
+        if index < 0:
+            index += self.nfiles
+        if not 0 <= index < self.nfiles:
+            raise IndexError(f'frame {key} out of range for a stack of {self.nfiles} frames')
+        return self.getimage(index)
+
+    def _shift(self, images, translations):
+        return writer.tosource(translate(images, translations, self.method), self.dtype, overwrite=True)
+
+    def _load(self, index, store=True):
+        image = self.cache.get(index)
+        if image is None:
+            image = self._shift(self.source._load(index), self.translations[index])
+            if store:
+                self.cache.put(index, image)
+        return image
+
+    def getimage(self, index):
+        """
+        Load in the shifted image at index
+        :param index: which image in series to open
+        :return: numpy array of image
+        """
+        return self._load(index)
+
+    getcorrected = getimage
+
+    def getimages(self, start, stop):
+        """
+        Load and shift a range of images
+        :param start: first image in the range
+        :param stop: one past the last image in the range
+        :return: numpy array of shape (n, width, height)
+        """
+        stop = min(stop, self.nfiles)
+        if stop <= start:
+            return np.empty((0, self.width, self.height), dtype=self.dtype)
+        return self._shift(self.source.getimages(start, stop), self.translations[start:stop])
+
+    def gethyperstack(self, start, stop):
+        """
+        Every channel and plane of a range of time points, each shifted by the translation of its time point
+        :return: numpy array of shape (n, nchannels, nplanes, width, height)
+        """
+        images = self.source.gethyperstack(start, stop)
+        planes = self.nchannels * self.nplanes
+        shifted = self._shift(images.reshape(-1, self.width, self.height),
+                              np.repeat(self.translations[start:start + len(images)], planes, axis=0))
+        return shifted.reshape(images.shape)
+
+    @property
+    def levels(self):
+        return self.source.levels
+
+    def getpreview(self, index, level=0, corrected=True):
+        """
+        Shifted image at index downsampled 2 ** level times, see tiffstack.getpreview
+        """
+        level = min(level, self.levels - 1)
+        if level == 0:
+            return self._load(index)
+        image = self.cache.get(('preview', index, level))
+        if image is None:
+            image = self._shift(self.store.level(index, level), self.translations[index] / 2 ** level)
+            self.cache.put(('preview', index, level), image)
+        return image
+
+    def prefetch(self, index, direction=1, corrected=True):
+        """ Start shifting the frames following index in the background, see tiffstack.prefetch """
+        if self.source.corrected is self:
+            self.source.prefetch(index, direction, corrected=True)
+
+    # Shifting doesn't change the intensities, the source's statistics hold for the corrected frames
+    @property
+    def statistics(self):
+        return self.source.statistics
+
+    @property
+    def minimum(self):
+        return self.source.minimum
+
+    @property
+    def maximum(self):
+        return self.source.maximum
+
+    def contrastlimits(self, index=None, mode='frame', level=None):
+        return self.source.contrastlimits(index, mode, level)
+
+    def checkheaders(self, workers=None):
+        return self.source.checkheaders(workers)
+
+    def outname(self, suffix='DC.tif'):
+        return self.source.outname(suffix)
+
+    def close(self):
+        self.source.close()
+
+    def savedriftcorrected(self, outname=None, **options):
+        """
+        Writes the corrected stack next to the original, see writer.savedriftcorrected for the options.
+        A name ending in .zarr writes a chunked store instead, in parallel blocks, see chunkstore.convert.
+        :param outname: path of the corrected tiff, defaults to the original name ending in DC.tif
+        """
+        if outname is None:
+            outname = self.outname()
+        options.setdefault('method', self.method)
+        if outname.rstrip(os.sep).endswith('.zarr'):
+            chunkstore.convert(self.source, outname, translations=self.translations,
+                               **{name: options[name] for name in ('method', 'progress', 'cancel') if name in options})
+        else:
+            writer.savedriftcorrected(self.source, outname, self.translations, **options)
+        print('saved data')
@@ -0,0 +1,79 @@
+import numpy as np
+from instrument import timed
+
+
+@timed('warp')
+def translate(images, translations, method='linear', out=None):
+    """
+    Moves frames by a pure translation. Same convention as
+    warp(image, AffineTransform(translation=(x, y)), preserve_range=True), so output[r, c] = input[r + y, c + x]
+    with zeros coming in from outside the frame, but without building a coordinate map for every pixel.
+    Whole pixel shifts are plain slice copies, subpixel shifts are a separable linear interpolation.
+    :param images: 2D frame or (n, h, w) block of frames
+    :param translations: (x, y) translation, or (n, 2) array of translations for a block
+    :param method: 'linear' for separable bilinear interpolation, 'fourier' for a phase ramp in Fourier space
+    which is exact for band limited data but wraps content around the edges
+    :param out: optional float buffer of the same shape to write the result into, may be images itself
+    :return: shifted frame(s), float32 unless the input is float64
+    """
+    images = np.asarray(images)
+    single = images.ndim == 2
+    if single:
+        images = images[np.newaxis]
+    translations = np.asarray(translations, dtype=float).reshape(-1, 2)
+    dtype = np.result_type(images.dtype, np.float32)
+    if out is None:
+        out = np.empty(images.shape, dtype=dtype)
+    else:
+        out = out[np.newaxis] if out.ndim == 2 else out
+
+    if method == 'fourier':
+        _fourier(images, translations, out)
+    elif method == 'linear':
+        buffer = np.empty(images.shape[1:], dtype=out.dtype)
+        for image, (x, y), result in zip(images, translations, out):
+            # Rows first into the scratch buffer, then columns into the output, so out may alias images
+            _shiftaxis(image, buffer, y, 0)
+            _shiftaxis(buffer, result, x, 1)
+    else:
+        raise ValueError(f"method must be 'linear' or 'fourier', not {method!r}")
+    return out[0] if single else out
+
+
+def _shiftaxis(src, dst, offset, axis):
+    """ dst[i] = src[i + offset] along axis, linearly interpolated, zero outside src """
+    whole = int(np.floor(offset))
+    fraction = offset - whole
+    length = src.shape[axis]
+
+    def window(step):
+        start, stop = max(0, -step), min(length, length - step)
+        stop = max(start, stop)
+        target = [slice(None)] * 2
+        source = [slice(None)] * 2
+        target[axis] = slice(start, stop)
+        source[axis] = slice(start + step, stop + step)
+        return tuple(target), tuple(source), start, stop
+
+    target, source, start, stop = window(whole)
+    np.multiply(src[source], 1 - fraction, out=dst[target])
+    # Rows or columns that have no source pixel
+    for edge in (slice(0, start), slice(stop, length)):
+        index = [slice(None)] * 2
+        index[axis] = edge
+        dst[tuple(index)] = 0
+    if fraction:
+        target, source, start, stop = window(whole + 1)
+        dst[target] += fraction * src[source]
+
+
+def _fourier(images, translations, out):
+    import scipy.fft
+    h, w = images.shape[1:]
+    ky = scipy.fft.fftfreq(h)[np.newaxis, :, np.newaxis]
+    kx = scipy.fft.rfftfreq(w)[np.newaxis, np.newaxis, :]
+    y = translations[:, 1, np.newaxis, np.newaxis]
+    x = translations[:, 0, np.newaxis, np.newaxis]
+    ramp = np.exp(2j * np.pi * (ky * y + kx * x))
+    spectrum = scipy.fft.rfft2(images.astype(out.dtype, copy=False), axes=(-2, -1), workers=-1)
+    out[...] = scipy.fft.irfft2(spectrum * ramp, s=(h, w), axes=(-2, -1), workers=-1)
@@ -0,0 +1,166 @@
+import os
+import queue
+import threading
+import numpy as np
+import tifffile
+from instrument import stage
+from jobs import checkpoint
+from translate import translate
+
+_DONE = object()
+
+
+class _Stage(threading.Thread):
+
+    """
+    Pipeline stage running in its own thread, pushes its results into a bounded queue so a slow consumer
+    holds back the producer instead of letting frames pile up in memory. Errors are forwarded down the
+    queue and raised again by the consumer.
+    """
+
+    def __init__(self, func, output, stop):
+        super().__init__(daemon=True)
+        self.func = func
+        self.output = output
+        self.stop = stop
+
+    def run(self):
+        try:
+            for item in self.func():
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except BaseException as error:
+            self._put(error)
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def _consume(source, stop):
+    while not stop.is_set():
+        try:
+            item = source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def tosource(image, dtype, overwrite=False):
+    """
+    Casts a shifted float frame back to the dtype of the source stack, integer types are rounded and clipped
+    to their range rather than wrapped
+    :param overwrite: image is a scratch buffer, round and clip it in place and always return a new array
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        out = image if overwrite else None
+        image = np.clip(np.rint(image, out=out), info.min, info.max, out=out)
+    return image.astype(dtype, copy=overwrite)
+
+
+def _tiles(frames, tile):
+    # tifffile expects tiled data to be streamed tile by tile, padded to full tiles at the edges
+    for frame in frames:
+        padded = np.pad(frame, ((0, -frame.shape[0] % tile[0]), (0, -frame.shape[1] % tile[1])))
+        for y in range(0, padded.shape[0], tile[0]):
+            for x in range(0, padded.shape[1], tile[1]):
+                yield np.ascontiguousarray(padded[y:y + tile[0], x:x + tile[1]])
+
+
+def savedriftcorrected(tf, outname, translations, batch=16, bigtiff=None, compression=None, tile=None,
+                       queuesize=4, method='linear', precision='float32', hyperstack=True, progress=None,
+                       cancel=None):
+    """
+    Writes a drift corrected copy of a stack. Reading, shifting and writing run as overlapping stages
+    connected by bounded queues, frames move through them in blocks of batch and the whole stack is written
+    as a single contiguous series. Every channel and z-plane of a time point is shifted by its translation,
+    so drift estimated on one channel corrects them all.
+    :param tf: stack of tiff images encapsulated in the tiffstack class
+    :param outname: path of the corrected tiff
+    :param translations: (nfiles, 2) array of (x, y) translations, one per frame
+    :param batch: frames per block
+    :param bigtiff: write a BigTIFF, None picks it automatically when the output may exceed 4 GB
+    :param compression: tifffile compression, e.g. 'zlib' or 'zstd', None writes uncompressed
+    :param tile: (height, width) of tiles, None writes one strip per frame
+    :param queuesize: maximum number of blocks held between two stages
+    :param method: 'linear' or 'fourier' interpolation, see translate.translate
+    :param precision: float dtype frames are shifted in
+    :param hyperstack: write every channel and plane as a TCZYX series, False writes only the frames of tf
+    :param progress: called as progress(frames written so far) after every block
+    :param cancel: threading.Event, raises jobs.Cancelled once it is set and removes the partial file
+    :return: None
+    """
+    translations = np.asarray(translations, dtype=float)
+    planes = getattr(tf, 'nchannels', 1) * getattr(tf, 'nplanes', 1) if hyperstack else 1
+    # tiffstack's width and height are the first and second axis of a frame
+    shape = (tf.nfiles, tf.width, tf.height)
+    metadata = {}
+    if planes > 1:
+        shape = (tf.nfiles, tf.nchannels, tf.nplanes, tf.width, tf.height)
+        metadata = {'axes': 'TCZYX'}
+    dtype = np.dtype(tf.dtype)
+    if bigtiff is None:
+        bigtiff = np.prod(shape) * dtype.itemsize > 2 ** 32 - 2 ** 25
+
+    def read():
+        for start in range(0, tf.nfiles, batch):
+            with stage('decode'):
+                if planes > 1:
+                    block = tf.gethyperstack(start, start + batch).reshape(-1, tf.width, tf.height)
+                else:
+                    block = tf.getimages(start, start + batch)
+            yield start, block
+
+    def shift():
+        # Blocks are shifted into one scratch buffer, only the cast to the source dtype makes a new array
+        buffer = np.empty((min(batch, tf.nfiles) * planes, tf.width, tf.height), dtype=precision)
+        for start, block in _consume(loaded, stop):
+            # All channels and planes of a time point share its translation
+            moved = translate(block, np.repeat(translations[start:start + len(block) // planes], planes, axis=0),
+                              method, out=buffer[:len(block)])
+            with stage('cast'):
+                block = tosource(moved, dtype, overwrite=True)
+            yield block
+
+    def frames():
+        written = 0
+        for block in _consume(shifted, stop):
+            checkpoint(cancel)
+            yield from block
+            written += len(block) // planes
+            if progress is not None:
+                progress(written)
+
+    stop = threading.Event()
+    loaded = queue.Queue(queuesize)
+    shifted = queue.Queue(queuesize)
+    workers = [_Stage(read, loaded, stop), _Stage(shift, shifted, stop)]
+    for worker in workers:
+        worker.start()
+    try:
+        # The stages overlap, so this is the time of the whole export rather than of the writing alone
+        with stage('write'), tifffile.TiffWriter(outname, bigtiff=bigtiff) as tif:
+            data = _tiles(frames(), tile) if tile is not None else frames()
+            # Grayscale planes even when there are 3 or 4 of them, which would otherwise be taken as RGB(A)
+            tif.write(data, shape=shape, dtype=dtype, compression=compression, tile=tile, metadata=metadata,
+                      photometric='minisblack')
+    except BaseException:
+        if os.path.exists(outname):
+            os.remove(outname)
+        raise
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()